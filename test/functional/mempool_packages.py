@@ -6,9 +6,17 @@
 
 from decimal import Decimal
 
-from test_framework.messages import COIN
+from test_framework.key import ECKey, wif_to_key
+from test_framework.messages import (
+    COIN,
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxOut,
+)
 from test_framework.mininode import P2PTxInvStore
 from test_framework.test_framework import BitcoinTestFramework
+from test_framework.txfactory import P2PKHTemplate, TransactionFactory
 from test_framework.util import (
     assert_equal,
     assert_raises_rpc_error,
@@ -34,24 +42,44 @@ class MempoolPackagesTest(BitcoinTestFramework):
     def skip_test_if_missing_module(self):
         self.skip_if_no_wallet()
 
+    def spend_template(self, node, txid, vout):
+        """The template to sign a spend of txid:vout"""
+        template = self.templates.get((txid, vout))
+        if template is None:
+            # A wallet coin, sign with the wallet's key
+            address = node.gettxout(txid, vout)['scriptPubKey']['addresses'][0]
+            template = P2PKHTemplate(wif_to_key(node.dumpprivkey(address)))
+        return template
+
     # Build a transaction that spends parent_txid:vout
     # Return amount sent
     def chain_transaction(self, node, parent_txid, vout,
                           value, fee, num_outputs):
         send_value = satoshi_round((value - fee) / num_outputs)
-        inputs = [{'txid': parent_txid, 'vout': vout}]
-        outputs = {}
+        tx = CTransaction()
+        tx.vin = [CTxIn(COutPoint(int(parent_txid, 16), vout))]
+        tx.vout = [CTxOut(int(send_value * COIN), self.template.script_pubkey)
+                   for _ in range(num_outputs)]
+        # Sign locally, rather than going through the wallet for every
+        # transaction of the chains
+        signedtx = self.factory.sign_transaction(
+            tx, [(self.spend_template(node, parent_txid, vout),
+                  int(value * COIN))])
+        txid = node.sendrawtransaction(signedtx)
         for i in range(num_outputs):
-            outputs[node.getnewaddress()] = send_value
-        rawtx = node.createrawtransaction(inputs, outputs)
-        signedtx = node.signrawtransactionwithwallet(rawtx)
-        txid = node.sendrawtransaction(signedtx['hex'])
-        fulltx = node.getrawtransaction(txid, 1)
-        # make sure we didn't generate a change output
-        assert len(fulltx['vout']) == num_outputs
+            self.templates[(txid, i)] = self.template
         return (txid, send_value)
 
     def run_test(self):
+        key = ECKey()
+        key.generate()
+        self.template = P2PKHTemplate(key)
+        self.templates = {}
+        # Stops the signing processes, if any were started
+        with TransactionFactory() as self.factory:
+            self.test_packages()
+
+    def test_packages(self):
         # Mine some blocks and have them mature.
         # keep track of invs
         self.nodes[0].add_p2p_connection(P2PTxInvStore())
@@ -326,7 +354,7 @@ class MempoolPackagesTest(BitcoinTestFramework):
         value = send_value
 
         # Create tx1
-        tx1_id, _ = self.chain_transaction(
+        tx1_id, tx1_value = self.chain_transaction(
             self.nodes[0], tx0_id, 0, value, fee, 1)
 
         # Create tx2-7
@@ -343,11 +371,15 @@ class MempoolPackagesTest(BitcoinTestFramework):
         self.sync_all()
 
         # Now generate tx8, with a big fee
-        inputs = [{'txid': tx1_id, 'vout': 0}, {'txid': txid, 'vout': 0}]
-        outputs = {self.nodes[0].getnewaddress(): send_value + value - 4 * fee}
-        rawtx = self.nodes[0].createrawtransaction(inputs, outputs)
-        signedtx = self.nodes[0].signrawtransactionwithwallet(rawtx)
-        txid = self.nodes[0].sendrawtransaction(signedtx['hex'])
+        tx = CTransaction()
+        tx.vin = [CTxIn(COutPoint(int(tx1_id, 16), 0)),
+                  CTxIn(COutPoint(int(txid, 16), 0))]
+        tx.vout = [CTxOut(int((send_value + value - 4 * fee) * COIN),
+                          self.template.script_pubkey)]
+        signedtx = self.factory.sign_transaction(
+            tx, [(self.template, int(tx1_value * COIN)),
+                 (self.template, int(value * COIN))])
+        txid = self.nodes[0].sendrawtransaction(signedtx)
         self.sync_mempools()
 
         # Now try to disconnect the tip on each node...
@@ -20,6 +20,7 @@ from test_framework.util import assert_equal, assert_raises_rpc_error
 class MempoolSpendCoinbaseTest(BitcoinTestFramework):
     def set_test_params(self):
         self.num_nodes = 1
+        self.supports_warm_pool = True
 
     def skip_test_if_missing_module(self):
         self.skip_if_no_wallet()
@@ -8,6 +8,8 @@ Tests that a node configured with -blockfilterindex and -peerblockfilters signal
 NODE_COMPACT_FILTERS and can serve cfilters, cfheaders and cfcheckpts.
 """
 
+from test_framework.authproxy import JSONRPCException
+from test_framework.chainfixture import ChainFixture
 from test_framework.messages import (
     FILTER_TYPE_BASIC,
     NODE_COMPACT_FILTERS,
@@ -46,22 +48,35 @@ class CFiltersClient(P2PInterface):
 
 class CompactFiltersTest(BitcoinTestFramework):
     def set_test_params(self):
-        self.setup_clean_chain = True
         self.rpc_timeout = 480
         self.num_nodes = 2
+        # The framework mines one more block on top of the fixture, so the
+        # nodes start with the same first 999 blocks
+        self.chain_fixture = ChainFixture('blockfilters', length=998)
         self.extra_args = [
             ["-blockfilterindex", "-peerblockfilters"],
             ["-blockfilterindex"],
         ]
 
+    @staticmethod
+    def has_filter(node, blockhash):
+        try:
+            node.getblockfilter(blockhash, 'basic')
+            return True
+        except JSONRPCException:
+            return False
+
     def run_test(self):
         # Node 0 supports COMPACT_FILTERS, node 1 does not.
         node0 = self.nodes[0].add_p2p_connection(CFiltersClient())
         node1 = self.nodes[1].add_p2p_connection(CFiltersClient())
 
-        # Nodes 0 & 1 share the same first 999 blocks in the chain.
-        self.nodes[0].generate(999)
-        self.sync_blocks(timeout=600)
+        # Nodes 0 & 1 share the same first 999 blocks in the chain. The
+        # filter indexes are built in the background when the nodes start.
+        assert_equal(self.nodes[0].getblockcount(), 999)
+        shared_tip = self.nodes[0].getbestblockhash()
+        wait_until(lambda: all(self.has_filter(node, shared_tip)
+                               for node in self.nodes), timeout=60)
 
         # Stale blocks by disconnecting nodes 0 & 1, mining, then reconnecting
         disconnect_nodes(self.nodes[0], self.nodes[1])
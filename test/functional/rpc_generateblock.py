@@ -15,6 +15,7 @@ from test_framework.util import (
 class GenerateBlockTest(BitcoinTestFramework):
     def set_test_params(self):
         self.num_nodes = 1
+        self.supports_warm_pool = True
 
     def skip_test_if_missing_module(self):
         self.skip_if_no_wallet()
@@ -11,6 +11,7 @@ from test_framework.util import assert_equal, assert_raises_rpc_error
 class NamedArgumentTest(BitcoinTestFramework):
     def set_test_params(self):
         self.num_nodes = 1
+        self.supports_warm_pool = True
         self.supports_cli = False
 
     def run_test(self):
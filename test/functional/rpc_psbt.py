@@ -15,6 +15,7 @@ from test_framework.util import (
     assert_equal,
     assert_raises_rpc_error,
     find_output,
+    find_outputs,
 )
 
 # Create one-input, one-output, no-fee transaction:
@@ -321,13 +322,12 @@ class PSBTTest(BitcoinTestFramework):
         # Send to all types of addresses
         addr1 = self.nodes[1].getnewaddress("")  # originally bech32
         txid1 = self.nodes[0].sendtoaddress(addr1, 11)
-        vout1 = find_output(self.nodes[0], txid1, 11)
         addr2 = self.nodes[1].getnewaddress("")  # originally legacy
         txid2 = self.nodes[0].sendtoaddress(addr2, 11)
-        vout2 = find_output(self.nodes[0], txid2, 11)
         addr3 = self.nodes[1].getnewaddress("")  # originally p2sh-segwit
         txid3 = self.nodes[0].sendtoaddress(addr3, 11)
-        vout3 = find_output(self.nodes[0], txid3, 11)
+        vout1, vout2, vout3 = find_outputs(
+            self.nodes[0], [(txid1, 11), (txid2, 11), (txid3, 11)])
         self.sync_all()
 
         def test_psbt_input_keys(psbt_input, keys):
@@ -6,6 +6,7 @@
 
 import unittest
 
+from . import keycache
 from .script import CScript, hash160, hash256
 from .util import hex_str_to_bytes, assert_equal
 
@@ -71,7 +72,10 @@ def scripthash_to_p2sh(hash, main=False):
 
 def key_to_p2pkh(key, main=False):
     key = check_key(key)
-    return keyhash_to_p2pkh(hash160(key), main)
+    address = keycache.derive(
+        'pubkey->p2pkh-main' if main else 'pubkey->p2pkh', key,
+        lambda k: keyhash_to_p2pkh(hash160(k), main).encode('ascii'))
+    return address.decode('ascii')
 
 
 def script_to_p2sh(script, main=False):
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""asyncio counterpart to AuthServiceProxy.
+
+AsyncAuthServiceProxy has the same interface as AuthServiceProxy, but calls
+return coroutines, so many requests can be in flight to many nodes at once.
+TestNode.arpc returns such a proxy for the node.
+
+Tests and helpers that are not written with asyncio use the sync facade,
+which runs the calls on an event loop owned by this module and waits for
+their results:
+
+    best_hashes = gather(*[node.arpc.getbestblockhash() for node in nodes])
+    blocks = gather(*[node.arpc.getblock(h, 2) for h in blockhashes])
+
+The calls to each server go through a pool of keep-alive connections, which
+bounds the number of concurrent requests to a node (bitcoind rejects the
+requests exceeding its -rpcworkqueue).
+"""
+
+import asyncio
+import base64
+import decimal
+from http import HTTPStatus
+import json
+import logging
+import socket
+import threading
+import unittest
+import urllib.parse
+import weakref
+
+from .authproxy import (
+    DEFAULT_POOL_SIZE,
+    HTTP_TIMEOUT,
+    USER_AGENT,
+    EncodeDecimal,
+    JSONRPCException,
+    AuthServiceProxy,
+)
+
+log = logging.getLogger("BitcoinRPC")
+
+
+class _Connection():
+    """A HTTP/1.1 connection over asyncio streams"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.keep_alive = True
+
+    @property
+    def is_stale(self):
+        # The event loop feeds the EOF to the reader as soon as the server
+        # closes an idle connection
+        return self.reader.at_eof()
+
+    def close(self):
+        self.writer.close()
+
+    async def request(self, host, path, headers, postdata):
+        lines = ['POST {} HTTP/1.1'.format(path), 'Host: {}'.format(host)]
+        lines += ['{}: {}'.format(k, v) for k, v in headers.items()]
+        lines.append('Content-Length: {}'.format(len(postdata)))
+        self.writer.write(
+            ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + postdata)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            # The server closed the connection before answering
+            raise ConnectionResetError('Remote end closed connection')
+        version, status, reason = (
+            status_line.decode('latin-1').rstrip('\r\n') + '  ').split(' ', 2)
+        status = int(status)
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    # Trailers
+                    while (await self.reader.readline()) not in (
+                            b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readexactly(2)
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await self.reader.readexactly(
+                int(headers['content-length']))
+        else:
+            body = await self.reader.read()
+            self.keep_alive = False
+
+        connection = headers.get('connection', '').lower()
+        if connection == 'close' or (version == 'HTTP/1.0' and
+                                     connection != 'keep-alive'):
+            self.keep_alive = False
+        return status, reason.strip(), headers, body
+
+
+async def _open_connection(url, timeout):
+    port = 80 if url.port is None else url.port
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(
+        url.hostname, port, ssl=url.scheme == 'https' or None), timeout)
+    return _Connection(reader, writer)
+
+
+class AsyncConnectionPool():
+    """Keep-alive connections to a server, for use by a single event loop.
+
+    At most size requests are in flight at the same time."""
+
+    def __init__(self, url, size=DEFAULT_POOL_SIZE):
+        self.url = url
+        self.size = size
+        self._idle = []
+        self._slots = asyncio.Semaphore(size)
+
+    async def acquire(self, timeout):
+        await asyncio.wait_for(self._slots.acquire(), timeout)
+        while self._idle:
+            conn = self._idle.pop()
+            if not conn.is_stale:
+                return conn
+            conn.close()
+        try:
+            return await _open_connection(self.url, timeout)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn, reuse=True):
+        if reuse and conn.keep_alive:
+            self._idle.append(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def close(self):
+        idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+# The pools of each event loop, by server
+_loop_pools = weakref.WeakKeyDictionary()
+
+
+def get_async_connection_pool(url, size=DEFAULT_POOL_SIZE):
+    """Return the pool of the running event loop for the server of url."""
+    pools = _loop_pools.setdefault(asyncio.get_event_loop(), {})
+    key = (url.scheme, url.hostname, url.port)
+    if key not in pools:
+        pools[key] = AsyncConnectionPool(url, size)
+    return pools[key]
+
+
+class AsyncAuthServiceProxy():
+    """Like AuthServiceProxy, but RPC calls return a coroutine."""
+
+    def __init__(self, service_url, service_name=None,
+                 timeout=HTTP_TIMEOUT, pool_size=DEFAULT_POOL_SIZE):
+        self.__service_url = service_url
+        self._service_name = service_name
+        self.__url = urllib.parse.urlparse(service_url)
+        # The credentials are sent as they appear in the url, like
+        # AuthServiceProxy does
+        authpair = self.__url.username.encode('utf8') + b':' + \
+            self.__url.password.encode('utf8')
+        self.__auth_header = 'Basic ' + \
+            base64.b64encode(authpair).decode('ascii')
+        self.timeout = timeout
+        self.pool_size = pool_size
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name.endswith('__'):
+            # Python internal stuff
+            raise AttributeError
+        if self._service_name is not None:
+            name = "{}.{}".format(self._service_name, name)
+        return AsyncAuthServiceProxy(
+            self.__service_url, name, self.timeout, self.pool_size)
+
+    def __truediv__(self, relative_uri):
+        return AsyncAuthServiceProxy(
+            "{}/{}".format(self.__service_url, relative_uri),
+            self._service_name, self.timeout, self.pool_size)
+
+    def get_request(self, *args, **argsn):
+        # Share the ids with the sync proxies
+        request_id = next(AuthServiceProxy._id_counter)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("-{}-> {} {}".format(
+                request_id, self._service_name,
+                json.dumps(args or argsn, default=EncodeDecimal)))
+        if args and argsn:
+            raise ValueError(
+                'Cannot handle both named and positional arguments')
+        return {'version': '1.1',
+                'method': self._service_name,
+                'params': args or argsn,
+                'id': request_id}
+
+    async def _request(self, postdata):
+        pool = get_async_connection_pool(self.__url, self.pool_size)
+        # The sizes of the last exchange, for the RPC profiling
+        self.last_request_bytes = len(postdata)
+        headers = {'User-Agent': USER_AGENT,
+                   'Authorization': self.__auth_header,
+                   'Content-type': 'application/json'}
+        try:
+            conn = await pool.acquire(self.timeout)
+        except asyncio.TimeoutError:
+            raise JSONRPCException({
+                'code': -344,
+                'message': 'No RPC connection to {} became available within '
+                           '{} seconds'.format(self.__url.netloc,
+                                               self.timeout)})
+        reuse = False
+        try:
+            try:
+                result = await asyncio.wait_for(conn.request(
+                    self.__url.hostname, self.__url.path or '/', headers,
+                    postdata), self.timeout)
+            except (BrokenPipeError, ConnectionResetError,
+                    asyncio.IncompleteReadError):
+                # The server closed the connection while it was idle
+                conn.close()
+                conn = await _open_connection(self.__url, self.timeout)
+                result = await asyncio.wait_for(conn.request(
+                    self.__url.hostname, self.__url.path or '/', headers,
+                    postdata), self.timeout)
+            reuse = True
+        except asyncio.TimeoutError:
+            raise JSONRPCException({
+                'code': -344,
+                'message': '{!r} RPC took longer than {} seconds. Consider '
+                           'using larger timeout for calls that take '
+                           'longer to return.'.format(self._service_name,
+                                                      self.timeout)})
+        finally:
+            pool.release(conn, reuse)
+
+        status, reason, headers, body = result
+        self.last_response_bytes = len(body)
+        if headers.get('content-type') != 'application/json':
+            raise JSONRPCException(
+                {'code': -342,
+                 'message': 'non-JSON HTTP response with \'{} {}\' from server'.format(
+                     status, reason)},
+                status)
+        response = json.loads(body.decode('utf8'),
+                              parse_float=decimal.Decimal)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("<-- {}".format(body.decode('utf8')))
+        return response, status
+
+    async def __call__(self, *args, **argsn):
+        postdata = json.dumps(self.get_request(*args, **argsn),
+                              default=EncodeDecimal, ensure_ascii=True)
+        response, status = await self._request(postdata.encode('utf-8'))
+        if response['error'] is not None:
+            raise JSONRPCException(response['error'], status)
+        elif 'result' not in response:
+            raise JSONRPCException({
+                'code': -343, 'message': 'missing JSON-RPC result'}, status)
+        elif status != HTTPStatus.OK:
+            raise JSONRPCException({
+                'code': -342, 'message': 'non-200 HTTP status code but no JSON-RPC error'}, status)
+        return response['result']
+
+    async def batch(self, rpc_call_list):
+        postdata = json.dumps(list(rpc_call_list), default=EncodeDecimal)
+        log.debug("--> " + postdata)
+        response, status = await self._request(postdata.encode('utf-8'))
+        if status != HTTPStatus.OK:
+            raise JSONRPCException({
+                'code': -342, 'message': 'non-200 HTTP status code but no JSON-RPC error'}, status)
+        return response
+
+
+# Sync facade
+#############
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _get_loop():
+    """The event loop running the calls of the sync facade, in its own
+    thread, so the connections it opens are reused across calls."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="AsyncRPCThread",
+                             daemon=True).start()
+        return _loop
+
+
+def run(awaitable):
+    """Wait for the result of an awaitable, from synchronous code."""
+    loop = _get_loop()
+    assert threading.current_thread().name != "AsyncRPCThread", \
+        "The sync facade must not be used from the RPC event loop"
+
+    async def wrapper():
+        return await awaitable
+    return asyncio.run_coroutine_threadsafe(wrapper(), loop).result()
+
+
+def gather(*awaitables):
+    """Wait for the results of several awaitables, e.g. RPC calls to several
+    nodes, which run concurrently. Returns the list of their results, in
+    order, or raises the first exception."""
+    async def gather_all():
+        return list(await asyncio.gather(*awaitables))
+    return run(gather_all())
+
+
+class TestFrameworkAsyncRPC(unittest.TestCase):
+    def setUp(self):
+        # Reuse the echo server of the sync proxy tests
+        from .authproxy import TestFrameworkAuthProxy
+        self.server_test = TestFrameworkAuthProxy()
+        self.server_test.setUp()
+        self.url = self.server_test.url
+
+    def tearDown(self):
+        async def close_pools():
+            pools = _loop_pools.pop(asyncio.get_event_loop(), {})
+            for pool in pools.values():
+                pool.close()
+        run(close_pools())
+        self.server_test.tearDown()
+
+    def test_gather(self):
+        proxy = AsyncAuthServiceProxy(self.url, pool_size=4)
+        results = gather(*[proxy.echo(i) for i in range(20)])
+        self.assertEqual(results, [[i] for i in range(20)])
+        self.assertEqual(run((proxy / 'wallet/w1').echo(x=1)), {'x': 1})
+        # The connections of the event loop are kept alive between calls
+        self.assertLessEqual(len(self.server_test.connections), 4)
+
+    def test_credentials(self):
+        # Same Authorization header as the sync proxy, escapes included
+        url = self.url.replace('user:pass', 'us%3Aer:p%2Fss')
+        run(AsyncAuthServiceProxy(url).echo(1))
+        AuthServiceProxy(url).echo(1)
+        auth_headers = self.server_test.auth_headers
+        self.assertEqual(len(auth_headers), 2)
+        self.assertEqual(auth_headers[0], auth_headers[1])
+
+    def test_concurrency(self):
+        proxy = AsyncAuthServiceProxy(self.url, pool_size=4)
+        gather(*[proxy.sleep(0.2) for _ in range(8)])
+        # The calls ran concurrently, within the limit of the pool size
+        self.assertEqual(self.server_test.in_flight[1], 4)
+
+    def test_stale_connection(self):
+        proxy = AsyncAuthServiceProxy(self.url)
+        self.assertEqual(run(proxy.echo(1)), [1])
+        for conn in self.server_test.connections:
+            conn.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(run(proxy.echo(2)), [2])
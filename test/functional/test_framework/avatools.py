@@ -23,7 +23,9 @@ def get_stakes(node: TestNode,
     :param amount: If specified, this overwrites the amount information
         in the coinbase dicts.
     """
-    blocks = [node.getblock(h, 2) for h in blockhashes]
+    with node.batch() as b:
+        futures = [b.getblock(h, 2) for h in blockhashes]
+    blocks = [f.result() for f in futures]
     coinbases = [
         {
             'height': b['height'],
@@ -10,9 +10,11 @@ from .script import (
     CScript,
     CScriptNum,
     CScriptOp,
+    GetSigOpCount,
     OP_1,
     OP_CHECKSIG,
     OP_DUP,
+    OP_EQUAL,
     OP_EQUALVERIFY,
     OP_HASH160,
     OP_RETURN,
@@ -143,13 +145,13 @@ def get_legacy_sigopcount_block(block, accurate=True):
 
 
 def get_legacy_sigopcount_tx(tx, accurate=True):
+    # The counts are cached per script (see compile_script), and both
+    # scriptPubKey and scriptSig might be of type bytes.
     count = 0
     for i in tx.vout:
-        count += i.scriptPubKey.GetSigOpCount(accurate)
+        count += GetSigOpCount(i.scriptPubKey, accurate)
     for j in tx.vin:
-        # scriptSig might be of type bytes, so convert to CScript for the
-        # moment
-        count += CScript(j.scriptSig).GetSigOpCount(accurate)
+        count += GetSigOpCount(j.scriptSig, accurate)
     return count
 
 
@@ -204,33 +206,68 @@ def mine_big_block(node, utxos=None):
     node.generate(1)
 
 
+def _is_p2pkh(script):
+    return len(script) == 25 and \
+        script[:3] == bytes([OP_DUP, OP_HASH160, 20]) and \
+        script[23:] == bytes([OP_EQUALVERIFY, OP_CHECKSIG])
+
+
 def send_big_transactions(node, utxos, num, fee_multiplier):
+    """Send num large transactions spending the wallet coins utxos. The
+    P2PKH coins are signed locally with the key exported by dumpprivkey, so
+    the transactions can be signed in parallel. The wallet signs the other
+    coins with signrawtransactionwithwallet."""
     from .cashaddr import decode
-    txids = []
+    from .key import wif_to_key
+    from .script import SIGHASH_FORKID, SIGHASH_NONE
+    from .txfactory import P2PKHTemplate, TransactionFactory
     padding = "1" * 512
     addrHash = decode(node.getnewaddress())[2]
 
-    for _ in range(num):
+    templates = {}
+    txs = []
+    # Index in the transactions -> signed by the wallet
+    wallet_signed = {}
+    for n in range(num):
         ctx = CTransaction()
         utxo = utxos.pop()
         txid = int(utxo['txid'], 16)
+        amount = int(satoshi_round(utxo['amount'] * COIN))
         ctx.vin.append(CTxIn(COutPoint(txid, int(utxo["vout"])), b""))
         ctx.vout.append(
-            CTxOut(int(satoshi_round(utxo['amount'] * COIN)),
+            CTxOut(amount,
                    CScript([OP_DUP, OP_HASH160, addrHash, OP_EQUALVERIFY, OP_CHECKSIG])))
         for i in range(0, 127):
             ctx.vout.append(CTxOut(0, CScript(
                 [OP_RETURN, bytes(padding, 'utf-8')])))
         # Create a proper fee for the transaction to be mined
         ctx.vout[0].nValue -= int(fee_multiplier * node.calculate_fee(ctx))
-        signresult = node.signrawtransactionwithwallet(
-            ToHex(ctx), None, "NONE|FORKID")
-        txid = node.sendrawtransaction(signresult["hex"], 0)
-        txids.append(txid)
-    return txids
+        if not _is_p2pkh(bytes.fromhex(utxo['scriptPubKey'])):
+            wallet_signed[n] = node.signrawtransactionwithwallet(
+                ToHex(ctx), None, "NONE|FORKID")["hex"]
+            continue
+        address = utxo['address']
+        if address not in templates:
+            templates[address] = P2PKHTemplate(
+                wif_to_key(node.dumpprivkey(address)), sigtype='ecdsa',
+                hashtype=SIGHASH_NONE | SIGHASH_FORKID)
+        txs.append((ctx, [(templates[address], amount)]))
+
+    with TransactionFactory() as factory:
+        signed = iter(factory.sign_transactions(txs))
+    return [node.sendrawtransaction(
+        wallet_signed[n] if n in wallet_signed else next(signed), 0)
+        for n in range(num)]
 
 
 class TestFrameworkBlockTools(unittest.TestCase):
+    def test_is_p2pkh(self):
+        self.assertTrue(_is_p2pkh(CScript(
+            [OP_DUP, OP_HASH160, bytes(20), OP_EQUALVERIFY, OP_CHECKSIG])))
+        self.assertFalse(_is_p2pkh(CScript(
+            [OP_DUP, OP_HASH160, bytes(21), OP_EQUALVERIFY, OP_CHECKSIG])))
+        self.assertFalse(_is_p2pkh(CScript([OP_HASH160, bytes(20), OP_EQUAL])))
+
     def test_create_coinbase(self):
         height = 20
         coinbase_tx = create_coinbase(height=height)
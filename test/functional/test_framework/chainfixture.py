@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Named chains mined once and shared through the test cache.
+
+The default cached chain (see BitcoinTestFramework._initialize_chain) is 199
+blocks long. A test needing a longer chain, many mature coins or large
+blocks declares a chain fixture instead of mining it every run:
+
+    def set_test_params(self):
+        self.num_nodes = 2
+        self.chain_fixture = ChainFixture(
+            'big-blocks', length=1000, block_size=900000)
+
+The first run mines the chain with a single node and keeps its datadir in
+the cache directory, under a key derived from the parameters of the fixture
+and the hash of the bitcoind binary: changing either mines it again. The
+datadirs of the nodes are then provisioned from it like from the default
+cache, and the nodes start with the fixture chain and mine a block to leave
+the initial block download, see BitcoinTestFramework.setup_nodes().
+
+The coinbases are paid to the deterministic keys of the first nodes, in turn
+(see TestNode.PRIV_KEYS), so the nodes can spend them after importing their
+key. The chain itself is deterministic, except for the transaction
+signatures and the timestamps of the blocks.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+# Name of the cache subdirectory holding the fixtures
+FIXTURES_DIRNAME = 'fixtures'
+# Name of the file describing a generated fixture
+MANIFEST_FILENAME = 'fixture.json'
+
+# Number of blocks mined between two fan-outs of the matured coinbases
+MINING_BATCH = 100
+# Fee rate of the fan-out transactions, in satoshis per byte
+FANOUT_FEE_PER_BYTE = 2
+# Version of the padded blocks, signalling no deployment
+PADDED_BLOCK_VERSION = 0x20000000
+
+_binary_digests = {}
+
+
+def binary_digest(path):
+    """Return the sha256 of the file at path, hashed once per process."""
+    path = os.path.realpath(path)
+    if path not in _binary_digests:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        _binary_digests[path] = h.hexdigest()
+    return _binary_digests[path]
+
+
+class ChainFixture():
+    """A chain declared by its parameters, see the module documentation.
+
+    name: names the fixture in the cache directory and in the logs.
+    version: bump it when the meaning of the parameters or the way the chain
+      is mined changes, so the fixtures cached with the old code are dropped.
+    length: height of the tip of the chain.
+    miners: number of deterministic keys the coinbases are paid to, in turn.
+    fanout: number of outputs each coinbase is split into once mature, so
+      the chain holds many spendable coins. 0 leaves the coinbases unspent.
+    block_size: when set, the blocks that do not include fan-out
+      transactions are padded to about that many bytes with a large
+      unspendable coinbase output. These blocks have no miner fund output,
+      so this cannot be used with -enableminerfund.
+    extra_args: the arguments of the node mining the chain, e.g. the
+      activation flags. The nodes of the test need compatible ones.
+    """
+
+    def __init__(self, name, *, version=1, length=200, miners=4, fanout=0,
+                 block_size=None, extra_args=()):
+        assert name and os.sep not in name, \
+            'Invalid fixture name {!r}'.format(name)
+        assert length >= 1
+        assert 1 <= miners <= 8
+        assert fanout >= 0
+        self.name = name
+        self.version = version
+        self.length = length
+        self.miners = miners
+        self.fanout = fanout
+        self.block_size = block_size
+        self.extra_args = list(extra_args)
+
+    def params(self):
+        return {
+            'name': self.name,
+            'version': self.version,
+            'length': self.length,
+            'miners': self.miners,
+            'fanout': self.fanout,
+            'block_size': self.block_size,
+            'extra_args': self.extra_args,
+        }
+
+    def key(self, binary_hash, extra_args=()):
+        """Return the cache key of the fixture mined by the bitcoind binary
+        with this hash, with extra_args added by the framework."""
+        manifest = dict(self.params(), binary=binary_hash,
+                        framework_args=list(extra_args))
+        return hashlib.sha256(json.dumps(
+            manifest, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+    def cache_dir(self, cachedir, key):
+        return os.path.join(
+            cachedir, FIXTURES_DIRNAME, '{}-{}'.format(self.name, key))
+
+    def generate(self, node):
+        """Mine the chain on node, started on an empty datadir."""
+        from .cdefs import COINBASE_MATURITY
+        from .key import wif_to_key
+        from .messages import COIN
+        from .txfactory import P2PKHTemplate
+
+        keys = node.PRIV_KEYS[:self.miners]
+        templates = [P2PKHTemplate(wif_to_key(k.key)) for k in keys]
+        # Unspent coinbases to fan out, height -> (txid, value)
+        coinbases = {}
+        height = node.getblockcount()
+        assert height < self.length, 'The node already has a chain'
+        while height < self.length:
+            # Blocks too far in the future of the mocktime are rejected
+            node.setmocktime(node.getblockheader(
+                node.getbestblockhash())['time'])
+
+            mature = [h for h in sorted(coinbases)
+                      if h + COINBASE_MATURITY <= height + 1]
+            if mature:
+                self._fan_out(node, [
+                    coinbases.pop(h) + (templates[(h - 1) % self.miners],)
+                    for h in mature])
+
+            count = min(MINING_BATCH, self.length - height)
+            heights = range(height + 1, height + count + 1)
+            if self.block_size is None:
+                with node.batch() as b:
+                    futures = [b.generatetoaddress(
+                        1, keys[(h - 1) % self.miners].address)
+                        for h in heights]
+                for f in futures:
+                    f.result()
+            else:
+                if mature:
+                    # The fan-out transactions go in a regular block
+                    node.generatetoaddress(
+                        1, keys[height % self.miners].address)
+                    heights = heights[1:]
+                self._mine_padded_blocks(node, heights, templates)
+
+            if self.fanout:
+                with node.batch() as b:
+                    hashes = [b.getblockhash(h)
+                              for h in range(height + 1, height + count + 1)]
+                with node.batch() as b:
+                    blocks = [b.getblock(f.result(), 2) for f in hashes]
+                for f in blocks:
+                    block = f.result()
+                    cb = block['tx'][0]
+                    coinbases[block['height']] = (
+                        cb['txid'], int(cb['vout'][0]['value'] * COIN))
+            height += count
+        assert node.getblockcount() == self.length
+
+    def _mine_padded_blocks(self, node, heights, templates):
+        """Mine a block padded to block_size at each height, on top of the
+        tip of node."""
+        from .blocktools import create_block, create_coinbase
+        from .messages import CTxOut, ToHex
+        from .script import CScript, OP_NOP, OP_RETURN
+
+        # The block and coinbase sizes, and the size of the output
+        padding = CScript(bytes([OP_RETURN]) + bytes([OP_NOP]) * max(
+            0, self.block_size - 250))
+        tip = node.getblockheader(node.getbestblockhash())
+        tip_hash = int(tip['hash'], 16)
+        ntime = tip['time'] + 1
+        with node.batch() as b:
+            futures = []
+            for h in heights:
+                coinbase = create_coinbase(h)
+                coinbase.vout[0].scriptPubKey = \
+                    templates[(h - 1) % self.miners].script_pubkey
+                coinbase.vout.append(CTxOut(0, padding))
+                coinbase.rehash()
+                block = create_block(tip_hash, coinbase, ntime,
+                                     version=PADDED_BLOCK_VERSION)
+                block.solve()
+                futures.append(b.submitblock(ToHex(block)))
+                tip_hash = block.sha256
+                ntime += 1
+        for f in futures:
+            result = f.result()
+            assert result is None, 'Padded block rejected: {}'.format(result)
+
+    def _fan_out(self, node, coins):
+        """Split each of the (txid, value, template) coinbases into fanout
+        outputs to the same key."""
+        from .messages import COutPoint, CTransaction, CTxIn, CTxOut
+        from .txfactory import TransactionFactory
+
+        txs = []
+        for txid, value, template in coins:
+            tx = CTransaction()
+            tx.vin.append(CTxIn(COutPoint(int(txid, 16), 0)))
+            # Version, locktime, input with its signature, outputs
+            size = 10 + 150 + 35 * self.fanout
+            amount = (value - FANOUT_FEE_PER_BYTE * size) // self.fanout
+            assert amount > 1000, 'Fan-out too large for the coinbase value'
+            tx.vout = [CTxOut(amount, template.script_pubkey)
+                       for _ in range(self.fanout)]
+            txs.append((tx, [(template, value)]))
+        with TransactionFactory() as factory:
+            signed = factory.sign_transactions(txs)
+        with node.batch() as b:
+            futures = [b.sendrawtransaction(tx) for tx in signed]
+        for f in futures:
+            f.result()
+
+    def save(self, generated_dir, fixture_dir, manifest):
+        """Move the fixture mined in generated_dir to fixture_dir. Another
+        process may have stored the same fixture meanwhile, then
+        generated_dir is removed.
+
+        The other cached versions of the fixture are left alone: a
+        concurrent run with another binary or other framework arguments may
+        be provisioning its nodes from them. They go with the cache
+        directory, which test_runner.py flushes unless --keepcache is
+        given."""
+        with open(os.path.join(generated_dir, MANIFEST_FILENAME), 'w',
+                  encoding='utf8') as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+        try:
+            os.rename(generated_dir, fixture_dir)
+        except OSError:
+            if not os.path.isdir(fixture_dir):
+                raise
+            shutil.rmtree(generated_dir)
+
+
+class TestFrameworkChainFixture(unittest.TestCase):
+    def test_key(self):
+        fixture = ChainFixture('test', length=1000, fanout=10)
+        key = fixture.key('aa')
+        self.assertEqual(len(key), 16)
+        self.assertEqual(key, ChainFixture(
+            'test', length=1000, fanout=10).key('aa'))
+        # Any parameter, the binary and the framework arguments change it
+        self.assertNotEqual(key, ChainFixture(
+            'test', length=1001, fanout=10).key('aa'))
+        self.assertNotEqual(key, ChainFixture(
+            'test', version=2, length=1000, fanout=10).key('aa'))
+        self.assertNotEqual(key, fixture.key('ab'))
+        self.assertNotEqual(key, fixture.key('aa', ['-axionactivationtime']))
+
+    def test_binary_digest(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'bitcoind')
+            f.flush()
+            self.assertEqual(binary_digest(f.name),
+                             hashlib.sha256(b'bitcoind').hexdigest())
+
+    def test_save(self):
+        with tempfile.TemporaryDirectory() as cachedir:
+            fixture = ChainFixture('test')
+
+            def generate(key):
+                generated = tempfile.mkdtemp(dir=cachedir)
+                fixture_dir = fixture.cache_dir(cachedir, key)
+                os.makedirs(os.path.dirname(fixture_dir), exist_ok=True)
+                fixture.save(generated, fixture_dir, fixture.params())
+                return fixture_dir
+
+            old = generate('0' * 16)
+            new = generate('1' * 16)
+            with open(os.path.join(new, MANIFEST_FILENAME),
+                      encoding='utf8') as f:
+                self.assertEqual(json.load(f)['name'], 'test')
+            # The other version may be in use by another run
+            self.assertTrue(os.path.isdir(old))
+            # Stored concurrently by another process, only the temporary
+            # directory of this one is removed
+            self.assertEqual(generate('1' * 16), new)
+            self.assertEqual(
+                sorted(os.listdir(os.path.dirname(new))),
+                sorted([os.path.basename(old), os.path.basename(new)]))
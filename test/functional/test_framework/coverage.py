@@ -2,16 +2,163 @@
 # Copyright (c) 2015-2016 The Bitcoin Core developers
 # Distributed under the MIT software license, see the accompanying
 # file COPYING or http://www.opensource.org/licenses/mit-license.php.
-"""Utilities for doing coverage analysis on the RPC interface.
+"""Utilities for doing coverage analysis and profiling on the RPC interface.
 
 Provides a way to track which RPC commands are exercised during
-testing.
+testing, and how long they take.
+
+A RPC command is written to the coverage log the first time it is covered,
+so the commands covered by a test that is killed are not lost. The profiles
+are kept in memory, written out every PROFILE_FLUSH_INTERVAL and when the
+test exits.
 """
 
+import atexit
+import inspect
+import json
+import math
 import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
 
 
 REFERENCE_FILENAME = 'rpc_interface.txt'
+PROFILE_FILE_PREFIX = 'rpcprofile.'
+# How often the profiles are written out while the test runs, in seconds
+PROFILE_FLUSH_INTERVAL = 5
+# The latencies are counted in buckets whose bounds grow by this factor, so
+# the size of a profile does not depend on the number of calls and the
+# percentiles are known within 10%
+LATENCY_BUCKET_GROWTH = 1.1
+
+
+def latency_bucket(elapsed):
+    """Return the upper bound of the bucket of a latency in seconds, in
+    microseconds."""
+    exponent = math.ceil(math.log(max(elapsed * 1e6, 1),
+                                  LATENCY_BUCKET_GROWTH))
+    return round(LATENCY_BUCKET_GROWTH ** exponent)
+
+
+class CoverageLog():
+    """The RPC commands covered, written to filename."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._covered = set()
+        self._lock = threading.Lock()
+
+    def add(self, rpc_method):
+        with self._lock:
+            if rpc_method in self._covered:
+                return
+            self._covered.add(rpc_method)
+            with open(self.filename, 'a+', encoding='utf8') as f:
+                f.write("{}\n".format(rpc_method))
+
+    def flush(self):
+        # Written as they are covered
+        pass
+
+
+class RPCProfile():
+    """Number of calls, latency histogram and sizes of the RPC commands sent
+    to a node, written to filename."""
+
+    def __init__(self, filename, n_node,
+                 flush_interval=PROFILE_FLUSH_INTERVAL):
+        self.filename = filename
+        self.n_node = n_node
+        self.flush_interval = flush_interval
+        # method -> [count, total time, {latency bucket: count},
+        #            max latency, request bytes, response bytes], the
+        #            latencies in microseconds
+        self.methods = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, rpc_method, elapsed, request_bytes, response_bytes):
+        with self._lock:
+            stats = self.methods.get(rpc_method)
+            if stats is None:
+                stats = self.methods[rpc_method] = [0, 0.0, {}, 0, 0, 0]
+            stats[0] += 1
+            stats[1] += elapsed
+            bucket = latency_bucket(elapsed)
+            stats[2][bucket] = stats[2].get(bucket, 0) + 1
+            stats[3] = max(stats[3], int(elapsed * 1e6))
+            stats[4] += request_bytes
+            stats[5] += response_bytes
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if not self.methods:
+                return
+            profile = {
+                'script': os.path.basename(sys.argv[0]),
+                'node': self.n_node,
+                'methods': {method: {
+                    'count': count,
+                    'time': total,
+                    'latencies': latencies,
+                    'max_latency': max_latency,
+                    'request_bytes': request_bytes,
+                    'response_bytes': response_bytes,
+                } for method, (count, total, latencies, max_latency,
+                               request_bytes, response_bytes)
+                    in self.methods.items()},
+            }
+        # Replaced atomically, the test can be killed while writing
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w', encoding='utf8') as f:
+            json.dump(profile, f)
+        os.replace(tmp_filename, self.filename)
+
+
+# The coverage logs and profiles of this process, by file name
+_files = {}
+_files_lock = threading.Lock()
+_profile_dir = None
+
+
+def _flush_files():
+    with _files_lock:
+        files = list(_files.values())
+    for f in files:
+        f.flush()
+
+
+atexit.register(_flush_files)
+
+
+def _get_file(filename, factory):
+    with _files_lock:
+        if filename not in _files:
+            _files[filename] = factory()
+        return _files[filename]
+
+
+def enable_profiling(dirname):
+    """Profile the RPC calls of the proxies created from now on, into
+    dirname."""
+    global _profile_dir
+    _profile_dir = dirname
+
+
+def get_profile(n_node):
+    """The profile of the node, or None if profiling is not enabled."""
+    if _profile_dir is None:
+        return None
+    filename = os.path.join(_profile_dir, "{}pid{}.node{}.json".format(
+        PROFILE_FILE_PREFIX, os.getpid(), n_node))
+    return _get_file(filename, lambda: RPCProfile(filename, n_node))
 
 
 class AuthServiceProxyWrapper():
@@ -20,24 +167,29 @@ class AuthServiceProxyWrapper():
 
     """
 
-    def __init__(self, auth_service_proxy_instance, coverage_logfile=None):
+    def __init__(self, auth_service_proxy_instance, coverage_logfile=None,
+                 profile=None):
         """
         Kwargs:
             auth_service_proxy_instance (AuthServiceProxy): the instance
                 being wrapped.
             coverage_logfile (str): if specified, write each service_name
                 out to a file when called.
+            profile (RPCProfile): if specified, record the latency and
+                size of each call.
 
         """
         self.auth_service_proxy_instance = auth_service_proxy_instance
         self.coverage_logfile = coverage_logfile
+        self.profile = profile
 
     def __getattr__(self, name):
         return_val = getattr(self.auth_service_proxy_instance, name)
         if not isinstance(return_val, type(self.auth_service_proxy_instance)):
             # If proxy getattr returned an unwrapped value, do the same here.
             return return_val
-        return AuthServiceProxyWrapper(return_val, self.coverage_logfile)
+        return AuthServiceProxyWrapper(
+            return_val, self.coverage_logfile, self.profile)
 
     def __call__(self, *args, **kwargs):
         """
@@ -45,25 +197,80 @@ class AuthServiceProxyWrapper():
         called to a file.
 
         """
-        return_val = self.auth_service_proxy_instance.__call__(*args, **kwargs)
-        self._log_call()
+        rpc_method = self.auth_service_proxy_instance._service_name
+        return self._profiled(
+            rpc_method, self.auth_service_proxy_instance.__call__, args,
+            kwargs, True)
+
+    def batch(self, rpc_call_list):
+        return self._profiled(
+            'batch', self.auth_service_proxy_instance.batch,
+            (rpc_call_list,), {}, False)
+
+    def _profiled(self, rpc_method, func, args, kwargs, log_call):
+        start = time.perf_counter()
+        try:
+            return_val = func(*args, **kwargs)
+        except BaseException:
+            self._record(rpc_method, start)
+            raise
+        if inspect.iscoroutine(return_val):
+            # Async proxy, the call happens when the coroutine is awaited
+            return self._profiled_async(rpc_method, return_val, log_call)
+        self._record(rpc_method, start)
+        if log_call:
+            self._log_call()
         return return_val
 
+    async def _profiled_async(self, rpc_method, coroutine, log_call):
+        start = time.perf_counter()
+        try:
+            return_val = await coroutine
+        finally:
+            self._record(rpc_method, start)
+        if log_call:
+            self._log_call()
+        return return_val
+
+    def _record(self, rpc_method, start):
+        if self.profile is not None:
+            proxy = self.auth_service_proxy_instance
+            self.profile.record(
+                rpc_method, time.perf_counter() - start,
+                getattr(proxy, 'last_request_bytes', 0),
+                getattr(proxy, 'last_response_bytes', 0))
+
     def _log_call(self):
         rpc_method = self.auth_service_proxy_instance._service_name
 
         if self.coverage_logfile:
-            with open(self.coverage_logfile, 'a+', encoding='utf8') as f:
-                f.write("{}\n".format(rpc_method))
+            _get_file(self.coverage_logfile,
+                      lambda: CoverageLog(self.coverage_logfile)).add(
+                rpc_method)
 
     def __truediv__(self, relative_uri):
         return AuthServiceProxyWrapper(self.auth_service_proxy_instance / relative_uri,
-                                       self.coverage_logfile)
+                                       self.coverage_logfile, self.profile)
 
     def get_request(self, *args, **kwargs):
         self._log_call()
         return self.auth_service_proxy_instance.get_request(*args, **kwargs)
 
+    def stream(self, *args, **kwargs):
+        self._log_call()
+        results = self.auth_service_proxy_instance.stream(*args, **kwargs)
+        if self.profile is None:
+            return results
+        return self._profiled_stream(results)
+
+    def _profiled_stream(self, results):
+        rpc_method = self.auth_service_proxy_instance._service_name
+        start = time.perf_counter()
+        try:
+            yield from results
+        finally:
+            self._record(rpc_method, start)
+
 
 def get_filename(dirname, n_node):
     """
@@ -109,3 +316,71 @@ def write_all_rpc_commands(dirname, node):
         f.writelines(list(commands))
 
     return True
+
+
+class TestFrameworkCoverage(unittest.TestCase):
+    def test_latency_bucket(self):
+        self.assertEqual(latency_bucket(0), 1)
+        self.assertEqual(latency_bucket(1e-6), 1)
+        for elapsed in (0.0005, 0.001, 0.0123, 1, 30):
+            bound = latency_bucket(elapsed)
+            self.assertGreaterEqual(bound, elapsed * 1e6 - 1)
+            self.assertLessEqual(bound, elapsed * 1e6 * 1.11)
+        # A bounded number of buckets, for latencies up to 1 s
+        self.assertLessEqual(
+            len({latency_bucket(i / 1e5) for i in range(100000)}),
+            math.ceil(math.log(1e6, LATENCY_BUCKET_GROWTH)) + 1)
+
+    class FakeProxy():
+        def __init__(self, service_name=None):
+            self._service_name = service_name
+            self.last_request_bytes = 0
+            self.last_response_bytes = 0
+
+        def __getattr__(self, name):
+            return TestFrameworkCoverage.FakeProxy(name)
+
+        def __call__(self, *args):
+            self.last_request_bytes = 10
+            self.last_response_bytes = 100
+            if self._service_name == 'fail':
+                raise ValueError
+            if self._service_name == 'async_echo':
+                async def coroutine():
+                    return args
+                return coroutine()
+            return args
+
+    def test_profile(self):
+        import asyncio
+
+        with tempfile.TemporaryDirectory() as dirname:
+            logfile = os.path.join(dirname, 'coverage.txt')
+            self.addCleanup(_files.pop, logfile, None)
+            profile = RPCProfile(os.path.join(dirname, 'profile.json'), 0,
+                                 flush_interval=3600)
+            proxy = AuthServiceProxyWrapper(self.FakeProxy(), logfile, profile)
+            self.assertEqual(proxy.echo(1), (1,))
+            self.assertEqual(proxy.echo(2), (2,))
+            with self.assertRaises(ValueError):
+                proxy.fail()
+
+            loop = asyncio.new_event_loop()
+            self.addCleanup(loop.close)
+            self.assertEqual(loop.run_until_complete(
+                proxy.async_echo(3)), (3,))
+
+            # The covered commands are written right away, the profile on
+            # flush
+            with open(logfile, encoding='utf8') as f:
+                self.assertEqual(f.read(), 'echo\nasync_echo\n')
+            self.assertFalse(os.path.exists(profile.filename))
+            profile.flush_interval = 0
+            proxy.echo(3)
+            with open(profile.filename, encoding='utf8') as f:
+                methods = json.load(f)['methods']
+            self.assertEqual(methods['echo']['count'], 3)
+            self.assertEqual(sum(methods['echo']['latencies'].values()), 3)
+            self.assertEqual(methods['echo']['response_bytes'], 300)
+            self.assertEqual(methods['async_echo']['count'], 1)
+            self.assertEqual(methods['fail']['count'], 1)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Provision the data directories of the nodes from the chain cache.
+
+Copying the cached datadir for every node of every test is a lot of I/O for
+data that mostly never changes. DatadirCloner copies a directory tree using
+the cheapest safe method available for each file:
+
+- reflink: on filesystems supporting it (btrfs, xfs, ...), the copy shares
+  the data blocks of the original until either is modified (ioctl FICLONE).
+- hardlink: otherwise, the block and undo files that are complete are never
+  written to again by bitcoind, they are hardlinked. The last block and undo
+  files, which get the new blocks appended, are copied.
+- copy: everything else, e.g. the LevelDB databases, is copied.
+"""
+
+from collections import Counter
+import errno
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl(2) request cloning a file, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+# The errors telling that a file cannot be cloned or linked at this location
+UNSUPPORTED_ERRNOS = {errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+                      errno.EINVAL, errno.ENOSYS, errno.EPERM}
+
+# Block and undo files, numbered in the order they are written
+BLOCK_FILE_RE = re.compile(r'^(blk|rev)(\d+)\.dat$')
+
+
+def reflink(src, dst):
+    """Clone the file src to dst, sharing its data. Raises OSError if the
+    filesystem does not support it."""
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, 'reflink not supported', src)
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def complete_block_files(directory):
+    """Return the paths of the block and undo files under directory that are
+    followed by another file of the same kind, so never written to again."""
+    complete = set()
+    for root, _, files in os.walk(directory):
+        last = {}
+        for name in files:
+            m = BLOCK_FILE_RE.match(name)
+            if m is None:
+                continue
+            kind, number = m.group(1), int(m.group(2))
+            complete.add(os.path.join(root, name))
+            if number > last.get(kind, (-1, None))[0]:
+                last[kind] = (number, name)
+        for _, name in last.values():
+            complete.discard(os.path.join(root, name))
+    return complete
+
+
+class DatadirCloner():
+    """Copy data directories, see the module documentation.
+
+    The method used for each file is counted in counts. A method found not
+    to be supported is not tried again."""
+
+    def __init__(self):
+        self.use_reflink = True
+        self.use_hardlink = True
+        self.counts = Counter()
+
+    def _copy_file(self, src, dst, linkable):
+        if self.use_reflink:
+            try:
+                reflink(src, dst)
+                shutil.copystat(src, dst)
+                self.counts['reflink'] += 1
+                return dst
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                self.use_reflink = False
+                if os.path.lexists(dst):
+                    os.remove(dst)
+        if linkable and self.use_hardlink:
+            try:
+                os.link(src, dst)
+                self.counts['hardlink'] += 1
+                return dst
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                self.use_hardlink = False
+        shutil.copy2(src, dst)
+        self.counts['copy'] += 1
+        return dst
+
+    def clone(self, src, dst):
+        """Copy the directory tree src to dst, which must not exist."""
+        linkable = complete_block_files(src)
+        shutil.copytree(
+            src, dst,
+            copy_function=lambda s, d: self._copy_file(s, d, s in linkable))
+
+    def report(self):
+        return ', '.join('{}: {} files'.format(method, self.counts[method])
+                         for method in ('reflink', 'hardlink', 'copy')
+                         if self.counts[method])
+
+
+class TestFrameworkDatadir(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.src = os.path.join(tmpdir.name, 'cache')
+        self.dst = os.path.join(tmpdir.name, 'node0')
+        self.files = {
+            'bitcoin.conf': b'regtest=1\n',
+            'regtest/blocks/blk00000.dat': b'block0',
+            'regtest/blocks/blk00001.dat': b'block1',
+            'regtest/blocks/rev00000.dat': b'undo0',
+            'regtest/blocks/index/CURRENT': b'MANIFEST-000001\n',
+            'regtest/chainstate/000003.ldb': b'coins',
+        }
+        for name, data in self.files.items():
+            path = os.path.join(self.src, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+
+    def check_copy(self):
+        for name, data in self.files.items():
+            with open(os.path.join(self.dst, name), 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+    def test_complete_block_files(self):
+        self.assertEqual(
+            complete_block_files(self.src),
+            {os.path.join(self.src, 'regtest/blocks/blk00000.dat')})
+
+    def test_hardlink(self):
+        cloner = DatadirCloner()
+        cloner.use_reflink = False
+        cloner.clone(self.src, self.dst)
+        self.check_copy()
+        self.assertEqual(cloner.counts, {'hardlink': 1, 'copy': 5})
+        self.assertEqual(cloner.report(), 'hardlink: 1 files, copy: 5 files')
+
+        def same_file(name):
+            return os.path.samefile(os.path.join(self.src, name),
+                                    os.path.join(self.dst, name))
+        self.assertTrue(same_file('regtest/blocks/blk00000.dat'))
+        self.assertFalse(same_file('regtest/blocks/blk00001.dat'))
+        self.assertFalse(same_file('regtest/chainstate/000003.ldb'))
+
+    def test_clone(self):
+        # Whatever the filesystem supports
+        cloner = DatadirCloner()
+        cloner.clone(self.src, self.dst)
+        self.check_copy()
+        self.assertEqual(sum(cloner.counts.values()), len(self.files))
+        # The copies are independent
+        with open(os.path.join(self.dst, 'regtest/blocks/blk00001.dat'),
+                  'ab') as f:
+            f.write(b'block2')
+        with open(os.path.join(self.src, 'regtest/blocks/blk00001.dat'),
+                  'rb') as f:
+            self.assertEqual(f.read(), b'block1')
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Keep the import of the test framework cheap.
+
+Every functional test imports test_framework.test_framework before it does
+anything, so whatever is done at import time is paid by every test. The
+modules only needed in some cases (the P2P code and asyncio, the
+serialization of the messages, the debugger, the RPC server of the unit
+tests, ctypes for inotify, the multiprocessing pool of the transaction
+factory, ...) are imported where they are used instead.
+
+measure_import() imports a module in a fresh interpreter with
+`python -X importtime` and returns the time spent in each module. The unit
+tests below check that the modules listed in LAZY_MODULES are not imported
+with the framework and, as a benchmark since the wall clock time depends on
+the machine, that the whole import stays within IMPORT_TIME_BUDGET. The
+report can be printed from test/functional with:
+
+    python3 -m test_framework.importtime [module]
+"""
+
+from collections import namedtuple
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from .script import BENCHMARK_ENV
+
+# The module imported by all the tests
+FRAMEWORK_MODULE = 'test_framework.test_framework'
+
+# Modules the framework must only import when they are used
+LAZY_MODULES = [
+    'asyncio',
+    'ctypes',
+    'http.server',
+    'multiprocessing',
+    'pdb',
+    'socketserver',
+    'test_framework.asyncrpc',
+    'test_framework.key',
+    'test_framework.messages',
+    'test_framework.mininode',
+    'test_framework.netutil',
+    'test_framework.script',
+    'test_framework.socks5',
+]
+
+# Cumulative time of the import of FRAMEWORK_MODULE, including the standard
+# library, in seconds
+IMPORT_TIME_BUDGET = 0.15
+
+# Number of measures, the fastest one is kept
+MEASURE_RUNS = 3
+
+# Time spent importing a module, in microseconds like -X importtime
+ImportTime = namedtuple('ImportTime', ['module', 'self_us', 'cumulative_us'])
+
+
+def parse_importtime(output):
+    """Parse the stderr of `python -X importtime`, return the ImportTime of
+    each module in the order they finished importing."""
+    times = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            # The header
+            continue
+        times.append(ImportTime(fields[2].strip(), int(fields[0]),
+                                int(fields[1])))
+    return times
+
+
+def measure_import(module, runs=MEASURE_RUNS):
+    """Import module in fresh interpreters and return the ImportTime of all
+    the modules it loaded, from the fastest run.
+
+    A first import compiles the modules to a temporary bytecode cache, so
+    the measures do not include the compilation."""
+    tests_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as pycache:
+        env = dict(os.environ, PYTHONPYCACHEPREFIX=pycache)
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        command = [sys.executable, '-X', 'importtime', '-c',
+                   'import {}'.format(module)]
+        subprocess.run(command, cwd=tests_dir, env=env, check=True,
+                       stderr=subprocess.DEVNULL)
+        best = None
+        for _ in range(runs):
+            process = subprocess.run(
+                command, cwd=tests_dir, env=env, check=True,
+                stderr=subprocess.PIPE, universal_newlines=True)
+            times = parse_importtime(process.stderr)
+            if best is None or times[-1].cumulative_us < \
+                    best[-1].cumulative_us:
+                best = times
+    return best
+
+
+def framework_time(times):
+    """Return the time spent in the code of the test_framework modules, in
+    seconds."""
+    return sum(t.self_us for t in times
+               if t.module.split('.')[0] == 'test_framework') / 1e6
+
+
+def report(times, limit=15):
+    """Return the lines describing the slowest imports."""
+    lines = ['{}: {:.1f} ms, framework modules {:.1f} ms'.format(
+        times[-1].module, times[-1].cumulative_us / 1000,
+        framework_time(times) * 1000)]
+    for t in sorted(times, key=lambda t: t.cumulative_us,
+                    reverse=True)[1:limit + 1]:
+        lines.append('  {:<40} {:>8.1f} ms {:>8.1f} ms self'.format(
+            t.module, t.cumulative_us / 1000, t.self_us / 1000))
+    return lines
+
+
+class TestFrameworkImportTime(unittest.TestCase):
+    def test_parse(self):
+        times = parse_importtime(
+            'import time: self [us] | cumulative | imported package\n'
+            'import time:       250 |        250 |   test_framework\n'
+            'import time:       822 |       1072 | test_framework.util\n')
+        self.assertEqual(times, [
+            ImportTime('test_framework', 250, 250),
+            ImportTime('test_framework.util', 822, 1072),
+        ])
+        self.assertEqual(framework_time(times), 0.001072)
+
+    @unittest.skipIf(sys.version_info < (3, 7),
+                     '-X importtime requires python 3.7')
+    def test_lazy_modules(self):
+        times = measure_import(FRAMEWORK_MODULE, runs=1)
+        self.assertEqual(times[-1].module, FRAMEWORK_MODULE)
+        modules = {t.module for t in times}
+        for module in LAZY_MODULES:
+            self.assertNotIn(module, modules,
+                             '{} is imported by {}'.format(
+                                 module, FRAMEWORK_MODULE))
+
+    @unittest.skipIf(sys.version_info < (3, 7),
+                     '-X importtime requires python 3.7')
+    @unittest.skipUnless(os.getenv(BENCHMARK_ENV),
+                         'set {}=1 to run the benchmarks'.format(BENCHMARK_ENV))
+    def test_budget(self):
+        times = measure_import(FRAMEWORK_MODULE)
+        self.assertLessEqual(times[-1].cumulative_us / 1e6,
+                             IMPORT_TIME_BUDGET, '\n'.join(report(times)))
+
+
+if __name__ == '__main__':
+    print('\n'.join(report(measure_import(
+        sys.argv[1] if len(sys.argv) > 1 else FRAMEWORK_MODULE))))
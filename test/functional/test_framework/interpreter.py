@@ -0,0 +1,1560 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""A python implementation of the script interpreter.
+
+Mirrors EvalScript() and VerifyScript() from src/script/interpreter.cpp, so
+tests can check whether a transaction spends its inputs correctly under a
+given set of script flags without submitting it to a node. This is useful to
+filter large batches of generated transactions and only send the interesting
+ones to the node:
+
+    errors = check_transactions(
+        [(tx, spent_outputs) for tx in candidates],
+        STANDARD_SCRIPT_VERIFY_FLAGS)
+
+The implementation is checked against the C++ unit test vectors from
+src/test/data (script_tests.json, tx_valid.json and tx_invalid.json).
+
+Signatures are verified with the slow test-only secp256k1 implementation from
+key.py, so it is not meant for transactions with thousands of signatures.
+"""
+
+from enum import Enum
+import hashlib
+import json
+import os
+import unittest
+
+from .key import (
+    ECPubKey,
+    SECP256K1_ORDER,
+    SECP256K1_ORDER_HALF,
+)
+from .messages import (
+    COIN,
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxOut,
+    FromHex,
+    MAX_MONEY,
+    hash256,
+    sha256,
+)
+from .script import (
+    CScript,
+    CScriptInvalidError,
+    FindAndDelete,
+    MAX_OPS_PER_SCRIPT,
+    MAX_PUBKEYS_PER_MULTISIG,
+    MAX_SCRIPT_ELEMENT_SIZE,
+    MAX_SCRIPT_SIZE,
+    MAX_STACK_SIZE,
+    OPCODE_NAMES,
+    OP_0,
+    OP_0NOTEQUAL,
+    OP_1,
+    OP_16,
+    OP_1ADD,
+    OP_1NEGATE,
+    OP_1SUB,
+    OP_2DIV,
+    OP_2DROP,
+    OP_2DUP,
+    OP_2MUL,
+    OP_2OVER,
+    OP_2ROT,
+    OP_2SWAP,
+    OP_3DUP,
+    OP_ABS,
+    OP_ADD,
+    OP_AND,
+    OP_BIN2NUM,
+    OP_BOOLAND,
+    OP_BOOLOR,
+    OP_CAT,
+    OP_CHECKDATASIG,
+    OP_CHECKDATASIGVERIFY,
+    OP_CHECKLOCKTIMEVERIFY,
+    OP_CHECKMULTISIG,
+    OP_CHECKMULTISIGVERIFY,
+    OP_CHECKSEQUENCEVERIFY,
+    OP_CHECKSIG,
+    OP_CHECKSIGVERIFY,
+    OP_CODESEPARATOR,
+    OP_DEPTH,
+    OP_DIV,
+    OP_DROP,
+    OP_DUP,
+    OP_ELSE,
+    OP_ENDIF,
+    OP_EQUAL,
+    OP_EQUALVERIFY,
+    OP_FROMALTSTACK,
+    OP_GREATERTHAN,
+    OP_GREATERTHANOREQUAL,
+    OP_HASH160,
+    OP_HASH256,
+    OP_IF,
+    OP_IFDUP,
+    OP_INVERT,
+    OP_LESSTHAN,
+    OP_LESSTHANOREQUAL,
+    OP_LSHIFT,
+    OP_MAX,
+    OP_MIN,
+    OP_MOD,
+    OP_MUL,
+    OP_NEGATE,
+    OP_NIP,
+    OP_NOP,
+    OP_NOP1,
+    OP_NOP10,
+    OP_NOP4,
+    OP_NOT,
+    OP_NOTIF,
+    OP_NUM2BIN,
+    OP_NUMEQUAL,
+    OP_NUMEQUALVERIFY,
+    OP_NUMNOTEQUAL,
+    OP_OR,
+    OP_OVER,
+    OP_PICK,
+    OP_PUSHDATA1,
+    OP_PUSHDATA2,
+    OP_PUSHDATA4,
+    OP_RETURN,
+    OP_REVERSEBYTES,
+    OP_RIPEMD160,
+    OP_ROLL,
+    OP_ROT,
+    OP_RSHIFT,
+    OP_SHA1,
+    OP_SHA256,
+    OP_SIZE,
+    OP_SPLIT,
+    OP_SUB,
+    OP_SWAP,
+    OP_TOALTSTACK,
+    OP_TUCK,
+    OP_VERIFY,
+    OP_WITHIN,
+    OP_XOR,
+    PrecomputedTransactionData,
+    SCRIPT_DISALLOW_SEGWIT_RECOVERY,
+    SCRIPT_ENABLE_REPLAY_PROTECTION,
+    SCRIPT_ENABLE_SCHNORR_MULTISIG,
+    SCRIPT_ENABLE_SIGHASH_FORKID,
+    SCRIPT_VERIFY_CHECKDATASIG_SIGOPS,
+    SCRIPT_VERIFY_CHECKLOCKTIMEVERIFY,
+    SCRIPT_VERIFY_CHECKSEQUENCEVERIFY,
+    SCRIPT_VERIFY_CLEANSTACK,
+    SCRIPT_VERIFY_DERSIG,
+    SCRIPT_VERIFY_DISCOURAGE_UPGRADABLE_NOPS,
+    SCRIPT_VERIFY_INPUT_SIGCHECKS,
+    SCRIPT_VERIFY_LOW_S,
+    SCRIPT_VERIFY_MINIMALDATA,
+    SCRIPT_VERIFY_MINIMALIF,
+    SCRIPT_VERIFY_NONE,
+    SCRIPT_VERIFY_NULLFAIL,
+    SCRIPT_VERIFY_P2SH,
+    SCRIPT_VERIFY_SIGPUSHONLY,
+    SCRIPT_VERIFY_STRICTENC,
+    SIGHASH_ALL,
+    SIGHASH_ANYONECANPAY,
+    SIGHASH_FORKID,
+    SIGHASH_SINGLE,
+    SignatureHash,
+    SignatureHashForkId,
+    UNIT_TEST_DATA_DIR,
+    bn2vch,
+    compile_script,
+)
+
+LOCKTIME_THRESHOLD = 500000000
+SEQUENCE_FINAL = 0xffffffff
+SEQUENCE_LOCKTIME_DISABLE_FLAG = (1 << 31)
+SEQUENCE_LOCKTIME_TYPE_FLAG = (1 << 22)
+SEQUENCE_LOCKTIME_MASK = 0x0000ffff
+
+
+class ScriptError(Enum):
+    """See src/script/script_error.h.
+
+    The values are the names used by the test vectors in src/test/data."""
+    OK = "OK"
+    UNKNOWN = "UNKNOWN_ERROR"
+    EVAL_FALSE = "EVAL_FALSE"
+    OP_RETURN = "OP_RETURN"
+    SCRIPT_SIZE = "SCRIPT_SIZE"
+    PUSH_SIZE = "PUSH_SIZE"
+    OP_COUNT = "OP_COUNT"
+    STACK_SIZE = "STACK_SIZE"
+    SIG_COUNT = "SIG_COUNT"
+    PUBKEY_COUNT = "PUBKEY_COUNT"
+    INPUT_SIGCHECKS = "INPUT_SIGCHECKS"
+    INVALID_OPERAND_SIZE = "OPERAND_SIZE"
+    INVALID_NUMBER_RANGE = "INVALID_NUMBER_RANGE"
+    IMPOSSIBLE_ENCODING = "IMPOSSIBLE_ENCODING"
+    INVALID_SPLIT_RANGE = "SPLIT_RANGE"
+    INVALID_BIT_COUNT = "INVALID_BIT_COUNT"
+    VERIFY = "VERIFY"
+    EQUALVERIFY = "EQUALVERIFY"
+    CHECKMULTISIGVERIFY = "CHECKMULTISIGVERIFY"
+    CHECKSIGVERIFY = "CHECKSIGVERIFY"
+    CHECKDATASIGVERIFY = "CHECKDATASIGVERIFY"
+    NUMEQUALVERIFY = "NUMEQUALVERIFY"
+    BAD_OPCODE = "BAD_OPCODE"
+    DISABLED_OPCODE = "DISABLED_OPCODE"
+    INVALID_STACK_OPERATION = "INVALID_STACK_OPERATION"
+    INVALID_ALTSTACK_OPERATION = "INVALID_ALTSTACK_OPERATION"
+    UNBALANCED_CONDITIONAL = "UNBALANCED_CONDITIONAL"
+    NEGATIVE_LOCKTIME = "NEGATIVE_LOCKTIME"
+    UNSATISFIED_LOCKTIME = "UNSATISFIED_LOCKTIME"
+    SIG_HASHTYPE = "SIG_HASHTYPE"
+    SIG_DER = "SIG_DER"
+    MINIMALDATA = "MINIMALDATA"
+    SIG_PUSHONLY = "SIG_PUSHONLY"
+    SIG_HIGH_S = "SIG_HIGH_S"
+    PUBKEYTYPE = "PUBKEYTYPE"
+    CLEANSTACK = "CLEANSTACK"
+    MINIMALIF = "MINIMALIF"
+    SIG_NULLFAIL = "NULLFAIL"
+    SIG_BADLENGTH = "SIG_BADLENGTH"
+    SIG_NONSCHNORR = "SIG_NONSCHNORR"
+    DISCOURAGE_UPGRADABLE_NOPS = "DISCOURAGE_UPGRADABLE_NOPS"
+    ILLEGAL_FORKID = "ILLEGAL_FORKID"
+    MUST_USE_FORKID = "MISSING_FORKID"
+    DIV_BY_ZERO = "DIV_BY_ZERO"
+    MOD_BY_ZERO = "MOD_BY_ZERO"
+    INVALID_BITFIELD_SIZE = "BITFIELD_SIZE"
+    INVALID_BIT_RANGE = "BIT_RANGE"
+    SIGCHECKS_LIMIT_EXCEEDED = "SIGCHECKS_LIMIT_EXCEEDED"
+
+
+# See ScriptErrorString() in src/script/script_error.cpp. The node includes
+# these in its reject reasons, e.g.
+# "mandatory-script-verify-flag-failed (Data push larger than necessary)".
+SCRIPT_ERROR_STRINGS = {
+    ScriptError.OK: "No error",
+    ScriptError.EVAL_FALSE: "Script evaluated without error but finished "
+                            "with a false/empty top stack element",
+    ScriptError.VERIFY: "Script failed an OP_VERIFY operation",
+    ScriptError.EQUALVERIFY: "Script failed an OP_EQUALVERIFY operation",
+    ScriptError.CHECKMULTISIGVERIFY:
+        "Script failed an OP_CHECKMULTISIGVERIFY operation",
+    ScriptError.CHECKSIGVERIFY: "Script failed an OP_CHECKSIGVERIFY operation",
+    ScriptError.CHECKDATASIGVERIFY:
+        "Script failed an OP_CHECKDATASIGVERIFY operation",
+    ScriptError.NUMEQUALVERIFY: "Script failed an OP_NUMEQUALVERIFY operation",
+    ScriptError.SCRIPT_SIZE: "Script is too big",
+    ScriptError.PUSH_SIZE: "Push value size limit exceeded",
+    ScriptError.OP_COUNT: "Operation limit exceeded",
+    ScriptError.STACK_SIZE: "Stack size limit exceeded",
+    ScriptError.SIG_COUNT:
+        "Signature count negative or greater than pubkey count",
+    ScriptError.PUBKEY_COUNT: "Pubkey count negative or limit exceeded",
+    ScriptError.INPUT_SIGCHECKS: "Input SigChecks limit exceeded",
+    ScriptError.INVALID_OPERAND_SIZE: "Invalid operand size",
+    ScriptError.INVALID_NUMBER_RANGE:
+        "Given operand is not a number within the valid range [-2^31...2^31]",
+    ScriptError.IMPOSSIBLE_ENCODING:
+        "The requested encoding is impossible to satisfy",
+    ScriptError.INVALID_SPLIT_RANGE: "Invalid OP_SPLIT range",
+    ScriptError.INVALID_BIT_COUNT:
+        "Invalid number of bit set in OP_CHECKMULTISIG",
+    ScriptError.BAD_OPCODE: "Opcode missing or not understood",
+    ScriptError.DISABLED_OPCODE: "Attempted to use a disabled opcode",
+    ScriptError.INVALID_STACK_OPERATION:
+        "Operation not valid with the current stack size",
+    ScriptError.INVALID_ALTSTACK_OPERATION:
+        "Operation not valid with the current altstack size",
+    ScriptError.OP_RETURN: "OP_RETURN was encountered",
+    ScriptError.UNBALANCED_CONDITIONAL: "Invalid OP_IF construction",
+    ScriptError.DIV_BY_ZERO: "Division by zero error",
+    ScriptError.MOD_BY_ZERO: "Modulo by zero error",
+    ScriptError.INVALID_BITFIELD_SIZE: "Bitfield of unexpected size error",
+    ScriptError.INVALID_BIT_RANGE: "Bitfield's bit out of the expected range",
+    ScriptError.NEGATIVE_LOCKTIME: "Negative locktime",
+    ScriptError.UNSATISFIED_LOCKTIME: "Locktime requirement not satisfied",
+    ScriptError.SIG_HASHTYPE: "Signature hash type missing or not understood",
+    ScriptError.SIG_DER: "Non-canonical DER signature",
+    ScriptError.MINIMALDATA: "Data push larger than necessary",
+    ScriptError.SIG_PUSHONLY: "Only push operators allowed in signatures",
+    ScriptError.SIG_HIGH_S:
+        "Non-canonical signature: S value is unnecessarily high",
+    ScriptError.MINIMALIF: "OP_IF/NOTIF argument must be minimal",
+    ScriptError.SIG_NULLFAIL:
+        "Signature must be zero for failed CHECK(MULTI)SIG operation",
+    ScriptError.SIG_BADLENGTH: "Signature cannot be 65 bytes in CHECKMULTISIG",
+    ScriptError.SIG_NONSCHNORR:
+        "Only Schnorr signatures allowed in this operation",
+    ScriptError.DISCOURAGE_UPGRADABLE_NOPS:
+        "NOPx reserved for soft-fork upgrades",
+    ScriptError.PUBKEYTYPE: "Public key is neither compressed or uncompressed",
+    ScriptError.CLEANSTACK: "Extra items left on stack after execution",
+    ScriptError.ILLEGAL_FORKID: "Illegal use of SIGHASH_FORKID",
+    ScriptError.MUST_USE_FORKID: "Signature must use SIGHASH_FORKID",
+    ScriptError.SIGCHECKS_LIMIT_EXCEEDED:
+        "Validation resources exceeded (SigChecks)",
+}
+
+
+def ScriptErrorString(serror):
+    return SCRIPT_ERROR_STRINGS.get(serror, "unknown error")
+
+
+class ScriptExecutionMetrics:
+    """Counters accumulated while executing the scripts of an input."""
+    __slots__ = ("nSigChecks",)
+
+    def __init__(self):
+        self.nSigChecks = 0
+
+
+class _ScriptFailure(Exception):
+    """Abort the script execution with the given ScriptError"""
+
+    def __init__(self, serror):
+        super().__init__(serror.name)
+        self.serror = serror
+
+
+class _ScriptNumError(Exception):
+    """Raised where CScriptNum would throw scriptnum_error"""
+    pass
+
+
+def _fail(serror):
+    raise _ScriptFailure(serror)
+
+
+def _cast_to_bool(vch):
+    for i, byte in enumerate(vch):
+        if byte != 0:
+            # Can be negative zero
+            return not (i == len(vch) - 1 and byte == 0x80)
+    return False
+
+
+def _is_minimally_encoded(vch, max_size=4):
+    if len(vch) > max_size:
+        return False
+    # The most significant byte, excluding the sign bit, must not be zero
+    # unless the sign bit of the next byte would be set otherwise.
+    if vch and (vch[-1] & 0x7f) == 0:
+        if len(vch) <= 1 or (vch[-2] & 0x80) == 0:
+            return False
+    return True
+
+
+def _minimally_encode(vch):
+    """Return the minimal encoding of the number vch (see
+    CScriptNum::MinimallyEncode())"""
+    if not vch or vch[-1] & 0x7f:
+        return vch
+    if len(vch) == 1:
+        return b''
+    if vch[-2] & 0x80:
+        return vch
+    last = vch[-1]
+    data = bytearray(vch)
+    for i in range(len(data) - 1, 0, -1):
+        if data[i - 1] != 0:
+            if data[i - 1] & 0x80:
+                # The sign bit is used, we need one more byte
+                data[i] = last
+                i += 1
+            else:
+                data[i - 1] |= last
+            return bytes(data[:i])
+    return b''
+
+
+def _decode_num(vch, require_minimal, max_size=4):
+    """The value of CScriptNum(vch, require_minimal, max_size)"""
+    if len(vch) > max_size:
+        raise _ScriptNumError("script number overflow")
+    if require_minimal and not _is_minimally_encoded(vch, max_size):
+        raise _ScriptNumError("non-minimally encoded script number")
+    if not vch:
+        return 0
+    value = int.from_bytes(vch, 'little')
+    if vch[-1] & 0x80:
+        return -(value & ~(0x80 << (8 * (len(vch) - 1))))
+    return value
+
+
+def _getint(n):
+    """CScriptNum::getint() saturates to the int range"""
+    return max(min(n, 0x7fffffff), -0x80000000)
+
+
+def _check_minimal_push(data, opcode):
+    if len(data) == 0:
+        # Should have used OP_0
+        return opcode == OP_0
+    if len(data) == 1 and 1 <= data[0] <= 16:
+        # Should have used OP_1 .. OP_16
+        return False
+    if len(data) == 1 and data[0] == 0x81:
+        # Should have used OP_1NEGATE
+        return False
+    if len(data) <= 75:
+        # Must have used a direct push
+        return opcode == len(data)
+    if len(data) <= 255:
+        return opcode == OP_PUSHDATA1
+    if len(data) <= 65535:
+        return opcode == OP_PUSHDATA2
+    return True
+
+
+def _is_valid_der_signature_encoding(sig):
+    """See IsValidDERSignatureEncoding() in src/script/sigencoding.cpp"""
+    # Format: 0x30 [total-length] 0x02 [R-length] [R] 0x02 [S-length] [S]
+    if len(sig) < 8 or len(sig) > 72:
+        return False
+    if sig[0] != 0x30 or sig[1] != len(sig) - 2 or sig[2] != 0x02:
+        return False
+    lenR = sig[3]
+    if lenR == 0 or sig[4] & 0x80 or lenR > len(sig) - 7:
+        return False
+    if lenR > 1 and sig[4] == 0x00 and not sig[5] & 0x80:
+        return False
+    startS = lenR + 4
+    if sig[startS] != 0x02:
+        return False
+    lenS = sig[startS + 1]
+    if lenS == 0 or sig[startS + 2] & 0x80:
+        return False
+    if startS + lenS + 2 != len(sig):
+        return False
+    if lenS > 1 and sig[startS + 2] == 0x00 and not sig[startS + 3] & 0x80:
+        return False
+    return True
+
+
+def _parse_der_lax(sig):
+    """Parse a DER-ish ECDSA signature like ecdsa_signature_parse_der_lax() in
+    src/pubkey.cpp.
+
+    Returns (r, s), with r = s = 0 if a value overflows, or None if the
+    signature cannot be parsed at all."""
+    pos = 0
+    siglen = len(sig)
+
+    def read_length():
+        nonlocal pos
+        if pos == siglen:
+            return None
+        lenbyte = sig[pos]
+        pos += 1
+        if not lenbyte & 0x80:
+            return lenbyte
+        lenbyte -= 0x80
+        if lenbyte > siglen - pos:
+            return None
+        while lenbyte > 0 and sig[pos] == 0:
+            pos += 1
+            lenbyte -= 1
+        if lenbyte >= 4:
+            return None
+        length = 0
+        while lenbyte > 0:
+            length = (length << 8) + sig[pos]
+            pos += 1
+            lenbyte -= 1
+        return length
+
+    # Sequence tag byte and length bytes
+    if pos == siglen or sig[pos] != 0x30:
+        return None
+    pos += 1
+    if pos == siglen:
+        return None
+    lenbyte = sig[pos]
+    pos += 1
+    if lenbyte & 0x80:
+        lenbyte -= 0x80
+        if lenbyte > siglen - pos:
+            return None
+        pos += lenbyte
+
+    values = []
+    for _ in range(2):
+        # Integer tag byte and length
+        if pos == siglen or sig[pos] != 0x02:
+            return None
+        pos += 1
+        length = read_length()
+        if length is None or length > siglen - pos:
+            return None
+        values.append(bytes(sig[pos:pos + length]).lstrip(b'\x00'))
+        pos += length
+
+    r, s = values
+    if len(r) > 32 or len(s) > 32:
+        return (0, 0)
+    r = int.from_bytes(r, 'big')
+    s = int.from_bytes(s, 'big')
+    if r >= SECP256K1_ORDER or s >= SECP256K1_ORDER:
+        return (0, 0)
+    return (r, s)
+
+
+def _check_low_s(sig):
+    rs = _parse_der_lax(sig)
+    return rs is not None and rs[1] <= SECP256K1_ORDER_HALF
+
+
+def _get_hash_type(vchSig):
+    return vchSig[-1] if vchSig else 0
+
+
+def _is_defined_hash_type(hashtype):
+    return SIGHASH_ALL <= hashtype & ~(
+        SIGHASH_FORKID | SIGHASH_ANYONECANPAY) <= SIGHASH_SINGLE
+
+
+def _check_raw_ecdsa_signature_encoding(sig, flags):
+    if len(sig) == 64:
+        _fail(ScriptError.SIG_BADLENGTH)
+    if (flags & (SCRIPT_VERIFY_DERSIG | SCRIPT_VERIFY_LOW_S |
+                 SCRIPT_VERIFY_STRICTENC) and
+            not _is_valid_der_signature_encoding(sig)):
+        _fail(ScriptError.SIG_DER)
+    if flags & SCRIPT_VERIFY_LOW_S and not _check_low_s(sig):
+        _fail(ScriptError.SIG_HIGH_S)
+
+
+def _check_raw_schnorr_signature_encoding(sig, flags):
+    if len(sig) != 64:
+        _fail(ScriptError.SIG_NONSCHNORR)
+
+
+def _check_raw_signature_encoding(sig, flags):
+    if len(sig) != 64:
+        _check_raw_ecdsa_signature_encoding(sig, flags)
+
+
+def _check_sighash_encoding(vchSig, flags):
+    if flags & SCRIPT_VERIFY_STRICTENC:
+        hashtype = _get_hash_type(vchSig)
+        if not _is_defined_hash_type(hashtype):
+            _fail(ScriptError.SIG_HASHTYPE)
+        usesForkId = bool(hashtype & SIGHASH_FORKID)
+        forkIdEnabled = bool(flags & SCRIPT_ENABLE_SIGHASH_FORKID)
+        if not forkIdEnabled and usesForkId:
+            _fail(ScriptError.ILLEGAL_FORKID)
+        if forkIdEnabled and not usesForkId:
+            _fail(ScriptError.MUST_USE_FORKID)
+
+
+def _check_transaction_signature_encoding(vchSig, flags, check_raw):
+    if len(vchSig) == 0:
+        return
+    check_raw(vchSig[:-1], flags)
+    _check_sighash_encoding(vchSig, flags)
+
+
+def _check_data_signature_encoding(vchSig, flags):
+    if len(vchSig) == 0:
+        return
+    _check_raw_signature_encoding(vchSig, flags)
+
+
+def _check_pubkey_encoding(vchPubKey, flags):
+    if not flags & SCRIPT_VERIFY_STRICTENC:
+        return
+    if len(vchPubKey) == 33 and vchPubKey[0] in (0x02, 0x03):
+        return
+    if len(vchPubKey) == 65 and vchPubKey[0] == 0x04:
+        return
+    _fail(ScriptError.PUBKEYTYPE)
+
+
+def _decode_bitfield(vch, size):
+    """See DecodeBitfield() in src/script/bitfield.cpp"""
+    if size > 32 or len(vch) != (size + 7) // 8:
+        _fail(ScriptError.INVALID_BITFIELD_SIZE)
+    bitfield = int.from_bytes(vch, 'little')
+    if bitfield >> size:
+        _fail(ScriptError.INVALID_BIT_RANGE)
+    return bitfield
+
+
+def _parse_pubkey(vchPubKey):
+    """Return an ECPubKey for the serialized key, or None if it is invalid.
+
+    Like the node, hybrid encodings (0x06 and 0x07 prefixes) are accepted."""
+    if len(vchPubKey) == 33 and vchPubKey[0] in (0x02, 0x03):
+        data = vchPubKey
+    elif len(vchPubKey) == 65 and vchPubKey[0] in (0x04, 0x06, 0x07):
+        if vchPubKey[0] != 0x04 and (vchPubKey[0] ^ vchPubKey[64]) & 1:
+            return None
+        data = b'\x04' + bytes(vchPubKey[1:])
+    else:
+        return None
+    pubkey = ECPubKey()
+    pubkey.set(data)
+    return pubkey if pubkey.is_valid else None
+
+
+def _der_encode(r, s):
+    rb = r.to_bytes((r.bit_length() + 8) // 8, 'big')
+    sb = s.to_bytes((s.bit_length() + 8) // 8, 'big')
+    return b'\x30' + bytes([4 + len(rb) + len(sb), 2, len(rb)]) + \
+        rb + bytes([2, len(sb)]) + sb
+
+
+class BaseSignatureChecker:
+    """A signature checker that is not bound to a transaction.
+
+    Only OP_CHECKDATASIG signatures can be validated, all transaction
+    signature and lock time checks fail."""
+
+    def VerifySignature(self, vchSig, vchPubKey, sighash):
+        """Verify a Schnorr (64 bytes) or ECDSA signature of sighash."""
+        pubkey = _parse_pubkey(vchPubKey)
+        if pubkey is None:
+            return False
+        if len(vchSig) == 64:
+            if int.from_bytes(vchSig[32:], 'big') >= SECP256K1_ORDER:
+                return False
+            # Schnorr signatures commit to the compressed public key
+            pubkey.compressed = True
+            return pubkey.verify_schnorr(bytes(vchSig), sighash)
+        rs = _parse_der_lax(vchSig)
+        if rs is None:
+            return False
+        r, s = rs
+        if r == 0 or s == 0:
+            return False
+        # The node normalizes the signatures to low S before verifying them
+        if s > SECP256K1_ORDER_HALF:
+            s = SECP256K1_ORDER - s
+        return pubkey.verify_ecdsa(_der_encode(r, s), sighash, low_s=False)
+
+    def CheckSig(self, vchSig, vchPubKey, scriptCode, flags):
+        return False
+
+    def CheckLockTime(self, nLockTime):
+        return False
+
+    def CheckSequence(self, nSequence):
+        return False
+
+
+class TransactionSignatureChecker(BaseSignatureChecker):
+    """Check the signatures of input nIn of txTo, spending amount satoshis.
+
+    txdata is an optional PrecomputedTransactionData for txTo, which should be
+    shared by the checkers of all the inputs."""
+
+    def __init__(self, txTo, nIn, amount, txdata=None):
+        self.txTo = txTo
+        self.nIn = nIn
+        self.amount = amount
+        self.txdata = txdata if txdata is not None else \
+            PrecomputedTransactionData(txTo)
+
+    def SignatureHash(self, scriptCode, hashtype, flags):
+        if flags & SCRIPT_ENABLE_REPLAY_PROTECTION:
+            # Legacy chain's value for fork id must be of the form 0xffxxxx.
+            newForkValue = 0xff0000 | ((hashtype >> 8) ^ 0xdead)
+            hashtype = (newForkValue << 8) | (hashtype & 0xff)
+        if hashtype & SIGHASH_FORKID and flags & SCRIPT_ENABLE_SIGHASH_FORKID:
+            return SignatureHashForkId(scriptCode, self.txTo, self.nIn,
+                                       hashtype, self.amount, self.txdata)
+        return SignatureHash(scriptCode, self.txTo, self.nIn, hashtype,
+                             self.txdata)[0]
+
+    def CheckSig(self, vchSig, vchPubKey, scriptCode, flags):
+        if _parse_pubkey(vchPubKey) is None or len(vchSig) == 0:
+            return False
+        sighash = self.SignatureHash(
+            scriptCode, _get_hash_type(vchSig), flags)
+        return self.VerifySignature(vchSig[:-1], vchPubKey, sighash)
+
+    def CheckLockTime(self, nLockTime):
+        txLockTime = self.txTo.nLockTime
+        # Only compare lock times of the same kind (height or time)
+        if (txLockTime < LOCKTIME_THRESHOLD) != (
+                nLockTime < LOCKTIME_THRESHOLD):
+            return False
+        if nLockTime > txLockTime:
+            return False
+        # A final input bypasses the lock time
+        return self.txTo.vin[self.nIn].nSequence != SEQUENCE_FINAL
+
+    def CheckSequence(self, nSequence):
+        txToSequence = self.txTo.vin[self.nIn].nSequence
+        # BIP68 only applies to version 2 transactions and up
+        if self.txTo.nVersion & 0xffffffff < 2:
+            return False
+        if txToSequence & SEQUENCE_LOCKTIME_DISABLE_FLAG:
+            return False
+        mask = SEQUENCE_LOCKTIME_TYPE_FLAG | SEQUENCE_LOCKTIME_MASK
+        txToSequenceMasked = txToSequence & mask
+        nSequenceMasked = nSequence & mask
+        # Only compare relative lock times of the same kind (height or time)
+        if (txToSequenceMasked < SEQUENCE_LOCKTIME_TYPE_FLAG) != (
+                nSequenceMasked < SEQUENCE_LOCKTIME_TYPE_FLAG):
+            return False
+        return nSequenceMasked <= txToSequenceMasked
+
+
+def _cleanup_script_code(scriptCode, vchSig, flags):
+    """Drop the signature from scriptCode when SIGHASH_FORKID is not used"""
+    if not (flags & SCRIPT_ENABLE_SIGHASH_FORKID and
+            _get_hash_type(vchSig) & SIGHASH_FORKID):
+        return FindAndDelete(scriptCode, CScript([bytes(vchSig)]))
+    return scriptCode
+
+
+def _eval_checksig(vchSig, vchPubKey, scriptCode, flags, checker, metrics):
+    _check_transaction_signature_encoding(
+        vchSig, flags, _check_raw_signature_encoding)
+    _check_pubkey_encoding(vchPubKey, flags)
+    if not vchSig:
+        return False
+    scriptCode = _cleanup_script_code(scriptCode, vchSig, flags)
+    success = checker.CheckSig(vchSig, vchPubKey, scriptCode, flags)
+    metrics.nSigChecks += 1
+    if not success and flags & SCRIPT_VERIFY_NULLFAIL:
+        _fail(ScriptError.SIG_NULLFAIL)
+    return success
+
+
+DISABLED_OPCODES = frozenset(
+    [OP_INVERT, OP_2MUL, OP_2DIV, OP_MUL, OP_LSHIFT, OP_RSHIFT])
+VCH_FALSE = b''
+VCH_TRUE = b'\x01'
+
+
+def EvalScript(stack, script, flags, checker, metrics=None):
+    """Execute script on stack (a list of bytes, modified in place).
+
+    Returns (success, ScriptError), see EvalScript() in
+    src/script/interpreter.cpp."""
+    if metrics is None:
+        metrics = ScriptExecutionMetrics()
+    try:
+        _eval_script(stack, script, flags, checker, metrics)
+    except _ScriptFailure as e:
+        return (False, e.serror)
+    except (_ScriptNumError, CScriptInvalidError):
+        return (False, ScriptError.UNKNOWN)
+    return (True, ScriptError.OK)
+
+
+def _eval_script(stack, script, flags, checker, metrics):
+    script = CScript(script)
+    if len(script) > MAX_SCRIPT_SIZE:
+        _fail(ScriptError.SCRIPT_SIZE)
+    compiled = compile_script(script)
+
+    altstack = []
+    # The condition stack is only ever observed through whether it is empty
+    # and whether it contains a False, so only the size and the position of
+    # the first False are tracked.
+    vfExecSize = 0
+    firstFalse = None
+    begincodehash = 0
+    nOpCount = 0
+    fRequireMinimal = bool(flags & SCRIPT_VERIFY_MINIMALDATA)
+
+    def num(vch, max_size=4):
+        return _decode_num(vch, fRequireMinimal, max_size)
+
+    def need(n):
+        if len(stack) < n:
+            _fail(ScriptError.INVALID_STACK_OPERATION)
+
+    for (opcode, sop_idx, data_idx, data_end) in compiled.ops:
+        fExec = firstFalse is None
+
+        if data_idx is not None and data_end - data_idx > \
+                MAX_SCRIPT_ELEMENT_SIZE:
+            _fail(ScriptError.PUSH_SIZE)
+
+        # Note how OP_RESERVED does not count towards the opcode limit.
+        if opcode > OP_16:
+            nOpCount += 1
+            if nOpCount > MAX_OPS_PER_SCRIPT:
+                _fail(ScriptError.OP_COUNT)
+
+        # Some opcodes are disabled (CVE-2010-5137).
+        if opcode in DISABLED_OPCODES:
+            _fail(ScriptError.DISABLED_OPCODE)
+
+        if fExec and opcode <= OP_PUSHDATA4:
+            data = script[data_idx:data_end]
+            if fRequireMinimal and not _check_minimal_push(data, opcode):
+                _fail(ScriptError.MINIMALDATA)
+            stack.append(data)
+        elif fExec or OP_IF <= opcode <= OP_ENDIF:
+            #
+            # Push value
+            #
+            if opcode == OP_1NEGATE or OP_1 <= opcode <= OP_16:
+                stack.append(bn2vch(opcode - (OP_1 - 1)))
+
+            #
+            # Control
+            #
+            elif opcode == OP_NOP:
+                pass
+
+            elif opcode == OP_CHECKLOCKTIMEVERIFY:
+                if flags & SCRIPT_VERIFY_CHECKLOCKTIMEVERIFY:
+                    need(1)
+                    # 5-byte operands are allowed, see interpreter.cpp
+                    nLockTime = num(stack[-1], 5)
+                    if nLockTime < 0:
+                        _fail(ScriptError.NEGATIVE_LOCKTIME)
+                    if not checker.CheckLockTime(nLockTime):
+                        _fail(ScriptError.UNSATISFIED_LOCKTIME)
+
+            elif opcode == OP_CHECKSEQUENCEVERIFY:
+                if flags & SCRIPT_VERIFY_CHECKSEQUENCEVERIFY:
+                    need(1)
+                    nSequence = num(stack[-1], 5)
+                    if nSequence < 0:
+                        _fail(ScriptError.NEGATIVE_LOCKTIME)
+                    # With the disable flag set, CHECKSEQUENCEVERIFY is a NOP
+                    if not nSequence & SEQUENCE_LOCKTIME_DISABLE_FLAG and \
+                            not checker.CheckSequence(nSequence):
+                        _fail(ScriptError.UNSATISFIED_LOCKTIME)
+
+            elif opcode == OP_NOP1 or OP_NOP4 <= opcode <= OP_NOP10:
+                if flags & SCRIPT_VERIFY_DISCOURAGE_UPGRADABLE_NOPS:
+                    _fail(ScriptError.DISCOURAGE_UPGRADABLE_NOPS)
+
+            elif opcode == OP_IF or opcode == OP_NOTIF:
+                fValue = False
+                if fExec:
+                    if len(stack) < 1:
+                        _fail(ScriptError.UNBALANCED_CONDITIONAL)
+                    vch = stack[-1]
+                    if flags & SCRIPT_VERIFY_MINIMALIF:
+                        if len(vch) > 1 or (len(vch) == 1 and vch[0] != 1):
+                            _fail(ScriptError.MINIMALIF)
+                    fValue = _cast_to_bool(vch)
+                    if opcode == OP_NOTIF:
+                        fValue = not fValue
+                    stack.pop()
+                if not fValue and firstFalse is None:
+                    firstFalse = vfExecSize
+                vfExecSize += 1
+
+            elif opcode == OP_ELSE:
+                if vfExecSize == 0:
+                    _fail(ScriptError.UNBALANCED_CONDITIONAL)
+                if firstFalse is None:
+                    firstFalse = vfExecSize - 1
+                elif firstFalse == vfExecSize - 1:
+                    firstFalse = None
+
+            elif opcode == OP_ENDIF:
+                if vfExecSize == 0:
+                    _fail(ScriptError.UNBALANCED_CONDITIONAL)
+                vfExecSize -= 1
+                if firstFalse == vfExecSize:
+                    firstFalse = None
+
+            elif opcode == OP_VERIFY:
+                need(1)
+                if not _cast_to_bool(stack[-1]):
+                    _fail(ScriptError.VERIFY)
+                stack.pop()
+
+            elif opcode == OP_RETURN:
+                _fail(ScriptError.OP_RETURN)
+
+            #
+            # Stack ops
+            #
+            elif opcode == OP_TOALTSTACK:
+                need(1)
+                altstack.append(stack.pop())
+
+            elif opcode == OP_FROMALTSTACK:
+                if len(altstack) < 1:
+                    _fail(ScriptError.INVALID_ALTSTACK_OPERATION)
+                stack.append(altstack.pop())
+
+            elif opcode == OP_2DROP:
+                need(2)
+                del stack[-2:]
+
+            elif opcode == OP_2DUP:
+                need(2)
+                stack.extend(stack[-2:])
+
+            elif opcode == OP_3DUP:
+                need(3)
+                stack.extend(stack[-3:])
+
+            elif opcode == OP_2OVER:
+                need(4)
+                stack.extend(stack[-4:-2])
+
+            elif opcode == OP_2ROT:
+                need(6)
+                moved = stack[-6:-4]
+                del stack[-6:-4]
+                stack.extend(moved)
+
+            elif opcode == OP_2SWAP:
+                need(4)
+                stack[-4:] = stack[-2:] + stack[-4:-2]
+
+            elif opcode == OP_IFDUP:
+                need(1)
+                if _cast_to_bool(stack[-1]):
+                    stack.append(stack[-1])
+
+            elif opcode == OP_DEPTH:
+                stack.append(bn2vch(len(stack)))
+
+            elif opcode == OP_DROP:
+                need(1)
+                stack.pop()
+
+            elif opcode == OP_DUP:
+                need(1)
+                stack.append(stack[-1])
+
+            elif opcode == OP_NIP:
+                need(2)
+                del stack[-2]
+
+            elif opcode == OP_OVER:
+                need(2)
+                stack.append(stack[-2])
+
+            elif opcode == OP_PICK or opcode == OP_ROLL:
+                need(2)
+                n = _getint(num(stack[-1]))
+                stack.pop()
+                if n < 0 or n >= len(stack):
+                    _fail(ScriptError.INVALID_STACK_OPERATION)
+                vch = stack[-n - 1]
+                if opcode == OP_ROLL:
+                    del stack[-n - 1]
+                stack.append(vch)
+
+            elif opcode == OP_ROT:
+                need(3)
+                stack.append(stack.pop(-3))
+
+            elif opcode == OP_SWAP:
+                need(2)
+                stack[-2], stack[-1] = stack[-1], stack[-2]
+
+            elif opcode == OP_TUCK:
+                need(2)
+                stack.insert(-2, stack[-1])
+
+            elif opcode == OP_SIZE:
+                need(1)
+                stack.append(bn2vch(len(stack[-1])))
+
+            #
+            # Bitwise logic
+            #
+            elif opcode in (OP_AND, OP_OR, OP_XOR):
+                need(2)
+                vch1, vch2 = stack[-2], stack[-1]
+                if len(vch1) != len(vch2):
+                    _fail(ScriptError.INVALID_OPERAND_SIZE)
+                a = int.from_bytes(vch1, 'big')
+                b = int.from_bytes(vch2, 'big')
+                if opcode == OP_AND:
+                    result = a & b
+                elif opcode == OP_OR:
+                    result = a | b
+                else:
+                    result = a ^ b
+                stack.pop()
+                stack[-1] = result.to_bytes(len(vch1), 'big')
+
+            elif opcode == OP_EQUAL or opcode == OP_EQUALVERIFY:
+                need(2)
+                fEqual = stack.pop() == stack.pop()
+                stack.append(VCH_TRUE if fEqual else VCH_FALSE)
+                if opcode == OP_EQUALVERIFY:
+                    if not fEqual:
+                        _fail(ScriptError.EQUALVERIFY)
+                    stack.pop()
+
+            #
+            # Numeric
+            #
+            elif opcode in (OP_1ADD, OP_1SUB, OP_NEGATE, OP_ABS, OP_NOT,
+                            OP_0NOTEQUAL):
+                need(1)
+                bn = num(stack[-1])
+                if opcode == OP_1ADD:
+                    bn += 1
+                elif opcode == OP_1SUB:
+                    bn -= 1
+                elif opcode == OP_NEGATE:
+                    bn = -bn
+                elif opcode == OP_ABS:
+                    bn = abs(bn)
+                elif opcode == OP_NOT:
+                    bn = int(bn == 0)
+                else:
+                    bn = int(bn != 0)
+                stack[-1] = bn2vch(bn)
+
+            elif opcode in (OP_ADD, OP_SUB, OP_DIV, OP_MOD, OP_BOOLAND,
+                            OP_BOOLOR, OP_NUMEQUAL, OP_NUMEQUALVERIFY,
+                            OP_NUMNOTEQUAL, OP_LESSTHAN, OP_GREATERTHAN,
+                            OP_LESSTHANOREQUAL, OP_GREATERTHANOREQUAL,
+                            OP_MIN, OP_MAX):
+                need(2)
+                bn1 = num(stack[-2])
+                bn2 = num(stack[-1])
+                if opcode == OP_ADD:
+                    bn = bn1 + bn2
+                elif opcode == OP_SUB:
+                    bn = bn1 - bn2
+                elif opcode == OP_DIV:
+                    if bn2 == 0:
+                        _fail(ScriptError.DIV_BY_ZERO)
+                    # C++ integer division truncates towards zero
+                    bn = abs(bn1) // abs(bn2)
+                    if (bn1 < 0) != (bn2 < 0):
+                        bn = -bn
+                elif opcode == OP_MOD:
+                    if bn2 == 0:
+                        _fail(ScriptError.MOD_BY_ZERO)
+                    # The result has the sign of the dividend, as in C++
+                    bn = abs(bn1) % abs(bn2)
+                    if bn1 < 0:
+                        bn = -bn
+                elif opcode == OP_BOOLAND:
+                    bn = int(bn1 != 0 and bn2 != 0)
+                elif opcode == OP_BOOLOR:
+                    bn = int(bn1 != 0 or bn2 != 0)
+                elif opcode in (OP_NUMEQUAL, OP_NUMEQUALVERIFY):
+                    bn = int(bn1 == bn2)
+                elif opcode == OP_NUMNOTEQUAL:
+                    bn = int(bn1 != bn2)
+                elif opcode == OP_LESSTHAN:
+                    bn = int(bn1 < bn2)
+                elif opcode == OP_GREATERTHAN:
+                    bn = int(bn1 > bn2)
+                elif opcode == OP_LESSTHANOREQUAL:
+                    bn = int(bn1 <= bn2)
+                elif opcode == OP_GREATERTHANOREQUAL:
+                    bn = int(bn1 >= bn2)
+                elif opcode == OP_MIN:
+                    bn = min(bn1, bn2)
+                else:
+                    bn = max(bn1, bn2)
+                del stack[-2:]
+                stack.append(bn2vch(bn))
+                if opcode == OP_NUMEQUALVERIFY:
+                    if not _cast_to_bool(stack[-1]):
+                        _fail(ScriptError.NUMEQUALVERIFY)
+                    stack.pop()
+
+            elif opcode == OP_WITHIN:
+                need(3)
+                bn1 = num(stack[-3])
+                bn2 = num(stack[-2])
+                bn3 = num(stack[-1])
+                del stack[-3:]
+                stack.append(VCH_TRUE if bn2 <= bn1 < bn3 else VCH_FALSE)
+
+            #
+            # Crypto
+            #
+            elif opcode == OP_RIPEMD160:
+                need(1)
+                stack[-1] = hashlib.new('ripemd160', stack[-1]).digest()
+
+            elif opcode == OP_SHA1:
+                need(1)
+                stack[-1] = hashlib.sha1(stack[-1]).digest()
+
+            elif opcode == OP_SHA256:
+                need(1)
+                stack[-1] = sha256(stack[-1])
+
+            elif opcode == OP_HASH160:
+                need(1)
+                stack[-1] = hashlib.new(
+                    'ripemd160', sha256(stack[-1])).digest()
+
+            elif opcode == OP_HASH256:
+                need(1)
+                stack[-1] = hash256(stack[-1])
+
+            elif opcode == OP_CODESEPARATOR:
+                # Hash starts after the code separator
+                begincodehash = sop_idx + 1
+
+            elif opcode == OP_CHECKSIG or opcode == OP_CHECKSIGVERIFY:
+                need(2)
+                fSuccess = _eval_checksig(
+                    stack[-2], stack[-1], CScript(script[begincodehash:]),
+                    flags, checker, metrics)
+                del stack[-2:]
+                stack.append(VCH_TRUE if fSuccess else VCH_FALSE)
+                if opcode == OP_CHECKSIGVERIFY:
+                    if not fSuccess:
+                        _fail(ScriptError.CHECKSIGVERIFY)
+                    stack.pop()
+
+            elif opcode == OP_CHECKDATASIG or opcode == OP_CHECKDATASIGVERIFY:
+                need(3)
+                vchSig, vchMessage, vchPubKey = stack[-3:]
+                _check_data_signature_encoding(vchSig, flags)
+                _check_pubkey_encoding(vchPubKey, flags)
+                fSuccess = False
+                if vchSig:
+                    fSuccess = checker.VerifySignature(
+                        vchSig, vchPubKey, sha256(vchMessage))
+                    metrics.nSigChecks += 1
+                    if not fSuccess and flags & SCRIPT_VERIFY_NULLFAIL:
+                        _fail(ScriptError.SIG_NULLFAIL)
+                del stack[-3:]
+                stack.append(VCH_TRUE if fSuccess else VCH_FALSE)
+                if opcode == OP_CHECKDATASIGVERIFY:
+                    if not fSuccess:
+                        _fail(ScriptError.CHECKDATASIGVERIFY)
+                    stack.pop()
+
+            elif opcode == OP_CHECKMULTISIG or \
+                    opcode == OP_CHECKMULTISIGVERIFY:
+                nOpCount = _eval_checkmultisig(
+                    stack, CScript(script[begincodehash:]), flags, checker,
+                    metrics, nOpCount, fRequireMinimal)
+                if opcode == OP_CHECKMULTISIGVERIFY:
+                    if not _cast_to_bool(stack[-1]):
+                        _fail(ScriptError.CHECKMULTISIGVERIFY)
+                    stack.pop()
+
+            #
+            # Byte string operations
+            #
+            elif opcode == OP_CAT:
+                need(2)
+                if len(stack[-2]) + len(stack[-1]) > MAX_SCRIPT_ELEMENT_SIZE:
+                    _fail(ScriptError.PUSH_SIZE)
+                vch2 = stack.pop()
+                stack[-1] += vch2
+
+            elif opcode == OP_SPLIT:
+                need(2)
+                data = stack[-2]
+                # The position is converted to an unsigned integer
+                position = _getint(num(stack[-1])) & 0xffffffffffffffff
+                if position > len(data):
+                    _fail(ScriptError.INVALID_SPLIT_RANGE)
+                stack[-2:] = [data[:position], data[position:]]
+
+            elif opcode == OP_REVERSEBYTES:
+                need(1)
+                stack[-1] = stack[-1][::-1]
+
+            #
+            # Conversion operations
+            #
+            elif opcode == OP_NUM2BIN:
+                need(2)
+                size = _getint(num(stack[-1])) & 0xffffffffffffffff
+                if size > MAX_SCRIPT_ELEMENT_SIZE:
+                    _fail(ScriptError.PUSH_SIZE)
+                stack.pop()
+                rawnum = _minimally_encode(stack[-1])
+                if len(rawnum) > size:
+                    _fail(ScriptError.IMPOSSIBLE_ENCODING)
+                if len(rawnum) < size:
+                    signbit = 0x00
+                    if rawnum:
+                        signbit = rawnum[-1] & 0x80
+                        rawnum = rawnum[:-1] + bytes([rawnum[-1] & 0x7f])
+                    rawnum += bytes(size - len(rawnum) - 1) + \
+                        bytes([signbit])
+                stack[-1] = rawnum
+
+            elif opcode == OP_BIN2NUM:
+                need(1)
+                stack[-1] = _minimally_encode(stack[-1])
+                if not _is_minimally_encoded(stack[-1]):
+                    _fail(ScriptError.INVALID_NUMBER_RANGE)
+
+            else:
+                _fail(ScriptError.BAD_OPCODE)
+
+        # Size limits
+        if len(stack) + len(altstack) > MAX_STACK_SIZE:
+            _fail(ScriptError.STACK_SIZE)
+
+    if compiled.error is not None:
+        # The script ends with a truncated push
+        _fail(ScriptError.BAD_OPCODE)
+
+    if vfExecSize != 0:
+        _fail(ScriptError.UNBALANCED_CONDITIONAL)
+
+
+def _eval_checkmultisig(stack, scriptCode, flags, checker, metrics, nOpCount,
+                        fRequireMinimal):
+    """OP_CHECKMULTISIG, returns the updated opcode count.
+
+    ([dummy] [sig ...] num_of_signatures [pubkey ...] num_of_pubkeys -- bool)
+    """
+    def need(n):
+        if len(stack) < n:
+            _fail(ScriptError.INVALID_STACK_OPERATION)
+
+    # Stack depths (from the top) of the arguments
+    idxKeyCount = 1
+    need(idxKeyCount)
+    nKeysCount = _getint(_decode_num(stack[-idxKeyCount], fRequireMinimal))
+    if nKeysCount < 0 or nKeysCount > MAX_PUBKEYS_PER_MULTISIG:
+        _fail(ScriptError.PUBKEY_COUNT)
+    nOpCount += nKeysCount
+    if nOpCount > MAX_OPS_PER_SCRIPT:
+        _fail(ScriptError.OP_COUNT)
+
+    idxTopKey = idxKeyCount + 1
+    idxSigCount = idxTopKey + nKeysCount
+    need(idxSigCount)
+    nSigsCount = _getint(_decode_num(stack[-idxSigCount], fRequireMinimal))
+    if nSigsCount < 0 or nSigsCount > nKeysCount:
+        _fail(ScriptError.SIG_COUNT)
+
+    idxTopSig = idxSigCount + 1
+    idxDummy = idxTopSig + nSigsCount
+    need(idxDummy)
+
+    fSuccess = True
+    if flags & SCRIPT_ENABLE_SCHNORR_MULTISIG and len(stack[-idxDummy]):
+        # Schnorr multisig: the dummy element is a bitfield telling which
+        # pubkeys are checked.
+        checkBits = _decode_bitfield(stack[-idxDummy], nKeysCount)
+        if bin(checkBits).count('1') != nSigsCount:
+            _fail(ScriptError.INVALID_BIT_COUNT)
+
+        idxBottomKey = idxTopKey + nKeysCount - 1
+        idxBottomSig = idxTopSig + nSigsCount - 1
+        iKey = 0
+        for iSig in range(nSigsCount):
+            # Find the next key to check
+            while not (checkBits >> iKey) & 0x01:
+                iKey += 1
+            vchSig = stack[-idxBottomSig + iSig]
+            vchPubKey = stack[-idxBottomKey + iKey]
+            # Only pubkeys associated with a signature are checked
+            _check_transaction_signature_encoding(
+                vchSig, flags, _check_raw_schnorr_signature_encoding)
+            _check_pubkey_encoding(vchPubKey, flags)
+            if not checker.CheckSig(vchSig, vchPubKey, scriptCode, flags):
+                _fail(ScriptError.SIG_NULLFAIL)
+            metrics.nSigChecks += 1
+            iKey += 1
+    else:
+        # Legacy multisig (ECDSA / NULL)
+
+        # Remove signatures for pre-fork scripts
+        for k in range(nSigsCount):
+            scriptCode = _cleanup_script_code(
+                scriptCode, stack[-idxTopSig - k], flags)
+
+        nSigsRemaining = nSigsCount
+        nKeysRemaining = nKeysCount
+        while fSuccess and nSigsRemaining > 0:
+            vchSig = stack[-idxTopSig - (nSigsCount - nSigsRemaining)]
+            vchPubKey = stack[-idxTopKey - (nKeysCount - nKeysRemaining)]
+
+            # The exact order of pubkey/signature evaluation is observable
+            # through the encoding errors.
+            _check_transaction_signature_encoding(
+                vchSig, flags, _check_raw_ecdsa_signature_encoding)
+            _check_pubkey_encoding(vchPubKey, flags)
+
+            if checker.CheckSig(vchSig, vchPubKey, scriptCode, flags):
+                nSigsRemaining -= 1
+            nKeysRemaining -= 1
+
+            # Too many signatures have failed, exit early
+            if nSigsRemaining > nKeysRemaining:
+                fSuccess = False
+
+        areAllSignaturesNull = not any(
+            len(stack[-idxTopSig - i]) for i in range(nSigsCount))
+        if not fSuccess and flags & SCRIPT_VERIFY_NULLFAIL and \
+                not areAllSignaturesNull:
+            _fail(ScriptError.SIG_NULLFAIL)
+        if not areAllSignaturesNull:
+            # An upper bound of the number of signature verifications
+            metrics.nSigChecks += nKeysCount
+
+    # Clean up stack of all arguments
+    del stack[-idxDummy:]
+    stack.append(VCH_TRUE if fSuccess else VCH_FALSE)
+    return nOpCount
+
+
+def _is_witness_program(script):
+    return (4 <= len(script) <= 42 and
+            (script[0] == OP_0 or OP_1 <= script[0] <= OP_16) and
+            script[1] + 2 == len(script))
+
+
+def _is_pay_to_script_hash(script):
+    return (len(script) == 23 and script[0] == OP_HASH160 and
+            script[1] == 0x14 and script[22] == OP_EQUAL)
+
+
+def VerifyScript(scriptSig, scriptPubKey, flags, checker, metrics=None):
+    """Check that scriptSig satisfies scriptPubKey.
+
+    Returns (success, ScriptError), see VerifyScript() in
+    src/script/interpreter.cpp. If metrics is a ScriptExecutionMetrics, it is
+    updated on success."""
+    try:
+        metricsOut = _verify_script(scriptSig, scriptPubKey, flags, checker)
+    except _ScriptFailure as e:
+        return (False, e.serror)
+    except (_ScriptNumError, CScriptInvalidError):
+        return (False, ScriptError.UNKNOWN)
+    if metrics is not None:
+        metrics.nSigChecks = metricsOut.nSigChecks
+    return (True, ScriptError.OK)
+
+
+def _verify_script(scriptSig, scriptPubKey, flags, checker):
+    # If FORKID is enabled, we also ensure strict encoding.
+    if flags & SCRIPT_ENABLE_SIGHASH_FORKID:
+        flags |= SCRIPT_VERIFY_STRICTENC
+
+    scriptSig = CScript(scriptSig)
+    if flags & SCRIPT_VERIFY_SIGPUSHONLY and not scriptSig.IsPushOnly():
+        _fail(ScriptError.SIG_PUSHONLY)
+
+    metrics = ScriptExecutionMetrics()
+
+    # scriptSig and scriptPubKey must be evaluated sequentially on the same
+    # stack rather than being simply concatenated (see CVE-2010-5141)
+    stack = []
+    _eval_script(stack, scriptSig, flags, checker, metrics)
+    stackCopy = list(stack)
+    _eval_script(stack, scriptPubKey, flags, checker, metrics)
+    if not stack or not _cast_to_bool(stack[-1]):
+        _fail(ScriptError.EVAL_FALSE)
+
+    # Additional validation for spend-to-script-hash transactions
+    if flags & SCRIPT_VERIFY_P2SH and _is_pay_to_script_hash(scriptPubKey):
+        # scriptSig must be literals-only or validation fails
+        if not scriptSig.IsPushOnly():
+            _fail(ScriptError.SIG_PUSHONLY)
+
+        stack = stackCopy
+        redeemScript = CScript(stack.pop())
+
+        # Segwit recovery: the redeem script is a p2sh segwit program and it
+        # was the only item pushed onto the stack.
+        if not flags & SCRIPT_DISALLOW_SEGWIT_RECOVERY and not stack and \
+                _is_witness_program(redeemScript):
+            return metrics
+
+        _eval_script(stack, redeemScript, flags, checker, metrics)
+        if not stack or not _cast_to_bool(stack[-1]):
+            _fail(ScriptError.EVAL_FALSE)
+
+    # The CLEANSTACK check is only performed after potential P2SH evaluation
+    if flags & SCRIPT_VERIFY_CLEANSTACK:
+        assert flags & SCRIPT_VERIFY_P2SH
+        if len(stack) != 1:
+            _fail(ScriptError.CLEANSTACK)
+
+    if flags & SCRIPT_VERIFY_INPUT_SIGCHECKS:
+        # Limit the density of sigchecks in the scriptSig, see
+        # interpreter.cpp for the rationale of the numbers.
+        if len(scriptSig) < metrics.nSigChecks * 43 - 60:
+            _fail(ScriptError.INPUT_SIGCHECKS)
+
+    return metrics
+
+
+def check_transaction(tx, spent_outputs, flags, txdata=None):
+    """Verify the scripts of all the inputs of tx.
+
+    spent_outputs is the list of the CTxOut spent by each input, in input
+    order. Returns (input index, ScriptError) for the first failing input, or
+    (None, ScriptError.OK) if all the inputs are valid."""
+    assert len(spent_outputs) == len(tx.vin)
+    if txdata is None:
+        txdata = PrecomputedTransactionData(tx)
+    for i, (txin, txout) in enumerate(zip(tx.vin, spent_outputs)):
+        checker = TransactionSignatureChecker(tx, i, txout.nValue, txdata)
+        success, serror = VerifyScript(
+            txin.scriptSig, txout.scriptPubKey, flags, checker)
+        if not success:
+            return (i, serror)
+    return (None, ScriptError.OK)
+
+
+def check_transactions(candidates, flags):
+    """Batch version of check_transaction().
+
+    candidates is an iterable of (tx, spent_outputs). Returns the list of the
+    ScriptError of each candidate, ScriptError.OK for the valid ones, so
+    generated transactions can be filtered before being sent to a node."""
+    return [check_transaction(tx, spent_outputs, flags)[1]
+            for tx, spent_outputs in candidates]
+
+
+# Names of the flags in the unit test vectors, see src/test/scriptflags.cpp
+SCRIPT_FLAG_NAMES = {
+    "NONE": SCRIPT_VERIFY_NONE,
+    "P2SH": SCRIPT_VERIFY_P2SH,
+    "STRICTENC": SCRIPT_VERIFY_STRICTENC,
+    "DERSIG": SCRIPT_VERIFY_DERSIG,
+    "LOW_S": SCRIPT_VERIFY_LOW_S,
+    "SIGPUSHONLY": SCRIPT_VERIFY_SIGPUSHONLY,
+    "MINIMALDATA": SCRIPT_VERIFY_MINIMALDATA,
+    "DISCOURAGE_UPGRADABLE_NOPS": SCRIPT_VERIFY_DISCOURAGE_UPGRADABLE_NOPS,
+    "CLEANSTACK": SCRIPT_VERIFY_CLEANSTACK,
+    "MINIMALIF": SCRIPT_VERIFY_MINIMALIF,
+    "NULLFAIL": SCRIPT_VERIFY_NULLFAIL,
+    "CHECKLOCKTIMEVERIFY": SCRIPT_VERIFY_CHECKLOCKTIMEVERIFY,
+    "CHECKSEQUENCEVERIFY": SCRIPT_VERIFY_CHECKSEQUENCEVERIFY,
+    "SIGHASH_FORKID": SCRIPT_ENABLE_SIGHASH_FORKID,
+    "REPLAY_PROTECTION": SCRIPT_ENABLE_REPLAY_PROTECTION,
+    "CHECKDATASIG": SCRIPT_VERIFY_CHECKDATASIG_SIGOPS,
+    "DISALLOW_SEGWIT_RECOVERY": SCRIPT_DISALLOW_SEGWIT_RECOVERY,
+    "SCHNORR_MULTISIG": SCRIPT_ENABLE_SCHNORR_MULTISIG,
+    "INPUT_SIGCHECKS": SCRIPT_VERIFY_INPUT_SIGCHECKS,
+}
+
+
+def parse_script_flags(names):
+    """Parse a comma separated list of flag names, see SCRIPT_FLAG_NAMES"""
+    flags = 0
+    for name in filter(None, names.split(",")):
+        flags |= SCRIPT_FLAG_NAMES[name]
+    return flags
+
+
+def parse_script(asm):
+    """Parse the script notation of the unit test vectors (see ParseScript()
+    in src/core_read.cpp): decimal numbers are pushed as numbers, 0x
+    prefixed hex is inserted verbatim, 'quoted' strings are pushed as data
+    and opcodes can be named with or without the OP_ prefix."""
+    chunks = []
+    for word in asm.split():
+        if word.lstrip('-').isdigit() and word != '-':
+            chunks.append(CScript([int(word)]))
+        elif word.startswith('0x') and len(word) > 2:
+            chunks.append(bytes.fromhex(word[2:]))
+        elif len(word) >= 2 and word[0] == "'" and word[-1] == "'":
+            chunks.append(CScript([word[1:-1].encode()]))
+        else:
+            chunks.append(bytes([_OPCODES_BY_NAME[word]]))
+    return CScript(b''.join(chunks))
+
+
+_OPCODES_BY_NAME = {}
+for _opcode, _name in OPCODE_NAMES.items():
+    if _opcode >= OP_PUSHDATA1:
+        _OPCODES_BY_NAME[_name] = _opcode
+        _OPCODES_BY_NAME[_name[3:]] = _opcode
+
+
+class TestFrameworkInterpreter(unittest.TestCase):
+    def load_vectors(self, filename):
+        with open(os.path.join(UNIT_TEST_DATA_DIR, filename),
+                  encoding="utf-8") as f:
+            # Single strings are comments
+            return [v for v in json.load(f) if len(v) > 1]
+
+    def test_script_tests(self):
+        for vector in self.load_vectors("script_tests.json"):
+            amount = 0
+            if isinstance(vector[0], list):
+                amount = int(round(vector[0][0] * COIN))
+                vector = vector[1:]
+            scriptSig = parse_script(vector[0])
+            scriptPubKey = parse_script(vector[1])
+            flags = parse_script_flags(vector[2])
+            expected = ScriptError(vector[3])
+            if flags & SCRIPT_VERIFY_CLEANSTACK:
+                flags |= SCRIPT_VERIFY_P2SH
+
+            # See BuildCreditingTransaction/BuildSpendingTransaction in
+            # src/test/util/transaction_utils.cpp
+            txCredit = CTransaction()
+            txCredit.nVersion = 1
+            txCredit.vin = [CTxIn(COutPoint(0, 0xffffffff),
+                                  CScript([OP_0, OP_0]), SEQUENCE_FINAL)]
+            txCredit.vout = [CTxOut(amount, scriptPubKey)]
+            txCredit.rehash()
+            txSpend = CTransaction()
+            txSpend.nVersion = 1
+            txSpend.vin = [CTxIn(COutPoint(txCredit.sha256, 0), scriptSig,
+                                 SEQUENCE_FINAL)]
+            txSpend.vout = [CTxOut(amount, CScript())]
+
+            checker = TransactionSignatureChecker(txSpend, 0, amount)
+            self.assertEqual(
+                VerifyScript(scriptSig, scriptPubKey, flags, checker),
+                (expected == ScriptError.OK, expected), vector)
+
+    def check_tx_vector(self, vector):
+        prevouts = {}
+        for prevout in vector[0]:
+            txid, n, scriptPubKey = prevout[:3]
+            amount = prevout[3] if len(prevout) > 3 else 0
+            prevouts[(int(txid, 16), n & 0xffffffff)] = CTxOut(
+                amount, parse_script(scriptPubKey))
+        tx = FromHex(CTransaction(), vector[1])
+        spent_outputs = [prevouts[(txin.prevout.hash, txin.prevout.n)]
+                         for txin in tx.vin]
+        return check_transaction(
+            tx, spent_outputs, parse_script_flags(vector[2]))
+
+    def test_tx_valid(self):
+        for vector in self.load_vectors("tx_valid.json"):
+            self.assertEqual(self.check_tx_vector(vector),
+                             (None, ScriptError.OK), vector)
+
+    def test_tx_invalid(self):
+        for vector in self.load_vectors("tx_invalid.json"):
+            tx = FromHex(CTransaction(), vector[1])
+            # Some of these transactions are invalid for other reasons than
+            # their scripts, see CheckRegularTransaction()
+            outpoints = [(i.prevout.hash, i.prevout.n) for i in tx.vin]
+            if (not tx.vin or not tx.vout or
+                    len(set(outpoints)) != len(outpoints) or
+                    (0, 0xffffffff) in outpoints or
+                    any(not 0 <= o.nValue <= MAX_MONEY for o in tx.vout) or
+                    sum(o.nValue for o in tx.vout) > MAX_MONEY):
+                continue
+            self.assertNotEqual(self.check_tx_vector(vector),
+                                (None, ScriptError.OK), vector)
+
+    def test_script_num(self):
+        for value in [0, 1, -1, 127, -127, 128, -128, 255, -255, 256,
+                      0x7fffffff, -0x7fffffff]:
+            self.assertEqual(_decode_num(bn2vch(value), True), value)
+        # Negative zero and padded encodings are only allowed if minimal
+        # encoding is not required
+        for vch, value in [(b'\x80', 0), (b'\x00', 0), (b'\x01\x00', 1),
+                           (b'\x01\x80', -1)]:
+            self.assertEqual(_decode_num(vch, False), value)
+            self.assertRaises(_ScriptNumError, _decode_num, vch, True)
+            self.assertEqual(_minimally_encode(vch), bn2vch(value))
+        self.assertRaises(_ScriptNumError, _decode_num, bytes(5), False)
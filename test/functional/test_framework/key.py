@@ -12,7 +12,8 @@ anything but tests.
 import hashlib
 import random
 
-from .address import byte_to_base58
+from . import keycache
+from .address import base58_to_byte, byte_to_base58
 
 
 def modinv(a, n):
@@ -210,6 +211,35 @@ SECP256K1_ORDER = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD036
 SECP256K1_ORDER_HALF = SECP256K1_ORDER // 2
 
 
+def _affine_to_bytes(p):
+    """Serialize an affine point tuple as the concatenation of x and y."""
+    return p[0].to_bytes(32, 'big') + p[1].to_bytes(32, 'big')
+
+
+def _affine_from_bytes(data):
+    return (int.from_bytes(data[:32], 'big'),
+            int.from_bytes(data[32:64], 'big'), 1)
+
+
+def _decompress_pubkey(data):
+    """Compute the serialized affine point of a compressed public key.
+
+    Returns an empty bytes object if data is not a valid X coordinate."""
+    x = int.from_bytes(data[1:33], 'big')
+    if not SECP256K1.is_x_coord(x):
+        return b''
+    p = SECP256K1.lift_x(x)
+    if (p[1] & 1) != (data[0] & 1):
+        p = SECP256K1.negate(p)
+    return _affine_to_bytes(p)
+
+
+def _secret_to_pubkey(secret):
+    """Compute the serialized affine public key point of a 32-byte secret."""
+    p = SECP256K1.mul([(SECP256K1_G, int.from_bytes(secret, 'big'))])
+    return _affine_to_bytes(SECP256K1.affine(p))
+
+
 class ECPubKey():
     """A secp256k1 public key"""
 
@@ -227,12 +257,10 @@ class ECPubKey():
                 self.p = p
                 self.compressed = False
         elif (len(data) == 33 and (data[0] == 0x02 or data[0] == 0x03)):
-            x = int.from_bytes(data[1:33], 'big')
-            if SECP256K1.is_x_coord(x):
-                p = SECP256K1.lift_x(x)
-                if (p[1] & 1) != (data[0] & 1):
-                    p = SECP256K1.negate(p)
-                self.p = p
+            point = keycache.derive(
+                'compressed->point', data, _decompress_pubkey)
+            if point:
+                self.p = _affine_from_bytes(point)
                 self.valid = True
                 self.compressed = True
             else:
@@ -301,7 +329,7 @@ class ECPubKey():
         u1 = z * w % SECP256K1_ORDER
         u2 = r * w % SECP256K1_ORDER
         R = SECP256K1.affine(SECP256K1.mul([(SECP256K1_G, u1), (self.p, u2)]))
-        if R is None or R[0] != r:
+        if R is None or (R[0] % SECP256K1_ORDER) != r:
             return False
         return True
 
@@ -335,12 +363,15 @@ class ECKey():
 
     def __init__(self):
         self.valid = False
+        # Randomly generated, not worth sharing with the other runs
+        self.generated = False
 
     def set(self, secret, compressed):
         """Construct a private key object with given 32-byte secret and compressed flag."""
         assert(len(secret) == 32)
         secret = int.from_bytes(secret, 'big')
         self.valid = (secret > 0 and secret < SECP256K1_ORDER)
+        self.generated = False
         if self.valid:
             self.secret = secret
             self.compressed = compressed
@@ -354,6 +385,7 @@ class ECKey():
                 32,
                 'big'),
             compressed)
+        self.generated = True
 
     def get_bytes(self):
         """Retrieve the 32-byte representation of this key."""
@@ -372,8 +404,9 @@ class ECKey():
         """Compute an ECPubKey object for this secret key."""
         assert(self.valid)
         ret = ECPubKey()
-        p = SECP256K1.mul([(SECP256K1_G, self.secret)])
-        ret.p = p
+        ret.p = _affine_from_bytes(keycache.derive(
+            'secret->point', self.get_bytes(), _secret_to_pubkey,
+            persist=not self.generated))
         ret.valid = True
         ret.compressed = self.compressed
         return ret
@@ -431,6 +464,15 @@ def bytes_to_wif(b, compressed=True):
     return byte_to_base58(b, 239)
 
 
+def wif_to_key(wif):
+    """Decode a WIF private key into an ECKey."""
+    data, _ = base58_to_byte(wif)
+    key = ECKey()
+    key.set(data[:32], len(data) == 33 and data[32] == 1)
+    assert key.is_valid
+    return key
+
+
 def generate_wif_key():
     # Makes a WIF privkey for imports
     k = ECKey()
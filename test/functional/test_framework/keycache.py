@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Content-addressed cache for deterministic key derivations.
+
+Deriving a public key from a secret, decompressing a public key or hashing a
+public key into an address only depends on the input bytes, but is expensive
+with the pure python secp256k1 implementation. The results are memoized in
+memory, the least recently used are dropped past MAX_MEMORY_ENTRIES.
+
+Once enable_disk_cache() has been called, the derivations marked persistent
+are also stored under the test cache directory so they can be shared by
+later runs and by test processes running in parallel. Only the derivations
+of keys that are the same in every run (constants, WIF strings) are marked
+so: the random keys of a test would only fill the cache directory.
+
+Each entry is stored in its own file named after the hash of its kind and
+input, and files are written atomically, so concurrent writers never need to
+coordinate: they can only ever write the same content to the same file.
+"""
+
+from collections import OrderedDict
+import hashlib
+import os
+import tempfile
+import unittest
+
+KEYCACHE_DIRNAME = "keycache"
+
+# Number of derivations kept in memory
+MAX_MEMORY_ENTRIES = 4096
+
+
+class DerivationCache():
+    """A memory cache of derivation results, optionally backed by a directory.
+    """
+
+    def __init__(self, max_entries=MAX_MEMORY_ENTRIES):
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.diskdir = None
+        self.hits = 0
+        self.misses = 0
+
+    def enable_disk_cache(self, diskdir):
+        """Share the cached derivations through the given directory."""
+        os.makedirs(diskdir, exist_ok=True)
+        self.diskdir = diskdir
+
+    def disable_disk_cache(self):
+        self.diskdir = None
+
+    def _disk_path(self, kind, data):
+        digest = hashlib.sha256(
+            kind.encode('ascii') + b'\x00' + data).hexdigest()
+        return os.path.join(self.diskdir, digest[:2], digest)
+
+    def _read_disk(self, kind, data):
+        try:
+            with open(self._disk_path(kind, data), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write_disk(self, kind, data, value):
+        path = self._disk_path(kind, data)
+        tmp_path = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            os.replace(tmp_path, path)
+        except OSError:
+            # The disk cache is an optimization only, failing to populate it
+            # (e.g. read-only or full cache dir) is not an error.
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+    def derive(self, kind, data, compute, persist=False):
+        """Return compute(data), looking it up in the cache first.
+
+        kind identifies the derivation and must be different for every
+        compute function. Both data and the value returned by compute must
+        be bytes. persist stores the result in the disk cache, if enabled,
+        it is only meant for the inputs used by every run."""
+        data = bytes(data)
+        key = (kind, data)
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        elif persist and self.diskdir is not None:
+            value = self._read_disk(kind, data)
+        if value is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            value = compute(data)
+            assert isinstance(value, bytes)
+            if persist and self.diskdir is not None:
+                self._write_disk(kind, data, value)
+        self.entries[key] = value
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        """Drop the in-memory entries and reset the statistics."""
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# Cache shared by the whole test framework (see key.py and address.py)
+DERIVATIONS = DerivationCache()
+
+
+def enable_disk_cache(cachedir):
+    """Store and look up derivations in a subdirectory of cachedir."""
+    DERIVATIONS.enable_disk_cache(os.path.join(cachedir, KEYCACHE_DIRNAME))
+
+
+def derive(kind, data, compute, persist=False):
+    return DERIVATIONS.derive(kind, data, compute, persist)
+
+
+class TestFrameworkKeyCache(unittest.TestCase):
+    def test_memory_cache(self):
+        cache = DerivationCache()
+        calls = []
+
+        def compute(data):
+            calls.append(data)
+            return data[::-1]
+
+        self.assertEqual(cache.derive('reverse', b'\x01\x02', compute),
+                         b'\x02\x01')
+        self.assertEqual(cache.derive('reverse', bytearray(b'\x01\x02'),
+                                      compute), b'\x02\x01')
+        self.assertEqual(calls, [b'\x01\x02'])
+        # Different kinds never share entries
+        self.assertEqual(cache.derive('copy', b'\x01\x02', bytes),
+                         b'\x01\x02')
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_eviction(self):
+        cache = DerivationCache(max_entries=2)
+        for data in (b'\x01', b'\x02', b'\x01', b'\x03'):
+            cache.derive('copy', data, bytes)
+        # The least recently used entry is dropped
+        self.assertEqual(list(cache.entries),
+                         [('copy', b'\x01'), ('copy', b'\x03')])
+
+    def test_disk_cache(self):
+        with tempfile.TemporaryDirectory() as diskdir:
+            writer = DerivationCache()
+            writer.enable_disk_cache(diskdir)
+            # Not persistent, e.g. a random key
+            writer.derive('copy', b'\x01\x02', bytes)
+            self.assertEqual(os.listdir(diskdir), [])
+            writer.derive('reverse', b'\x01\x02', lambda data: data[::-1],
+                          persist=True)
+
+            # A fresh cache (e.g. another test process) reuses the result
+            reader = DerivationCache()
+            reader.enable_disk_cache(diskdir)
+
+            def fail(data):
+                raise AssertionError("Derivation should have been cached")
+            self.assertEqual(reader.derive('reverse', b'\x01\x02', fail,
+                                           persist=True), b'\x02\x01')
+            self.assertEqual((reader.hits, reader.misses), (1, 0))
+
+    def test_failed_write(self):
+        with tempfile.TemporaryDirectory() as diskdir:
+            cache = DerivationCache()
+            cache.enable_disk_cache(diskdir)
+            # A directory in the way of the entry makes the rename fail
+            path = cache._disk_path('copy', b'\x01')
+            os.makedirs(os.path.join(path, 'entry'))
+            self.assertEqual(cache.derive('copy', b'\x01', bytes,
+                                          persist=True), b'\x01')
+            # The temporary file is removed
+            self.assertEqual(os.listdir(os.path.dirname(path)),
+                             [os.path.basename(path)])
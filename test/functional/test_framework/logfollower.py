@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Follow a log file as it grows and wait for messages to appear in it.
+
+A LogFollower tails a file (a node's debug.log) incrementally: it remembers
+how far it has read and only reads what was appended since. A background
+thread wakes the waiters when the file changes, using inotify on Linux and
+polling the file elsewhere.
+
+LogFollower.watch() starts watching for a set of messages from the current
+end of the file. All the messages are searched for in a single pass over
+the new lines, so the cost of waiting is linear in the amount of log
+written, whatever the number of messages and checks.
+"""
+
+import os
+import re
+import select
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+# How often the file is checked when inotify is not available
+POLL_INTERVAL = 0.05
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+
+def _inotify_watch(directory):
+    """Return an inotify file descriptor watching the changes to the files of
+    directory, or None if inotify is not available."""
+    if not sys.platform.startswith('linux'):
+        return None
+    import ctypes
+    import ctypes.util
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(directory),
+                              IN_MODIFY | IN_MOVED_TO | IN_CREATE) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class MultiMatcher():
+    """Find which of a set of strings occur in a stream of text.
+
+    All the strings still to be found are searched for at once with a single
+    regular expression. When one is found, the search resumes from where it
+    started with the remaining ones, so overlapping strings are found too."""
+
+    def __init__(self, msgs):
+        self.pending = list(dict.fromkeys(msgs))
+        self._compile()
+
+    def _compile(self):
+        self._regex = re.compile('|'.join(
+            '({})'.format(re.escape(msg)) for msg in self.pending)) \
+            if self.pending else None
+
+    def feed(self, text):
+        """Return the strings found in text, in the order they appear."""
+        found = []
+        pos = 0
+        while self._regex is not None:
+            m = self._regex.search(text, pos)
+            if m is None:
+                break
+            msg = self.pending.pop(m.lastindex - 1)
+            found.append(msg)
+            self._compile()
+            pos = m.start()
+        return found
+
+
+class LogWatch():
+    """Messages expected, or not, in the part of a log written after the
+    watch was created. See LogFollower.watch()."""
+
+    def __init__(self, follower, expected_msgs, unexpected_msgs):
+        self.follower = follower
+        self.expected = set(expected_msgs)
+        self.unexpected_msgs = set(unexpected_msgs)
+        self.unexpected = None
+        self._matcher = MultiMatcher(
+            list(unexpected_msgs) + list(expected_msgs))
+        # Follow the changes before reading, none can be missed
+        follower.start()
+        self._offset = follower.size()
+        self._partial = b''
+        self._chunks = []
+
+    @property
+    def log(self):
+        """What was written to the log since the watch was created"""
+        return ''.join(self._chunks) + self._partial.decode(
+            'utf-8', errors='replace')
+
+    def _scan(self, final=False):
+        data, self._offset = self.follower.read(self._offset)
+        data = self._partial + data
+        # Messages are matched within whole lines, the last line is kept
+        # until it is complete
+        end = data.rfind(b'\n') + 1
+        self._partial = data[end:]
+        text = data[:end].decode('utf-8', errors='replace')
+        self._chunks.append(text)
+        if final:
+            # Last chance, also look into the incomplete line. It is scanned
+            # again once complete, in case a message spans the end.
+            text += self._partial.decode('utf-8', errors='replace')
+        for msg in self._matcher.feed(text):
+            if msg in self.unexpected_msgs:
+                if self.unexpected is None:
+                    self.unexpected = msg
+            else:
+                self.expected.discard(msg)
+
+    def wait(self, timeout):
+        """Wait until all the expected messages were written to the log, for
+        at most timeout seconds. Return whether they were, stopping as soon
+        as an unexpected message is found."""
+        time_end = time.time() + timeout
+        while True:
+            generation = self.follower.generation
+            remaining = time_end - time.time()
+            self._scan(final=remaining <= 0)
+            if self.unexpected is not None:
+                return False
+            if not self.expected:
+                return True
+            if remaining <= 0:
+                return False
+            self.follower.wait_for_change(generation, remaining)
+
+
+class LogFollower():
+    """Follow a log file, see the module documentation."""
+
+    def __init__(self, path):
+        self.path = path
+        self.generation = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stop = None
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def read(self, offset):
+        """Return what was appended to the file since offset, and the offset
+        of its end. A file that shrank since offset was truncated or
+        recreated, it is read from the start."""
+        try:
+            with open(self.path, 'rb') as f:
+                end = f.seek(0, os.SEEK_END)
+                if end < offset:
+                    offset = 0
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return b'', 0
+        return data, offset + len(data)
+
+    def watch(self, expected_msgs, unexpected_msgs=()):
+        return LogWatch(self, expected_msgs, unexpected_msgs)
+
+    def wait_for_change(self, generation, timeout):
+        """Wait for the file to change after generation was read, for at
+        most timeout seconds."""
+        self.start()
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self.generation != generation, timeout)
+
+    def _notify(self):
+        with self._cond:
+            self.generation += 1
+            self._cond.notify_all()
+
+    def start(self):
+        """Start the background thread following the changes of the file."""
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stop = threading.Event()
+            fd = _inotify_watch(os.path.dirname(os.path.abspath(self.path)))
+            if fd is None:
+                target, args = self._poll, ()
+            else:
+                target, args = self._follow_inotify, (fd,)
+            self._thread = threading.Thread(
+                target=target, args=args, daemon=True,
+                name='LogFollower({})'.format(self.path))
+            self._thread.start()
+
+    def close(self):
+        """Stop the background thread, it is restarted on demand."""
+        with self._cond:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+            self._stop.set()
+        thread.join()
+
+    def _follow_inotify(self, fd):
+        try:
+            while not self._stop.is_set():
+                # Time out to check for the stop event
+                readable, _, _ = select.select([fd], [], [], 0.1)
+                if readable:
+                    # Any change in the directory wakes the waiters up, they
+                    # check whether the file did grow
+                    while True:
+                        try:
+                            if not os.read(fd, 4096):
+                                break
+                        except BlockingIOError:
+                            break
+                    self._notify()
+        finally:
+            os.close(fd)
+
+    def _poll(self):
+        last = None
+        while not self._stop.wait(POLL_INTERVAL):
+            try:
+                st = os.stat(self.path)
+                current = (st.st_size, st.st_mtime_ns, st.st_ino)
+            except FileNotFoundError:
+                current = None
+            if current != last:
+                last = current
+                self._notify()
+
+
+class TestFrameworkLogFollower(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.join(self.dir.name, 'debug.log')
+        self.follower = LogFollower(self.path)
+        self.addCleanup(self.follower.close)
+        self.write('old message\n')
+
+    def write(self, text):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(text)
+
+    def test_matcher(self):
+        matcher = MultiMatcher(['abc', 'bcd', 'c', 'x'])
+        self.assertEqual(matcher.feed('..abcd..'), ['abc', 'bcd', 'c'])
+        self.assertEqual(matcher.feed('..abcd..'), [])
+        self.assertEqual(matcher.pending, ['x'])
+
+    def test_watch(self):
+        watch = self.follower.watch(['first', 'second'], ['old'])
+        self.write('first message\nsec')
+        # Messages are only matched in complete lines
+        self.assertFalse(watch.wait(0.1))
+        self.assertEqual(watch.expected, {'second'})
+        self.write('ond message\n')
+        self.assertTrue(watch.wait(0))
+        self.assertEqual(watch.log, 'first message\nsecond message\n')
+        # The messages before the watch was created are ignored
+        self.assertIsNone(watch.unexpected)
+
+        watch = self.follower.watch(['never'], ['oops'])
+        self.write('oops\n')
+        self.assertFalse(watch.wait(60))
+        self.assertEqual(watch.unexpected, 'oops')
+
+    def test_wake_up(self):
+        watch = self.follower.watch(['done'])
+
+        def write_later():
+            time.sleep(0.2)
+            self.write('done\n')
+        threading.Thread(target=write_later).start()
+        start = time.time()
+        self.assertTrue(watch.wait(10))
+        self.assertLess(time.time() - start, 2)
+
+    def test_truncated(self):
+        watch = self.follower.watch(['new'])
+        os.remove(self.path)
+        self.write('new\n')
+        self.assertTrue(watch.wait(1))
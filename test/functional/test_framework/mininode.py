@@ -152,6 +152,8 @@ class P2PConnection(asyncio.Protocol):
             self.dstaddr, self.dstport))
 
         loop = NetworkThread.network_event_loop
+        assert loop, "The network thread is only started for the tests " \
+            "importing test_framework.mininode before setup"
         conn_gen_unsafe = loop.create_connection(
             lambda: self, host=self.dstaddr, port=self.dstport)
 
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Cache for the RPCs whose results cannot change.
+
+TestNode.enable_rpc_cache() routes the calls to these RPCs through an
+RPCCache, which keeps their results in a LRU cache:
+
+- results that only depend on their arguments, e.g. a raw block by hash or a
+  raw transaction by txid, are kept until evicted.
+- results that depend on the active chain are checked against the tip of the
+  node before being served: getblockhash by height, and the verbose forms of
+  getblock, getblockheader and getrawtransaction, whose number of
+  confirmations grows with the chain. They are kept as long as the chain is
+  only extended, and dropped when the node reorgs to another chain.
+- the results keyed by a height at least reorg_safety_margin blocks below the
+  last tip seen are served without checking the tip, so looking up a deep
+  block by height costs no round trip. The tests using the cache must not
+  reorg deeper than that.
+
+The results are shared between the calls hitting the same entry, they must
+not be modified.
+
+Blocks and transactions can become unavailable (pruning, a transaction
+leaving the mempool), which the cache does not notice: the RPCs of a node
+whose test expects these errors should not be cached.
+"""
+
+from collections import Counter, OrderedDict
+import json
+import unittest
+
+# Maximum number of results kept by a cache
+DEFAULT_MAX_ENTRIES = 10000
+# Depth below the tip from which the heights are assumed not to be reorged
+DEFAULT_REORG_SAFETY_MARGIN = 100
+
+# The result only depends on the arguments
+IMMUTABLE = 'immutable'
+# The result is keyed by height, it changes when the chain is reorged
+HEIGHT = 'height'
+# The result is keyed by hash, but has fields that depend on the tip
+TIP = 'tip'
+
+# The named parameters of the cacheable RPCs, with their default value
+CACHEABLE_RPCS = {
+    'getblock': (('blockhash', None), ('verbosity', 1)),
+    'getblockhash': (('height', None),),
+    'getblockheader': (('blockhash', None), ('verbose', True)),
+    'getblockstats': (('hash_or_height', None), ('stats', None)),
+    'getrawtransaction': (('txid', None), ('verbose', False),
+                          ('blockhash', None)),
+}
+
+
+def _bind(method, args, kwargs):
+    """Return the dict of the values of all the parameters of a call."""
+    params = CACHEABLE_RPCS[method]
+    if len(args) > len(params):
+        raise TypeError('Too many arguments for {}'.format(method))
+    bound = {name: default for name, default in params}
+    for (name, _), value in zip(params, args):
+        bound[name] = value
+    for name, value in kwargs.items():
+        if name not in bound:
+            raise TypeError(
+                'Unknown parameter {} for {}'.format(name, method))
+        bound[name] = value
+    return bound
+
+
+def _classify(method, params):
+    """Return how the result of a call can be cached."""
+    if method == 'getblock':
+        return IMMUTABLE if params['verbosity'] in (0, False) else TIP
+    if method == 'getblockheader':
+        return TIP if params['verbose'] else IMMUTABLE
+    if method == 'getrawtransaction':
+        return TIP if params['verbose'] else IMMUTABLE
+    if method == 'getblockstats':
+        return HEIGHT if isinstance(params['hash_or_height'], int) \
+            else IMMUTABLE
+    return HEIGHT
+
+
+class RPCCache():
+    """LRU cache of the results of the cacheable RPCs of a node.
+
+    call(method, *args, **kwargs) does the actual RPC. Only the RPCs in
+    methods (by default all the CACHEABLE_RPCS) are cached. The hits and
+    misses are counted per RPC, report() summarizes them."""
+
+    def __init__(self, call, max_entries=DEFAULT_MAX_ENTRIES, methods=None,
+                 reorg_safety_margin=DEFAULT_REORG_SAFETY_MARGIN):
+        self._call = call
+        self.max_entries = max_entries
+        self.reorg_safety_margin = reorg_safety_margin
+        self.methods = set(CACHEABLE_RPCS if methods is None else methods)
+        assert self.methods <= set(CACHEABLE_RPCS), \
+            'Not cacheable: {}'.format(self.methods - set(CACHEABLE_RPCS))
+        # (method, params) -> (kind, result, tip height when fetched)
+        self._entries = OrderedDict()
+        self._tip = None
+        self._tip_height = None
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def clear(self):
+        self._entries.clear()
+        self._tip = None
+        self._tip_height = None
+
+    def _check_tip(self):
+        """Follow the tip of the node, dropping the entries that depend on
+        the chain when it is not an extension of the previous one. Return
+        whether the tip changed."""
+        info = self._call('getblockchaininfo')
+        tip, height = info['bestblockhash'], info['blocks']
+        if tip == self._tip:
+            return False
+        if self._tip is not None and not (
+                height >= self._tip_height and
+                self._call('getblockhash', self._tip_height) == self._tip):
+            for key in [key for key, (kind, _, _) in self._entries.items()
+                        if kind != IMMUTABLE]:
+                del self._entries[key]
+        self._tip = tip
+        self._tip_height = height
+        return True
+
+    def _is_deep(self, method, params):
+        """Whether the call is keyed by a height deep enough in the chain to
+        be served without checking the tip."""
+        height = params['height'] if method == 'getblockhash' else \
+            params.get('hash_or_height')
+        return isinstance(height, int) and self._tip_height is not None and \
+            height <= self._tip_height - self.reorg_safety_margin
+
+    def _lookup(self, key, kind):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        _, result, height = entry
+        if kind == TIP and height != self._tip_height:
+            if 'height' in result and 'nextblockhash' not in result and \
+                    result['confirmations'] > 0:
+                # The block was the tip, it has a successor now
+                return None
+            if result.get('confirmations', 0) > 0:
+                result = dict(result)
+                result['confirmations'] += self._tip_height - height
+            entry = (kind, result, self._tip_height)
+            self._entries[key] = entry
+        self._entries.move_to_end(key)
+        return entry
+
+    def call(self, method, *args, **kwargs):
+        if method not in self.methods:
+            return self._call(method, *args, **kwargs)
+        params = _bind(method, args, kwargs)
+        kind = _classify(method, params)
+        key = (method, json.dumps(params, sort_keys=True, default=str))
+        if kind != IMMUTABLE and not (
+                kind == HEIGHT and self._is_deep(method, params)):
+            self._check_tip()
+        entry = self._lookup(key, kind)
+        if entry is not None:
+            self.hits[method] += 1
+            return entry[1]
+
+        self.misses[method] += 1
+        result = self._call(method, *args, **kwargs)
+        tip_height = self._tip_height
+        if kind == TIP:
+            if 'height' in result and result['confirmations'] > 0:
+                # The chain may have moved during the call, the result tells
+                # the tip it was computed at
+                tip_height = result['height'] + result['confirmations'] - 1
+            elif 'blockhash' not in result:
+                # An unconfirmed transaction
+                return result
+            elif self._check_tip():
+                # A transaction, the confirmations may be older or newer
+                # than the tip
+                return result
+        self._entries[key] = (kind, result, tip_height)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return result
+
+    def hit_rate(self, method=None):
+        """Fraction of the calls to method, or to all the cached RPCs, that
+        were served by the cache."""
+        if method is None:
+            hits = sum(self.hits.values())
+            total = hits + sum(self.misses.values())
+        else:
+            hits = self.hits[method]
+            total = hits + self.misses[method]
+        return hits / total if total else 0.0
+
+    def report(self):
+        return ', '.join('{} {}/{} ({:.0%})'.format(
+            method, self.hits[method], self.hits[method] + self.misses[method],
+            self.hit_rate(method))
+            for method in sorted(set(self.hits) | set(self.misses)))
+
+
+class TestFrameworkRPCCache(unittest.TestCase):
+    class FakeNode():
+        """Chain of blocks named by their height and branch"""
+
+        def __init__(self):
+            self.chain = ['b0']
+            self.calls = Counter()
+
+        def __call__(self, method, *args, **kwargs):
+            self.calls[method] += 1
+            if method == 'getblockchaininfo':
+                return {'bestblockhash': self.chain[-1],
+                        'blocks': len(self.chain) - 1}
+            if method == 'getblockhash':
+                return self.chain[args[0]]
+            height = self.chain.index(args[0])
+            if method == 'getblockheader' and len(args) < 2:
+                header = {'hash': args[0], 'height': height,
+                          'confirmations': len(self.chain) - height}
+                if height + 1 < len(self.chain):
+                    header['nextblockhash'] = self.chain[height + 1]
+                return header
+            return 'raw' + args[0]
+
+    def setUp(self):
+        self.node = self.FakeNode()
+        self.cache = RPCCache(self.node)
+
+    def test_immutable(self):
+        for _ in range(3):
+            self.assertEqual(self.cache.call('getblock', 'b0', 0), 'rawb0')
+        self.assertEqual(
+            self.cache.call('getblock', blockhash='b0', verbosity=0), 'rawb0')
+        self.assertEqual(self.node.calls['getblock'], 1)
+        # No need to check the tip
+        self.assertEqual(self.node.calls['getblockchaininfo'], 0)
+        self.assertEqual(self.cache.hit_rate(), 0.75)
+        self.assertEqual(self.cache.report(), 'getblock 3/4 (75%)')
+
+    def test_chain(self):
+        self.node.chain += ['b1', 'b2']
+        self.assertEqual(self.cache.call('getblockhash', 1), 'b1')
+        header = self.cache.call('getblockheader', 'b1')
+        tip = self.cache.call('getblockheader', 'b2')
+        self.assertEqual(header['confirmations'], 2)
+
+        # The chain is extended, the entries are updated
+        self.node.chain += ['b3']
+        self.assertEqual(self.cache.call('getblockhash', 1), 'b1')
+        self.assertEqual(
+            self.cache.call('getblockheader', 'b1')['confirmations'], 3)
+        self.assertEqual(header['confirmations'], 2)
+        self.assertEqual(self.cache.hits['getblockheader'], 1)
+        # The previous tip has a successor now
+        tip = self.cache.call('getblockheader', 'b2')
+        self.assertEqual(tip['nextblockhash'], 'b3')
+        self.assertEqual(self.cache.misses['getblockheader'], 3)
+
+        # Reorg
+        self.node.chain[1:] = ['c1', 'c2', 'c3', 'c4']
+        self.assertEqual(self.cache.call('getblockhash', 1), 'c1')
+        self.assertEqual(self.cache.misses['getblockhash'], 2)
+
+    def test_deep_heights(self):
+        self.cache.reorg_safety_margin = 10
+        self.node.chain += ['b{}'.format(h) for h in range(1, 20)]
+        self.assertEqual(self.cache.call('getblockhash', 5), 'b5')
+        self.assertEqual(self.cache.call('getblockhash', 15), 'b15')
+        self.assertEqual(self.node.calls['getblockchaininfo'], 2)
+        # Deep enough, the tip is not checked
+        self.node.calls.clear()
+        self.assertEqual(self.cache.call('getblockhash', 5), 'b5')
+        self.assertEqual(self.cache.call('getblockhash', 9), 'b9')
+        self.assertEqual(self.node.calls, {'getblockhash': 1})
+        # Close to the tip, it is
+        self.node.calls.clear()
+        self.assertEqual(self.cache.call('getblockhash', 15), 'b15')
+        self.assertEqual(self.node.calls, {'getblockchaininfo': 1})
+
+    def test_lru(self):
+        self.cache.max_entries = 2
+        for block in ('b0', 'b0', 'b1', 'b0', 'b2', 'b0', 'b1'):
+            if block not in self.node.chain:
+                self.node.chain.append(block)
+            self.cache.call('getblock', block, 0)
+        # b1 was evicted by b2, b0 was kept as the most recently used
+        self.assertEqual(self.cache.hits['getblock'], 3)
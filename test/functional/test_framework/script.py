@@ -7,23 +7,41 @@
 This file is modified from python-bitcoinlib.
 """
 
+import functools
 import hashlib
+import json
+import os
 import struct
+import time
 import unittest
 from typing import List, Dict
 
 from .messages import (
+    COutPoint,
     CTransaction,
+    CTxIn,
     CTxOut,
+    FromHex,
     hash256,
+    ser_compact_size,
     ser_string,
-    ser_uint256,
     sha256,
-    uint256_from_str,
 )
 
 
 MAX_SCRIPT_ELEMENT_SIZE = 520
+MAX_OPS_PER_SCRIPT = 201
+MAX_PUBKEYS_PER_MULTISIG = 20
+MAX_SCRIPT_SIZE = 10000
+MAX_STACK_SIZE = 1000
+# Data files shared with the C++ unit tests
+UNIT_TEST_DATA_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    "..", "..", "..", "src", "test", "data")
+# Environment variable enabling the benchmarks of the unit tests, and the
+# number of inputs of the transaction hashed by the sighash benchmark
+BENCHMARK_ENV = "TEST_FRAMEWORK_BENCHMARK"
+BENCHMARK_SIGHASH_INPUTS = 2000
 OPCODE_NAMES: Dict["CScriptOp", str] = {}
 
 
@@ -375,6 +393,7 @@ OPCODE_NAMES.update({
     OP_CHECKMULTISIGVERIFY: 'OP_CHECKMULTISIGVERIFY',
     OP_CHECKDATASIG: 'OP_CHECKDATASIG',
     OP_CHECKDATASIGVERIFY: 'OP_CHECKDATASIGVERIFY',
+    OP_REVERSEBYTES: 'OP_REVERSEBYTES',
     OP_NOP1: 'OP_NOP1',
     OP_CHECKLOCKTIMEVERIFY: 'OP_CHECKLOCKTIMEVERIFY',
     OP_CHECKSEQUENCEVERIFY: 'OP_CHECKSEQUENCEVERIFY',
@@ -505,60 +524,17 @@ class CScript(bytes):
         Yields tuples of (opcode, data, sop_idx) so that the different possible
         PUSHDATA encodings can be accurately distinguished, as well as
         determining the exact opcode byte indexes. (sop_idx)
-        """
-        i = 0
-        while i < len(self):
-            sop_idx = i
-            opcode = self[i]
-            i += 1
 
-            if opcode > OP_PUSHDATA4:
+        The script is only parsed once, see compile_script().
+        """
+        compiled = compile_script(self)
+        for (opcode, sop_idx, data_idx, data_end) in compiled.ops:
+            if data_idx is None:
                 yield (opcode, None, sop_idx)
             else:
-                datasize = None
-                pushdata_type = None
-                if opcode < OP_PUSHDATA1:
-                    pushdata_type = 'PUSHDATA({})'.format(opcode)
-                    datasize = opcode
-
-                elif opcode == OP_PUSHDATA1:
-                    pushdata_type = 'PUSHDATA1'
-                    if i >= len(self):
-                        raise CScriptInvalidError(
-                            'PUSHDATA1: missing data length')
-                    datasize = self[i]
-                    i += 1
-
-                elif opcode == OP_PUSHDATA2:
-                    pushdata_type = 'PUSHDATA2'
-                    if i + 1 >= len(self):
-                        raise CScriptInvalidError(
-                            'PUSHDATA2: missing data length')
-                    datasize = self[i] + (self[i + 1] << 8)
-                    i += 2
-
-                elif opcode == OP_PUSHDATA4:
-                    pushdata_type = 'PUSHDATA4'
-                    if i + 3 >= len(self):
-                        raise CScriptInvalidError(
-                            'PUSHDATA4: missing data length')
-                    datasize = self[i] + (self[i + 1] << 8) + \
-                        (self[i + 2] << 16) + (self[i + 3] << 24)
-                    i += 4
-
-                else:
-                    assert False  # shouldn't happen
-
-                data = bytes(self[i:i + datasize])
-
-                # Check for truncation
-                if len(data) < datasize:
-                    raise CScriptTruncatedPushDataError(
-                        '{}: truncated data'.format(pushdata_type), data)
-
-                i += datasize
-
-                yield (opcode, data, sop_idx)
+                yield (opcode, self[data_idx:data_end], sop_idx)
+        if compiled.error is not None:
+            compiled.raise_error()
 
     def __iter__(self):
         """'Cooked' iteration
@@ -614,18 +590,147 @@ class CScript(bytes):
 
         Note that this is consensus-critical.
         """
-        n = 0
+        return GetSigOpCount(self, fAccurate)
+
+    def IsPushOnly(self):
+        """Return True if the script only pushes data (up to OP_16)."""
+        compiled = compile_script(self)
+        return compiled.error is None and compiled.push_only
+
+
+class CompiledScript:
+    """The result of parsing a serialized script once, see compile_script().
+
+    ops is a tuple of (opcode, sop_idx, data_idx, data_end) for every opcode
+    that could be parsed; data_idx and data_end delimit the pushed data and
+    are None for non-push opcodes. If the script is truncated, error holds the
+    (exception class, message, data) to raise after iterating over ops.
+    """
+    __slots__ = ("ops", "error", "sigops", "accurate_sigops", "push_only")
+
+    def __init__(self, ops, error):
+        self.ops = ops
+        self.error = error
+
+        # Precompute the sigop counts, with and without fAccurate
+        self.sigops = 0
+        self.accurate_sigops = 0
+        self.push_only = True
         lastOpcode = OP_INVALIDOPCODE
-        for (opcode, data, sop_idx) in self.raw_iter():
+        for (opcode, _, _, _) in ops:
             if opcode in (OP_CHECKSIG, OP_CHECKSIGVERIFY):
-                n += 1
+                self.sigops += 1
+                self.accurate_sigops += 1
             elif opcode in (OP_CHECKMULTISIG, OP_CHECKMULTISIGVERIFY):
-                if fAccurate and (OP_1 <= lastOpcode <= OP_16):
-                    n += opcode.decode_op_n()
+                self.sigops += 20
+                if OP_1 <= lastOpcode <= OP_16:
+                    self.accurate_sigops += lastOpcode - OP_1 + 1
                 else:
-                    n += 20
+                    self.accurate_sigops += 20
+            if opcode > OP_16:
+                self.push_only = False
             lastOpcode = opcode
-        return n
+
+    def raise_error(self):
+        exc_class, msg, data = self.error
+        if exc_class is CScriptTruncatedPushDataError:
+            raise CScriptTruncatedPushDataError(msg, data)
+        raise exc_class(msg)
+
+
+# Number of parsed scripts kept by compile_script(), and the size of the
+# largest script cached: the large ones, e.g. padded with data, are parsed
+# each time rather than kept in memory
+SCRIPT_CACHE_SIZE = 1 << 12
+SCRIPT_CACHE_MAX_SCRIPT_SIZE = 1 << 10
+
+
+def compile_script(script):
+    """Parse a serialized script (bytes or CScript) into a CompiledScript.
+
+    The result is cached, keyed by the script bytes, so iterating over a
+    script, counting its sigops or running FindAndDelete() on it repeatedly
+    only parses it once. Scripts larger than SCRIPT_CACHE_MAX_SCRIPT_SIZE
+    are not cached.
+    """
+    if isinstance(script, bytearray):
+        script = bytes(script)
+    if len(script) > SCRIPT_CACHE_MAX_SCRIPT_SIZE:
+        return _compile_script.__wrapped__(script)
+    return _compile_script(script)
+
+
+@functools.lru_cache(maxsize=SCRIPT_CACHE_SIZE)
+def _compile_script(script):
+    ops = []
+    error = None
+    i = 0
+    while i < len(script):
+        sop_idx = i
+        opcode = script[i]
+        i += 1
+
+        if opcode > OP_PUSHDATA4:
+            ops.append((opcode, sop_idx, None, None))
+            continue
+
+        datasize = None
+        pushdata_type = None
+        if opcode < OP_PUSHDATA1:
+            pushdata_type = 'PUSHDATA({})'.format(opcode)
+            datasize = opcode
+
+        elif opcode == OP_PUSHDATA1:
+            pushdata_type = 'PUSHDATA1'
+            if i >= len(script):
+                error = (CScriptInvalidError,
+                         'PUSHDATA1: missing data length', None)
+                break
+            datasize = script[i]
+            i += 1
+
+        elif opcode == OP_PUSHDATA2:
+            pushdata_type = 'PUSHDATA2'
+            if i + 1 >= len(script):
+                error = (CScriptInvalidError,
+                         'PUSHDATA2: missing data length', None)
+                break
+            datasize = script[i] + (script[i + 1] << 8)
+            i += 2
+
+        elif opcode == OP_PUSHDATA4:
+            pushdata_type = 'PUSHDATA4'
+            if i + 3 >= len(script):
+                error = (CScriptInvalidError,
+                         'PUSHDATA4: missing data length', None)
+                break
+            datasize = script[i] + (script[i + 1] << 8) + \
+                (script[i + 2] << 16) + (script[i + 3] << 24)
+            i += 4
+
+        # Check for truncation
+        if i + datasize > len(script):
+            error = (CScriptTruncatedPushDataError,
+                     '{}: truncated data'.format(pushdata_type),
+                     bytes(script[i:]))
+            break
+
+        ops.append((opcode, sop_idx, i, i + datasize))
+        i += datasize
+
+    return CompiledScript(tuple(ops), error)
+
+
+def GetSigOpCount(script, fAccurate):
+    """Get the SigOp count of a serialized script (bytes or CScript).
+
+    See CScript.GetSigOpCount(). The count is looked up from the cached
+    CompiledScript, so counting the sigops of a block again is cheap.
+    """
+    compiled = compile_script(script)
+    if compiled.error is not None:
+        compiled.raise_error()
+    return compiled.accurate_sigops if fAccurate else compiled.sigops
 
 
 SIGHASH_ALL = 1
@@ -634,124 +739,247 @@ SIGHASH_SINGLE = 3
 SIGHASH_FORKID = 0x40
 SIGHASH_ANYONECANPAY = 0x80
 
+# Script verification flags, see src/script/script_flags.h
+SCRIPT_VERIFY_NONE = 0
+SCRIPT_VERIFY_P2SH = (1 << 0)
+SCRIPT_VERIFY_STRICTENC = (1 << 1)
+SCRIPT_VERIFY_DERSIG = (1 << 2)
+SCRIPT_VERIFY_LOW_S = (1 << 3)
+SCRIPT_VERIFY_SIGPUSHONLY = (1 << 5)
+SCRIPT_VERIFY_MINIMALDATA = (1 << 6)
+SCRIPT_VERIFY_DISCOURAGE_UPGRADABLE_NOPS = (1 << 7)
+SCRIPT_VERIFY_CLEANSTACK = (1 << 8)
+SCRIPT_VERIFY_CHECKLOCKTIMEVERIFY = (1 << 9)
+SCRIPT_VERIFY_CHECKSEQUENCEVERIFY = (1 << 10)
+SCRIPT_VERIFY_MINIMALIF = (1 << 13)
+SCRIPT_VERIFY_NULLFAIL = (1 << 14)
+SCRIPT_ENABLE_SIGHASH_FORKID = (1 << 16)
+SCRIPT_ENABLE_REPLAY_PROTECTION = (1 << 17)
+SCRIPT_VERIFY_CHECKDATASIG_SIGOPS = (1 << 18)
+SCRIPT_DISALLOW_SEGWIT_RECOVERY = (1 << 20)
+SCRIPT_ENABLE_SCHNORR_MULTISIG = (1 << 21)
+SCRIPT_VERIFY_INPUT_SIGCHECKS = (1 << 22)
+SCRIPT_ENFORCE_SIGCHECKS = (1 << 23)
+
+# See src/policy/policy.h
+MANDATORY_SCRIPT_VERIFY_FLAGS = (
+    SCRIPT_VERIFY_P2SH | SCRIPT_VERIFY_STRICTENC |
+    SCRIPT_ENABLE_SIGHASH_FORKID | SCRIPT_VERIFY_LOW_S |
+    SCRIPT_VERIFY_NULLFAIL | SCRIPT_VERIFY_MINIMALDATA |
+    SCRIPT_ENABLE_SCHNORR_MULTISIG | SCRIPT_ENFORCE_SIGCHECKS)
+STANDARD_SCRIPT_VERIFY_FLAGS = (
+    MANDATORY_SCRIPT_VERIFY_FLAGS | SCRIPT_VERIFY_DERSIG |
+    SCRIPT_VERIFY_SIGPUSHONLY | SCRIPT_VERIFY_MINIMALDATA |
+    SCRIPT_VERIFY_DISCOURAGE_UPGRADABLE_NOPS | SCRIPT_VERIFY_CLEANSTACK |
+    SCRIPT_VERIFY_CHECKLOCKTIMEVERIFY | SCRIPT_VERIFY_CHECKSEQUENCEVERIFY |
+    SCRIPT_VERIFY_CHECKDATASIG_SIGOPS | SCRIPT_DISALLOW_SEGWIT_RECOVERY |
+    SCRIPT_VERIFY_INPUT_SIGCHECKS)
+
+ZERO_HASH = bytes(32)
+
 
 def FindAndDelete(script, sig):
     """Consensus critical, see FindAndDelete() in Satoshi codebase"""
-    r = b''
+    if sig not in script:
+        # Nothing to delete, save parsing the script
+        return CScript(script)
+    chunks = []
     last_sop_idx = sop_idx = 0
     skip = True
     for (opcode, data, sop_idx) in script.raw_iter():
         if not skip:
-            r += script[last_sop_idx:sop_idx]
+            chunks.append(script[last_sop_idx:sop_idx])
         last_sop_idx = sop_idx
         if script[sop_idx:sop_idx + len(sig)] == sig:
             skip = True
         else:
             skip = False
     if not skip:
-        r += script[last_sop_idx:]
-    return CScript(r)
+        chunks.append(script[last_sop_idx:])
+    return CScript(b''.join(chunks))
 
 
-def SignatureHash(script, txTo, inIdx, hashtype):
+class PrecomputedTransactionData:
+    """Serializations and hashes shared by the signature hashes of all inputs.
+
+    Mirrors PrecomputedTransactionData in src/script/interpreter.h. The hashes
+    of the prevouts, sequences and outputs of txTo are computed the first
+    time an input needs them and reused for every other input, so signing an
+    N-input transaction costs O(N) rather than O(N^2). The serialized inputs
+    and outputs used by the legacy SignatureHash are cached the same way.
+
+    txTo must not be modified, apart from its scriptSigs, while this object is
+    in use.
+    """
+    __slots__ = ("txTo", "_hashPrevouts", "_hashSequence", "_hashOutputs",
+                 "_prevouts", "_outputs", "_blankedInputs")
+
+    def __init__(self, txTo):
+        self.txTo = txTo
+        self._hashPrevouts = None
+        self._hashSequence = None
+        self._hashOutputs = None
+        self._prevouts = None
+        self._outputs = None
+        self._blankedInputs = {}
+
+    @property
+    def prevouts(self):
+        """The serialized outpoints of all the inputs."""
+        if self._prevouts is None:
+            self._prevouts = [i.prevout.serialize() for i in self.txTo.vin]
+        return self._prevouts
+
+    @property
+    def outputs(self):
+        """The serialized outputs, without the leading vector size."""
+        if self._outputs is None:
+            self._outputs = b''.join(o.serialize() for o in self.txTo.vout)
+        return self._outputs
+
+    def blanked_inputs(self, blank_sequences):
+        """The serialized inputs, with empty scriptSigs.
+
+        If blank_sequences is True, all the nSequence are set to 0. Every
+        input takes exactly BLANKED_TXIN_SIZE bytes, so the result is a
+        memoryview which can be sliced without copying."""
+        blanked = self._blankedInputs.get(blank_sequences)
+        if blanked is None:
+            blanked = memoryview(b''.join(
+                prevout + b'\x00' + struct.pack(
+                    "<I", 0 if blank_sequences else txin.nSequence)
+                for prevout, txin in zip(self.prevouts, self.txTo.vin)))
+            self._blankedInputs[blank_sequences] = blanked
+        return blanked
+
+    @property
+    def hashPrevouts(self):
+        if self._hashPrevouts is None:
+            self._hashPrevouts = hash256(b''.join(self.prevouts))
+        return self._hashPrevouts
+
+    @property
+    def hashSequence(self):
+        if self._hashSequence is None:
+            self._hashSequence = hash256(
+                b''.join(struct.pack("<I", i.nSequence) for i in self.txTo.vin))
+        return self._hashSequence
+
+    @property
+    def hashOutputs(self):
+        if self._hashOutputs is None:
+            self._hashOutputs = hash256(self.outputs)
+        return self._hashOutputs
+
+
+# Outpoint, empty scriptSig and nSequence
+BLANKED_TXIN_SIZE = 32 + 4 + 1 + 4
+# CTxOut(-1), as serialized for SIGHASH_SINGLE
+NULL_TXOUT = struct.pack("<q", -1) + b'\x00'
+
+
+def SignatureHash(script, txTo, inIdx, hashtype, txdata=None):
     """Consensus-correct SignatureHash
 
     Returns (hash, err) to precisely match the consensus-critical behavior of
     the SIGHASH_SINGLE bug. (inIdx is *not* checked for validity)
+
+    The modified transaction is never built: its serialization is streamed
+    into the hash, reusing the parts shared by all the inputs from txdata, an
+    optional PrecomputedTransactionData for txTo.
     """
     HASH_ONE = b'\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
 
     if inIdx >= len(txTo.vin):
         return (HASH_ONE, "inIdx {} out of range ({})".format(
             inIdx, len(txTo.vin)))
-    txtmp = CTransaction(txTo)
-
-    for txin in txtmp.vin:
-        txin.scriptSig = b''
-    txtmp.vin[inIdx].scriptSig = FindAndDelete(
-        script, CScript([OP_CODESEPARATOR]))
-
-    if (hashtype & 0x1f) == SIGHASH_NONE:
-        txtmp.vout = []
-
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
 
-    elif (hashtype & 0x1f) == SIGHASH_SINGLE:
-        outIdx = inIdx
-        if outIdx >= len(txtmp.vout):
-            return (HASH_ONE, "outIdx {} out of range ({})".format(
-                outIdx, len(txtmp.vout)))
+    basetype = hashtype & 0x1f
+    if basetype == SIGHASH_SINGLE and inIdx >= len(txTo.vout):
+        return (HASH_ONE, "outIdx {} out of range ({})".format(
+            inIdx, len(txTo.vout)))
 
-        tmp = txtmp.vout[outIdx]
-        txtmp.vout = []
-        for i in range(outIdx):
-            txtmp.vout.append(CTxOut(-1))
-        txtmp.vout.append(tmp)
+    if txdata is None:
+        txdata = PrecomputedTransactionData(txTo)
+    assert txdata.txTo is txTo
 
-        for i in range(len(txtmp.vin)):
-            if i != inIdx:
-                txtmp.vin[i].nSequence = 0
+    txin = txTo.vin[inIdx]
+    signed_input = b''.join([
+        txdata.prevouts[inIdx],
+        ser_string(FindAndDelete(script, CScript([OP_CODESEPARATOR]))),
+        struct.pack("<I", txin.nSequence),
+    ])
 
+    ss = hashlib.sha256(struct.pack("<i", txTo.nVersion))
     if hashtype & SIGHASH_ANYONECANPAY:
-        tmp = txtmp.vin[inIdx]
-        txtmp.vin = []
-        txtmp.vin.append(tmp)
-
-    s = txtmp.serialize()
-    s += struct.pack(b"<I", hashtype)
-
-    hash = hash256(s)
-
-    return (hash, None)
-
-# TODO: Allow cached hashPrevouts/hashSequence/hashOutputs to be provided.
-# Performance optimization probably not necessary for python tests, however.
-
-
-def SignatureHashForkId(script, txTo, inIdx, hashtype, amount):
+        ss.update(ser_compact_size(1))
+        ss.update(signed_input)
+    else:
+        # All the other inputs have their scriptSig (and nSequence for
+        # SIGHASH_NONE and SIGHASH_SINGLE) blanked out.
+        blanked = txdata.blanked_inputs(
+            basetype in (SIGHASH_NONE, SIGHASH_SINGLE))
+        ss.update(ser_compact_size(len(txTo.vin)))
+        ss.update(blanked[:inIdx * BLANKED_TXIN_SIZE])
+        ss.update(signed_input)
+        ss.update(blanked[(inIdx + 1) * BLANKED_TXIN_SIZE:])
+
+    if basetype == SIGHASH_NONE:
+        ss.update(ser_compact_size(0))
+    elif basetype == SIGHASH_SINGLE:
+        ss.update(ser_compact_size(inIdx + 1))
+        ss.update(NULL_TXOUT * inIdx)
+        ss.update(txTo.vout[inIdx].serialize())
+    else:
+        ss.update(ser_compact_size(len(txTo.vout)))
+        ss.update(txdata.outputs)
+
+    ss.update(struct.pack("<I", txTo.nLockTime))
+    ss.update(struct.pack("<I", hashtype))
+
+    return (hashlib.sha256(ss.digest()).digest(), None)
+
+
+def SignatureHashForkId(script, txTo, inIdx, hashtype, amount, txdata=None):
+    """BIP143 style signature hash, as used with SIGHASH_FORKID.
+
+    txdata is an optional PrecomputedTransactionData for txTo, to be shared
+    between the calls for all the inputs of the transaction.
+    """
+    if txdata is None:
+        txdata = PrecomputedTransactionData(txTo)
+    assert txdata.txTo is txTo
 
-    hashPrevouts = 0
-    hashSequence = 0
-    hashOutputs = 0
+    hashPrevouts = ZERO_HASH
+    hashSequence = ZERO_HASH
+    hashOutputs = ZERO_HASH
+    basetype = hashtype & 0x1f
 
     if not (hashtype & SIGHASH_ANYONECANPAY):
-        serialize_prevouts = bytes()
-        for i in txTo.vin:
-            serialize_prevouts += i.prevout.serialize()
-        hashPrevouts = uint256_from_str(hash256(serialize_prevouts))
-
-    if (not (hashtype & SIGHASH_ANYONECANPAY) and (hashtype & 0x1f)
-            != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_sequence = bytes()
-        for i in txTo.vin:
-            serialize_sequence += struct.pack("<I", i.nSequence)
-        hashSequence = uint256_from_str(hash256(serialize_sequence))
-
-    if ((hashtype & 0x1f) != SIGHASH_SINGLE and (
-            hashtype & 0x1f) != SIGHASH_NONE):
-        serialize_outputs = bytes()
-        for o in txTo.vout:
-            serialize_outputs += o.serialize()
-        hashOutputs = uint256_from_str(hash256(serialize_outputs))
-    elif ((hashtype & 0x1f) == SIGHASH_SINGLE and inIdx < len(txTo.vout)):
-        serialize_outputs = txTo.vout[inIdx].serialize()
-        hashOutputs = uint256_from_str(hash256(serialize_outputs))
-
-    ss = bytes()
-    ss += struct.pack("<i", txTo.nVersion)
-    ss += ser_uint256(hashPrevouts)
-    ss += ser_uint256(hashSequence)
-    ss += txTo.vin[inIdx].prevout.serialize()
-    ss += ser_string(script)
-    ss += struct.pack("<q", amount)
-    ss += struct.pack("<I", txTo.vin[inIdx].nSequence)
-    ss += ser_uint256(hashOutputs)
-    ss += struct.pack("<i", txTo.nLockTime)
-    ss += struct.pack("<I", hashtype)
-
-    return hash256(ss)
+        hashPrevouts = txdata.hashPrevouts
+
+    if (not (hashtype & SIGHASH_ANYONECANPAY) and basetype != SIGHASH_SINGLE
+            and basetype != SIGHASH_NONE):
+        hashSequence = txdata.hashSequence
+
+    if basetype != SIGHASH_SINGLE and basetype != SIGHASH_NONE:
+        hashOutputs = txdata.hashOutputs
+    elif basetype == SIGHASH_SINGLE and inIdx < len(txTo.vout):
+        hashOutputs = hash256(txTo.vout[inIdx].serialize())
+
+    txin = txTo.vin[inIdx]
+    return hash256(b''.join([
+        struct.pack("<i", txTo.nVersion),
+        hashPrevouts,
+        hashSequence,
+        txin.prevout.serialize(),
+        ser_string(script),
+        struct.pack("<q", amount),
+        struct.pack("<I", txin.nSequence),
+        hashOutputs,
+        struct.pack("<I", txTo.nLockTime),
+        struct.pack("<I", hashtype),
+    ]))
 
 
 class TestFrameworkScript(unittest.TestCase):
@@ -790,3 +1018,114 @@ class TestFrameworkScript(unittest.TestCase):
             self.assertEqual(
                 CScriptNum.decode(CScriptNum.encode(CScriptNum(value))),
                 value)
+
+    def test_sighash_legacy(self):
+        with open(os.path.join(UNIT_TEST_DATA_DIR, "sighash.json"),
+                  encoding="utf-8") as f:
+            vectors = json.load(f)[1:]
+        for (raw_tx, raw_script, nIn, hashtype, _, sighash_no_forkid,
+             _) in vectors:
+            tx = FromHex(CTransaction(), raw_tx)
+            txdata = PrecomputedTransactionData(tx)
+            script = CScript(bytes.fromhex(raw_script))
+            hashtype &= 0xffffffff
+            for i in range(len(tx.vin)):
+                # Also hash the other inputs, to exercise the shared txdata
+                sighash, err = SignatureHash(script, tx, i, hashtype, txdata)
+                if i == nIn:
+                    self.assertIsNone(err)
+                    self.assertEqual(sighash[::-1].hex(), sighash_no_forkid)
+
+    def test_sighash_forkid(self):
+        with open(os.path.join(UNIT_TEST_DATA_DIR, "sighash.json"),
+                  encoding="utf-8") as f:
+            vectors = json.load(f)[1:]
+        for (raw_tx, raw_script, nIn, hashtype, sighash_regular,
+             _, _) in vectors:
+            hashtype &= 0xffffffff
+            if not hashtype & SIGHASH_FORKID:
+                continue
+            tx = FromHex(CTransaction(), raw_tx)
+            script = CScript(bytes.fromhex(raw_script))
+            self.assertEqual(
+                SignatureHashForkId(script, tx, nIn, hashtype, 0)[::-1].hex(),
+                sighash_regular)
+
+    def test_sighash_forkid_precomputed(self):
+        tx = CTransaction()
+        for i in range(20):
+            tx.vin.append(CTxIn(COutPoint(i, i), b'', i))
+            tx.vout.append(CTxOut(i, CScript([OP_TRUE] * i)))
+        script = CScript([OP_DUP, OP_HASH160, bytes(20), OP_EQUALVERIFY,
+                          OP_CHECKSIG])
+        txdata = PrecomputedTransactionData(tx)
+        for hashtype in (SIGHASH_ALL, SIGHASH_NONE, SIGHASH_SINGLE):
+            for anyonecanpay in (0, SIGHASH_ANYONECANPAY):
+                fullhashtype = hashtype | anyonecanpay | SIGHASH_FORKID
+                for i in range(len(tx.vin)):
+                    self.assertEqual(
+                        SignatureHashForkId(
+                            script, tx, i, fullhashtype, 1000, txdata),
+                        SignatureHashForkId(
+                            script, tx, i, fullhashtype, 1000))
+
+    @unittest.skipUnless(os.getenv(BENCHMARK_ENV),
+                         'set {}=1 to run the benchmarks'.format(BENCHMARK_ENV))
+    def test_sighash_forkid_benchmark(self):
+        # Hashing all the inputs of a large transaction, without then with
+        # the hashes shared by the inputs computed once
+        tx = CTransaction()
+        for i in range(BENCHMARK_SIGHASH_INPUTS):
+            tx.vin.append(CTxIn(COutPoint(i, 0), b'', 0xffffffff))
+        tx.vout.append(CTxOut(1000, CScript([OP_TRUE])))
+        script = CScript([OP_DUP, OP_HASH160, bytes(20), OP_EQUALVERIFY,
+                          OP_CHECKSIG])
+        hashtype = SIGHASH_ALL | SIGHASH_FORKID
+
+        def bench(txdata_factory):
+            start = time.perf_counter()
+            txdata = txdata_factory()
+            hashes = [SignatureHashForkId(script, tx, i, hashtype, 1000,
+                                          txdata)
+                      for i in range(len(tx.vin))]
+            return time.perf_counter() - start, hashes
+
+        naive, naive_hashes = bench(lambda: None)
+        precomputed, precomputed_hashes = bench(
+            lambda: PrecomputedTransactionData(tx))
+        print('\nSignatureHashForkId of {} inputs: {:.3f}s, {:.3f}s with '
+              'PrecomputedTransactionData'.format(
+                  len(tx.vin), naive, precomputed))
+        self.assertEqual(naive_hashes, precomputed_hashes)
+        self.assertLess(precomputed * 10, naive)
+
+    def test_compiled_script(self):
+        script = CScript([OP_2, b'\x01' * 33, b'\x02' * 33, OP_2,
+                          OP_CHECKMULTISIG, OP_CHECKSIG, b'\x03' * 0x100])
+        self.assertEqual(
+            [(op, data) for (op, data, _) in script.raw_iter()],
+            [(OP_2, None), (33, b'\x01' * 33), (33, b'\x02' * 33),
+             (OP_2, None), (OP_CHECKMULTISIG, None), (OP_CHECKSIG, None),
+             (OP_PUSHDATA2, b'\x03' * 0x100)])
+        self.assertEqual(script.GetSigOpCount(False), 21)
+        self.assertEqual(script.GetSigOpCount(True), 3)
+        # Plain bytes share the cached parse
+        self.assertEqual(GetSigOpCount(bytes(script), True), 3)
+        self.assertEqual(GetSigOpCount(bytearray(script), True), 3)
+        self.assertFalse(script.IsPushOnly())
+        self.assertTrue(CScript([OP_0, b'\x01' * 75, OP_16]).IsPushOnly())
+
+        # The large scripts are parsed, but not kept
+        large = CScript([OP_RETURN] + [b'\x04' * 0x200] * 2)
+        misses = _compile_script.cache_info().misses
+        self.assertEqual(list(large), [OP_RETURN] + [b'\x04' * 0x200] * 2)
+        self.assertEqual(_compile_script.cache_info().misses, misses)
+
+        truncated = CScript(b'\x51\x4c\x05\x01\x02')
+        self.assertEqual(next(truncated.raw_iter()), (OP_1, None, 0))
+        with self.assertRaises(CScriptTruncatedPushDataError) as cm:
+            list(truncated.raw_iter())
+        self.assertEqual(cm.exception.data, b'\x01\x02')
+        with self.assertRaises(CScriptInvalidError):
+            list(CScript(b'\x4d\x01'))
+        self.assertFalse(truncated.IsPushOnly())
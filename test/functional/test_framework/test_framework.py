@@ -9,7 +9,6 @@ import configparser
 from enum import Enum
 import logging
 import os
-import pdb
 import random
 import shutil
 import sys
@@ -17,10 +16,15 @@ import tempfile
 import time
 from typing import Optional
 
+from .chainfixture import binary_digest
+from .datadir import DatadirCloner
 from .authproxy import JSONRPCException
-from . import coverage
-from .test_node import TestNode
-from .mininode import NetworkThread
+from . import coverage, keycache
+from .test_node import (
+    TestNode,
+    wait_for_rpc_connections,
+    wait_until_stopped,
+)
 from .util import (
     assert_equal,
     check_json_precision,
@@ -29,6 +33,7 @@ from .util import (
     get_datadir_path,
     initialize_datadir,
     MAX_NODES,
+    mempools_diff,
     p2p_port,
     PortSeed,
     rpc_port,
@@ -50,6 +55,9 @@ TIMESTAMP_IN_THE_PAST = 1575158400
 
 TMPDIR_PREFIX = "bitcoin_func_test_"
 
+# First polling interval of sync_blocks and sync_mempools, in seconds
+SYNC_POLL_MIN_INTERVAL = 0.05
+
 
 class SkipTest(Exception):
     """This exception is raised to skip a test"""
@@ -101,11 +109,22 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         """Sets test framework defaults. Do not override this method. Instead, override the set_test_params() method"""
         self.chain = 'regtest'
         self.setup_clean_chain = False
+        # The chain the nodes start with instead of the default cached
+        # chain, see chainfixture.py
+        self.chain_fixture = None
         self.nodes = []
         self.network_thread = None
         # Wait for up to 60 seconds for the RPC server to respond
         self.rpc_timeout = 60
         self.supports_cli = True
+        # Whether the test can run on the nodes of test_runner.py --warmpool,
+        # see warmpool.py
+        self.supports_warm_pool = False
+        self._warm_pool_lease = None
+        self._warm_pool_tried = False
+        # The cache whose chain is copied to the datadirs once the nodes are
+        # not leased from the warm pool, see _provision_datadirs()
+        self._deferred_cache_dir = None
         self.bind_to_localhost_only = True
         # We run parse_args before set_test_params for tests who need to
         # know the parser options during setup.
@@ -164,6 +183,8 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
                             help="The seed to use for assigning port numbers (default: current process id)")
         parser.add_argument("--coveragedir", dest="coveragedir",
                             help="Write tested RPC commands into this directory")
+        parser.add_argument("--rpcprofiledir", dest="rpcprofiledir",
+                            help="Write the number of calls, latencies and sizes of the RPC commands into this directory")
         parser.add_argument("--configfile", dest="configfile", default=os.path.abspath(os.path.dirname(os.path.realpath(
             __file__)) + "/../../config.ini"), help="Location of the test framework config file (default: %(default)s)")
         parser.add_argument("--pdbonfailure", dest="pdbonfailure", default=False, action="store_true",
@@ -192,10 +213,14 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
     def setup(self):
         """Call this method to start up the test framework object with options set."""
         PortSeed.n = self.options.port_seed
+        if self.options.rpcprofiledir is not None:
+            coverage.enable_profiling(self.options.rpcprofiledir)
 
         check_json_precision()
 
         self.options.cachedir = os.path.abspath(self.options.cachedir)
+        # Share deterministic key and address derivations across test runs
+        keycache.enable_disk_cache(self.options.cachedir)
 
         config = configparser.ConfigParser()
         config.read_file(open(self.options.configfile, encoding='utf-8'))
@@ -243,9 +268,13 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         random.seed(seed)
         self.log.debug("PRNG seed is: {}".format(seed))
 
-        self.log.debug('Setting up network thread')
-        self.network_thread = NetworkThread()
-        self.network_thread.start()
+        # Only the tests importing the P2P code can connect to the nodes, the
+        # others do not pay for asyncio and the network thread
+        if 'test_framework.mininode' in sys.modules:
+            from .mininode import NetworkThread
+            self.log.debug('Setting up network thread')
+            self.network_thread = NetworkThread()
+            self.network_thread.start()
 
         if self.options.usecli:
             if not self.supports_cli:
@@ -262,13 +291,21 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         """Call this method to shut down the test framework object."""
         if self.success == TestStatus.FAILED and self.options.pdbonfailure:
             print("Testcase failed. Attaching python debugger. Enter ? for help")
+            import pdb
             pdb.set_trace()
 
-        self.log.debug('Closing down network thread')
-        self.network_thread.close()
+        if self.network_thread is not None:
+            self.log.debug('Closing down network thread')
+            self.network_thread.close()
+        for node in self.nodes:
+            if node.rpc_cache is not None:
+                self.log.info("RPC cache hits for node {}: {}".format(
+                    node.index, node.rpc_cache.report()))
         if not self.options.noshutdown:
             self.log.info("Stopping nodes")
-            if self.nodes:
+            if self._warm_pool_lease is not None:
+                self._release_warm_nodes()
+            elif self.nodes:
                 self.stop_nodes()
         else:
             for node in self.nodes:
@@ -348,7 +385,9 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
     def setup_chain(self):
         """Override this method to customize blockchain setup"""
         self.log.info("Initializing test directory " + self.options.tmpdir)
-        if self.setup_clean_chain:
+        if self.chain_fixture is not None:
+            self._initialize_chain_fixture()
+        elif self.setup_clean_chain:
             self._initialize_chain_clean()
         else:
             self._initialize_chain()
@@ -383,8 +422,10 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         self.start_nodes()
         self.import_deterministic_coinbase_privkeys()
         if not self.setup_clean_chain:
+            height = 199 if self.chain_fixture is None \
+                else self.chain_fixture.length
             for n in self.nodes:
-                assert_equal(n.getblockchaininfo()["blocks"], 199)
+                assert_equal(n.getblockchaininfo()["blocks"], height)
             # To ensure that all nodes are out of IBD, the most recent block
             # must have a timestamp not too old (see IsInitialBlockDownload()).
             self.log.debug('Generate a block with current time')
@@ -393,7 +434,7 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
             for n in self.nodes:
                 n.submitblock(block)
                 chain_info = n.getblockchaininfo()
-                assert_equal(chain_info["blocks"], 200)
+                assert_equal(chain_info["blocks"], height + 1)
                 assert_equal(chain_info["initialblockdownload"], False)
 
     def import_deterministic_coinbase_privkeys(self):
@@ -460,6 +501,7 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
     def start_node(self, i, *args, **kwargs):
         """Start a bitcoind"""
 
+        self._copy_deferred_chain()
         node = self.nodes[i]
 
         node.start(*args, **kwargs)
@@ -475,10 +517,11 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
             extra_args = [None] * self.num_nodes
         assert_equal(len(extra_args), self.num_nodes)
         try:
-            for i, node in enumerate(self.nodes):
-                node.start(extra_args[i], *args, **kwargs)
-            for node in self.nodes:
-                node.wait_for_rpc_connection()
+            if args or kwargs or not self._lease_warm_nodes(extra_args):
+                self._copy_deferred_chain()
+                for i, node in enumerate(self.nodes):
+                    node.start(extra_args[i], *args, **kwargs)
+            wait_for_rpc_connections(self.nodes)
         except BaseException:
             # If one node failed to start, stop the others
             self.stop_nodes()
@@ -489,6 +532,59 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
                 coverage.write_all_rpc_commands(
                     self.options.coveragedir, node.rpc)
 
+    def _may_lease_warm_nodes(self):
+        """Return whether the nodes may be leased from the warm pool, when
+        they are started the first time."""
+        if not self.supports_warm_pool or self._warm_pool_tried:
+            return False
+        from .warmpool import WARM_POOL_ENV
+        # The pool nodes run on the standard cache until the test is over
+        return os.environ.get(WARM_POOL_ENV) is not None and \
+            self.chain == 'regtest' and not self.setup_clean_chain and \
+            self.chain_fixture is None and not self.options.noshutdown and \
+            not self.options.perf
+
+    def _lease_warm_nodes(self, extra_args):
+        """Adopt the nodes started in advance by test_runner.py --warmpool
+        instead of starting the nodes, see warmpool.py. Only tried the first
+        time the nodes are started. Returns whether they were leased."""
+        from .warmpool import WARM_POOL_ENV, lease_nodes, node_key
+
+        if not self._may_lease_warm_nodes():
+            return False
+        self._warm_pool_tried = True
+        socket_path = os.environ[WARM_POOL_ENV]
+        lease = lease_nodes(socket_path, [
+            node_key(node, args) for node, args in zip(self.nodes, extra_args)],
+            self.options.tmpdir)
+        if lease is None:
+            self.log.debug("No matching nodes in the warm pool")
+            return False
+        for node, info in zip(self.nodes, lease.nodes):
+            node.adopt(lease, info)
+        self._warm_pool_lease = lease
+        # The leased nodes come with their chain
+        self._deferred_cache_dir = None
+        self.log.debug("Leased {} nodes from the warm pool".format(
+            len(lease.nodes)))
+        return True
+
+    def _release_warm_nodes(self):
+        """Give the nodes back to the warm pool, which stops them in the
+        background. Their datadir is kept if the test failed."""
+        lease, self._warm_pool_lease = self._warm_pool_lease, None
+        for node in self.nodes:
+            if node.running and \
+                    node.process is lease.processes.get(node.index):
+                node.detach()
+        # The nodes restarted by the test run on the leased datadirs
+        self.stop_nodes()
+        keep = self.success == TestStatus.FAILED or self.options.nocleanup
+        for info in lease.nodes:
+            lease.release(info['index'], get_datadir_path(
+                self.options.tmpdir, info['index']) if keep else None)
+        lease.close()
+
     def stop_node(self, i, expected_stderr='', wait=0):
         """Stop a bitcoind test node"""
         self.nodes[i].stop_node(expected_stderr, wait=wait)
@@ -499,9 +595,8 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
             # Issue RPC to stop nodes
             node.stop_node(wait=wait, wait_until_stopped=False)
 
-        for node in self.nodes:
-            # Wait for nodes to stop
-            node.wait_until_stopped()
+        # Wait for nodes to stop
+        wait_until_stopped(self.nodes)
 
     def restart_node(self, i, extra_args=None):
         """Stop and start a test node"""
@@ -533,17 +628,49 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         sync_blocks needs to be called with an rpc_connections set that has least
         one node already synced to the latest, stable tip, otherwise there's a
         chance it might return before all nodes are stably synced.
+
+        The nodes behind the highest tip are long-polled until they reach its
+        height, for at most wait seconds at a time. Otherwise, e.g. while the
+        nodes are on competing tips of the same height, the tips are polled
+        with a backoff from SYNC_POLL_MIN_INTERVAL to wait seconds.
         """
+        # asyncio is only loaded by the tests syncing nodes
+        from .asyncrpc import gather
+
         rpc_connections = nodes or self.nodes
         timeout = int(timeout * self.options.timeout_factor)
         stop_time = time.time() + timeout
+        delay = min(SYNC_POLL_MIN_INTERVAL, wait)
+        long_poll = True
         while time.time() <= stop_time:
-            best_hash = [x.getbestblockhash() for x in rpc_connections]
+            tips = gather(*[x.arpc.getbestblockhash() for x in rpc_connections],
+                          *[x.arpc.getblockcount() for x in rpc_connections])
+            best_hash = tips[:len(rpc_connections)]
+            heights = tips[len(rpc_connections):]
             if best_hash.count(best_hash[0]) == len(rpc_connections):
                 return
             # Check that each peer has at least one connection
-            assert (all([len(x.getpeerinfo()) for x in rpc_connections]))
-            time.sleep(wait)
+            assert (all([len(peers) for peers in gather(
+                *[x.arpc.getpeerinfo() for x in rpc_connections])]))
+            remaining = stop_time - time.time()
+            height = max(heights)
+            lagging = [x for x, h in zip(rpc_connections, heights)
+                       if h < height]
+            if long_poll and lagging and remaining > 0:
+                # Returns as soon as the node reached the height, a zero
+                # timeout would wait forever
+                wait_ms = max(1, int(1000 * min(wait, remaining)))
+                try:
+                    gather(*[x.arpc.waitforblockheight(height, wait_ms)
+                             for x in lagging])
+                    continue
+                except JSONRPCException as e:
+                    if e.error['code'] != -32601:
+                        raise
+                    # Method not found, fall back to polling
+                    long_poll = False
+            time.sleep(max(0, min(delay, remaining)))
+            delay = min(2 * delay, wait)
         raise AssertionError("Block sync timed out after {}s:{}".format(
             timeout,
             "".join("\n  {!r}".format(b) for b in best_hash),
@@ -554,23 +681,40 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
         """
         Wait until everybody has the same transactions in their memory
         pools
+
+        The mempools are polled with a backoff from SYNC_POLL_MIN_INTERVAL to
+        wait seconds. Only their size is polled until it matches on all the
+        nodes, then the txids are compared.
         """
+        from .asyncrpc import gather
+
         rpc_connections = nodes or self.nodes
         timeout = int(timeout * self.options.timeout_factor)
         stop_time = time.time() + timeout
+        delay = min(SYNC_POLL_MIN_INTERVAL, wait)
         while time.time() <= stop_time:
-            pool = [set(r.getrawmempool()) for r in rpc_connections]
-            if pool.count(pool[0]) == len(rpc_connections):
-                if flush_scheduler:
-                    for r in rpc_connections:
-                        r.syncwithvalidationinterfacequeue()
-                return
+            sizes = [(info['size'], info['bytes']) for info in gather(
+                *[r.arpc.getmempoolinfo() for r in rpc_connections])]
+            if sizes.count(sizes[0]) == len(rpc_connections):
+                txids = gather(
+                    *[r.arpc.getrawmempool() for r in rpc_connections])
+                pool = set(txids[0])
+                if all(set(t) == pool for t in txids[1:]):
+                    if flush_scheduler:
+                        for r in rpc_connections:
+                            r.syncwithvalidationinterfacequeue()
+                    return
             # Check that each peer has at least one connection
-            assert (all([len(x.getpeerinfo()) for x in rpc_connections]))
-            time.sleep(wait)
+            assert (all([len(peers) for peers in gather(
+                *[r.arpc.getpeerinfo() for r in rpc_connections])]))
+            time.sleep(max(0, min(delay, stop_time - time.time())))
+            delay = min(2 * delay, wait)
+        pools = [set(txids) for txids in gather(
+            *[r.arpc.getrawmempool() for r in rpc_connections])]
         raise AssertionError("Mempool sync timed out after {}s:{}".format(
             timeout,
-            "".join("\n  {!r}".format(m) for m in pool),
+            "".join("\n  {}".format(line) for line in mempools_diff(
+                ['node{}'.format(r.index) for r in rpc_connections], pools)),
         ))
 
     def sync_all(self, nodes=None):
@@ -614,6 +758,91 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
             rpc_handler.setLevel(logging.DEBUG)
             rpc_logger.addHandler(rpc_handler)
 
+    def _add_cache_node(self, dirname, extra_args):
+        """Add a node mining a chain to cache in dirname."""
+        CACHE_NODE_ID = 0
+        initialize_datadir(dirname, CACHE_NODE_ID, self.chain)
+        self.nodes.append(
+            TestNode(
+                CACHE_NODE_ID,
+                get_datadir_path(dirname, CACHE_NODE_ID),
+                chain=self.chain,
+                extra_conf=["bind=127.0.0.1"],
+                extra_args=extra_args,
+                host=None,
+                rpc_port=rpc_port(CACHE_NODE_ID),
+                p2p_port=p2p_port(CACHE_NODE_ID),
+                timewait=self.rpc_timeout,
+                timeout_factor=self.options.timeout_factor,
+                bitcoind=self.options.bitcoind,
+                bitcoin_cli=self.options.bitcoincli,
+                coverage_dir=None,
+                cwd=self.options.tmpdir,
+                emulator=self.options.emulator,
+            ))
+
+        if self.options.axionactivation:
+            self.nodes[CACHE_NODE_ID].extend_default_args(
+                ["-axionactivationtime={}".format(TIMESTAMP_IN_THE_PAST)])
+
+        self.start_node(CACHE_NODE_ID)
+        return self.nodes[CACHE_NODE_ID]
+
+    def _stop_cache_node(self):
+        """Stop the cache node and only keep the chain in its datadir."""
+        cache_node_dir = self.nodes[0].datadir
+        self.stop_nodes()
+        self.nodes = []
+
+        def cache_path(*paths):
+            return os.path.join(cache_node_dir, self.chain, *paths)
+
+        # Remove empty wallets dir
+        os.rmdir(cache_path('wallets'))
+        for entry in os.listdir(cache_path()):
+            # Only keep chainstate and blocks folder
+            if entry not in ['chainstate', 'blocks']:
+                os.remove(cache_path(entry))
+
+    def _provision_datadirs(self, cache_node_dir):
+        """Copy the cached chain in cache_node_dir to all the nodes. If they
+        may be leased from the warm pool, only their bitcoin.conf is written
+        and the chain is copied when they are started, unless leased."""
+        if self._may_lease_warm_nodes():
+            for i in range(self.num_nodes):
+                initialize_datadir(self.options.tmpdir, i, self.chain)
+            self._deferred_cache_dir = cache_node_dir
+            return
+        cloner = DatadirCloner()
+        start = time.time()
+        for i in range(self.num_nodes):
+            self.log.debug(
+                "Copy cache directory {} to node {}".format(
+                    cache_node_dir, i))
+            to_dir = get_datadir_path(self.options.tmpdir, i)
+            cloner.clone(cache_node_dir, to_dir)
+            # Overwrite port/rpcport in bitcoin.conf
+            initialize_datadir(self.options.tmpdir, i, self.chain)
+        self.log.debug(
+            "Provisioned {} datadirs from the cache in {:.3f}s ({})".format(
+                self.num_nodes, time.time() - start, cloner.report()))
+
+    def _copy_deferred_chain(self):
+        """Copy the chain deferred by _provision_datadirs() to the datadirs
+        of the nodes, which were not leased."""
+        cache_node_dir, self._deferred_cache_dir = \
+            self._deferred_cache_dir, None
+        if cache_node_dir is None:
+            return
+        cloner = DatadirCloner()
+        for i in range(self.num_nodes):
+            cloner.clone(
+                os.path.join(cache_node_dir, self.chain),
+                os.path.join(get_datadir_path(self.options.tmpdir, i),
+                             self.chain))
+        self.log.debug("Copied the cached chain to {} datadirs ({})".format(
+            self.num_nodes, cloner.report()))
+
     def _initialize_chain(self):
         """Initialize a pre-mined blockchain for use by the test.
 
@@ -629,38 +858,8 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
             self.log.debug(
                 "Creating cache directory {}".format(cache_node_dir))
 
-            initialize_datadir(
-                self.options.cachedir,
-                CACHE_NODE_ID,
-                self.chain)
-            self.nodes.append(
-                TestNode(
-                    CACHE_NODE_ID,
-                    cache_node_dir,
-                    chain=self.chain,
-                    extra_conf=["bind=127.0.0.1"],
-                    extra_args=['-disablewallet'],
-                    host=None,
-                    rpc_port=rpc_port(CACHE_NODE_ID),
-                    p2p_port=p2p_port(CACHE_NODE_ID),
-                    timewait=self.rpc_timeout,
-                    timeout_factor=self.options.timeout_factor,
-                    bitcoind=self.options.bitcoind,
-                    bitcoin_cli=self.options.bitcoincli,
-                    coverage_dir=None,
-                    cwd=self.options.tmpdir,
-                    emulator=self.options.emulator,
-                ))
-
-            if self.options.axionactivation:
-                self.nodes[CACHE_NODE_ID].extend_default_args(
-                    ["-axionactivationtime={}".format(TIMESTAMP_IN_THE_PAST)])
-
-            self.start_node(CACHE_NODE_ID)
-            cache_node = self.nodes[CACHE_NODE_ID]
-
-            # Wait for RPC connections to be ready
-            cache_node.wait_for_rpc_connection()
+            cache_node = self._add_cache_node(
+                self.options.cachedir, ['-disablewallet'])
 
             # Set a time in the past, so that blocks don't end up in the future
             cache_node.setmocktime(
@@ -682,27 +881,48 @@ class BitcoinTestFramework(metaclass=BitcoinTestMetaClass):
             assert_equal(cache_node.getblockchaininfo()["blocks"], 199)
 
             # Shut it down, and clean up cache directories:
-            self.stop_nodes()
-            self.nodes = []
+            self._stop_cache_node()
 
-            def cache_path(*paths):
-                return os.path.join(cache_node_dir, self.chain, *paths)
+        self._provision_datadirs(cache_node_dir)
 
-            # Remove empty wallets dir
-            os.rmdir(cache_path('wallets'))
-            for entry in os.listdir(cache_path()):
-                # Only keep chainstate and blocks folder
-                if entry not in ['chainstate', 'blocks']:
-                    os.remove(cache_path(entry))
+    def _initialize_chain_fixture(self):
+        """Initialize the chain of self.chain_fixture for use by the test.
 
-        for i in range(self.num_nodes):
-            self.log.debug(
-                "Copy cache directory {} to node {}".format(
-                    cache_node_dir, i))
-            to_dir = get_datadir_path(self.options.tmpdir, i)
-            shutil.copytree(cache_node_dir, to_dir)
-            # Overwrite port/rpcport in bitcoin.conf
-            initialize_datadir(self.options.tmpdir, i, self.chain)
+        Mine the chain into the cache directory if it is not cached yet,
+        then create num_nodes copies from the cache."""
+        fixture = self.chain_fixture
+        assert self.num_nodes <= MAX_NODES
+        framework_args = []
+        if self.options.axionactivation:
+            framework_args.append('-axionactivationtime')
+        binary_hash = binary_digest(self.options.bitcoind)
+        key = fixture.key(binary_hash, framework_args)
+        fixture_dir = fixture.cache_dir(self.options.cachedir, key)
+
+        if not os.path.isdir(fixture_dir):
+            self.log.info("Mining chain fixture {} into {}".format(
+                fixture.name, fixture_dir))
+            start = time.time()
+            os.makedirs(os.path.dirname(fixture_dir), exist_ok=True)
+            generated_dir = tempfile.mkdtemp(
+                prefix='.tmp-', dir=os.path.dirname(fixture_dir))
+            try:
+                cache_node = self._add_cache_node(
+                    generated_dir, ['-disablewallet'] + fixture.extra_args)
+                fixture.generate(cache_node)
+                self._stop_cache_node()
+                fixture.save(generated_dir, fixture_dir, dict(
+                    fixture.params(), binary=binary_hash,
+                    framework_args=framework_args))
+            except BaseException:
+                self.stop_nodes()
+                self.nodes = []
+                shutil.rmtree(generated_dir, ignore_errors=True)
+                raise
+            self.log.info("Mined chain fixture {} in {:.1f}s".format(
+                fixture.name, time.time() - start))
+
+        self._provision_datadirs(get_datadir_path(fixture_dir, 0))
 
     def _initialize_chain_clean(self):
         """Initialize empty blockchain for use by the test.
@@ -13,6 +13,7 @@ import json
 import logging
 import os
 import re
+import shutil
 import subprocess
 import sys
 import tempfile
@@ -21,22 +22,26 @@ import urllib.parse
 import collections
 import shlex
 
-from .authproxy import JSONRPCException
+from .authproxy import DEFAULT_BATCH_SIZE, JSONRPCException, RPCBatch
 from .descriptors import descsum_create
-from .messages import COIN, CTransaction, FromHex
+from .logfollower import LogFollower
+from .rpccache import RPCCache
 from .util import (
     MAX_NODES,
     append_config,
     delete_cookie_file,
+    get_async_rpc_proxy,
     get_auth_cookie,
     get_rpc_proxy,
-    p2p_port,
     rpc_url,
     wait_until,
     EncodeDecimal,
 )
 
 BITCOIND_PROC_WAIT_TIMEOUT = 60
+# Polling intervals bounds while waiting for bitcoind to start
+STARTUP_POLL_MIN_INTERVAL = 0.01
+STARTUP_POLL_MAX_INTERVAL = 0.25
 
 
 class FailedToStartError(Exception):
@@ -139,6 +144,10 @@ class TestNode():
         self.process = None
         self.rpc_connected = False
         self.rpc = None
+        self.rpc_cache = None
+        self._debug_log_follower = None
+        # The RPC proxy used while waiting for the node to start
+        self._startup_rpc = None
         self.url = None
         self.relay_fee_cache = None
         self.log = logging.getLogger('TestFramework.node{}'.format(i))
@@ -216,6 +225,9 @@ class TestNode():
 
     def __getattr__(self, name):
         """Dispatches any unrecognised messages to the RPC connection or a CLI instance."""
+        if self.rpc_cache is not None and name in self.rpc_cache.methods:
+            return lambda *args, **kwargs: self.rpc_cache.call(
+                name, *args, **kwargs)
         if self.use_cli:
             return getattr(RPCOverloadWrapper(self.cli, True), name)
         else:
@@ -225,6 +237,39 @@ class TestNode():
                 "Error: No RPC connection")
             return getattr(RPCOverloadWrapper(self.rpc), name)
 
+    def enable_rpc_cache(self, **options):
+        """Cache the results of the RPCs that cannot change, see rpccache.py
+        for the arguments. The cache is kept across restarts."""
+        def call(method, *args, **kwargs):
+            return getattr(RPCOverloadWrapper(
+                self.cli if self.use_cli else self.rpc, self.use_cli),
+                method)(*args, **kwargs)
+        self.rpc_cache = RPCCache(call, **options)
+
+    def batch(self, requests=None, *, batch_size=DEFAULT_BATCH_SIZE):
+        """Without arguments, return a RPCBatch collecting calls to the node
+        (see authproxy.py):
+
+            with node.batch() as b:
+                futures = [b.getblock(h) for h in blockhashes]
+
+        Otherwise send the list of requests built with get_request() as a
+        single batch and return the responses."""
+        if requests is not None:
+            return self.__getattr__('batch')(requests)
+        return RPCBatch(self.cli if self.use_cli else self.rpc, batch_size)
+
+    @property
+    def arpc(self):
+        """An asyncio RPC proxy to the node, see asyncrpc.py.
+
+        Unlike the sync RPC connection, it is also available when the node is
+        controlled through bitcoin-cli."""
+        url = self.url or rpc_url(
+            self.datadir, self.chain, self.host, self.rpc_port)
+        return get_async_rpc_proxy(url, self.index, timeout=self.rpc_timeout,
+                                   coveragedir=self.coverage_dir)
+
     def clear_default_args(self):
         self.default_args.clear()
 
@@ -241,11 +286,19 @@ class TestNode():
             self.default_args = [def_arg for def_arg in self.default_args
                                  if rm_arg != def_arg and not def_arg.startswith(rm_arg + '=')]
 
+    def get_start_args(self, extra_args=None):
+        """The command line starting the node with extra_args, or the extra
+        args of the node if None."""
+        if extra_args is None:
+            extra_args = self.extra_args
+        p_args = [self.binary] + self.default_args + extra_args
+        if self.emulator is not None:
+            p_args = [self.emulator] + p_args
+        return p_args
+
     def start(self, extra_args=None, *, cwd=None, stdout=None,
               stderr=None, **kwargs):
         """Start the node."""
-        if extra_args is None:
-            extra_args = self.extra_args
 
         # Add a new stdout and stderr file each time bitcoind is started
         if stderr is None:
@@ -269,11 +322,8 @@ class TestNode():
         # written to stderr and not the terminal
         subp_env = dict(os.environ, LIBC_FATAL_STDERR_="1")
 
-        p_args = [self.binary] + self.default_args + extra_args
-        if self.emulator is not None:
-            p_args = [self.emulator] + p_args
         self.process = subprocess.Popen(
-            p_args,
+            self.get_start_args(extra_args),
             env=subp_env,
             stdout=stdout,
             stderr=stderr,
@@ -281,21 +331,53 @@ class TestNode():
             **kwargs)
 
         self.running = True
+        self._startup_rpc = None
         self.log.debug("bitcoind started, waiting for RPC to come up")
 
         if self.start_perf:
             self._start_perf()
 
+    def adopt(self, lease, info):
+        """Use the node leased from the warm pool instead of starting it, see
+        warmpool.py. info describes the leased node. Its datadir is linked
+        in place of the datadir of this node, and its ports replace ours."""
+        shutil.rmtree(self.datadir)
+        os.symlink(info['datadir'], self.datadir)
+        self.rpc_port = info['rpc_port']
+        self.p2p_port = info['p2p_port']
+        self.stdout = open(info['stdout'], 'rb')
+        self.stderr = open(info['stderr'], 'rb')
+        self.process = lease.processes[self.index]
+        self.running = True
+        self._startup_rpc = None
+
+    def detach(self):
+        """Forget the leased process without stopping it, the warm pool
+        stops it once the node is released, see adopt()."""
+        self.stdout.close()
+        self.stderr.close()
+        del self.p2ps[:]
+        self.running = False
+        self.process = None
+        self.rpc_connected = False
+        self.rpc = None
+
     def wait_for_rpc_connection(self):
-        """Sets up an RPC connection to the bitcoind process. Returns False if unable to connect."""
-        # Poll at a rate of four times per second
-        poll_per_s = 4
-        for _ in range(poll_per_s * self.rpc_timeout):
-            if self.process.poll() is not None:
-                raise FailedToStartError(self._node_msg(
-                    'bitcoind exited with status {} during initialization'.format(self.process.returncode)))
-            try:
-                rpc = get_rpc_proxy(
+        """Sets up an RPC connection to the bitcoind process."""
+        wait_for_rpc_connections([self])
+
+    def poll_rpc_connection(self):
+        """Check once whether the RPC server of the bitcoind process is up,
+        see wait_for_rpc_connections(). Returns True once the RPC
+        connection is set up, False if the node is not ready yet."""
+        if self.process.poll() is not None:
+            raise FailedToStartError(self._node_msg(
+                'bitcoind exited with status {} during initialization'.format(self.process.returncode)))
+        try:
+            if self._startup_rpc is None:
+                # Raises until bitcoind wrote the cookie file, which happens
+                # when its RPC server starts
+                self._startup_rpc = get_rpc_proxy(
                     rpc_url(
                         self.datadir,
                         self.chain,
@@ -307,61 +389,61 @@ class TestNode():
                     timeout=self.rpc_timeout // 2,
                     coveragedir=self.coverage_dir
                 )
-                rpc.getblockcount()
-                # If the call to getblockcount() succeeds then the RPC
-                # connection is up
-                wait_until(lambda: rpc.getmempoolinfo()['loaded'])
-                # Wait for the node to finish reindex, block import, and
-                # loading the mempool. Usually importing happens fast or
-                # even "immediate" when the node is started. However, there
-                # is no guarantee and sometimes ThreadImport might finish
-                # later. This is going to cause intermittent test failures,
-                # because generally the tests assume the node is fully
-                # ready after being started.
-                #
-                # For example, the node will reject block messages from p2p
-                # when it is still importing with the error "Unexpected
-                # block message received"
-                #
-                # The wait is done here to make tests as robust as possible
-                # and prevent racy tests and intermittent failures as much
-                # as possible. Some tests might not need this, but the
-                # overhead is trivial, and the added guarantees are worth
-                # the minimal performance cost.
-
-                self.log.debug("RPC successfully started")
-                if self.use_cli:
-                    return
-                self.rpc = rpc
-                self.rpc_connected = True
-                self.url = self.rpc.url
-                return
-            except JSONRPCException as e:  # Initialization phase
-                # -28 RPC in warmup
-                # -342 Service unavailable, RPC server started but is shutting down due to error
-                if e.error['code'] != -28 and e.error['code'] != -342:
-                    raise  # unknown JSON RPC exception
-            except ConnectionResetError:
-                # This might happen when the RPC server is in warmup, but shut down before the call to getblockcount
-                # succeeds. Try again to properly raise the FailedToStartError
+            rpc = self._startup_rpc
+            # Fails while the RPC port is not open or the RPC is in warmup.
+            # Then wait for the node to finish reindex, block import, and
+            # loading the mempool. Usually importing happens fast or
+            # even "immediate" when the node is started. However, there
+            # is no guarantee and sometimes ThreadImport might finish
+            # later. This is going to cause intermittent test failures,
+            # because generally the tests assume the node is fully
+            # ready after being started.
+            #
+            # For example, the node will reject block messages from p2p
+            # when it is still importing with the error "Unexpected
+            # block message received"
+            #
+            # The wait is done here to make tests as robust as possible
+            # and prevent racy tests and intermittent failures as much
+            # as possible. Some tests might not need this, but the
+            # overhead is trivial, and the added guarantees are worth
+            # the minimal performance cost.
+            if not rpc.getmempoolinfo()['loaded']:
+                return False
+
+            self.log.debug("RPC successfully started")
+            self._startup_rpc = None
+            if self.use_cli:
+                return True
+            self.rpc = rpc
+            self.rpc_connected = True
+            self.url = self.rpc.url
+            return True
+        except JSONRPCException as e:  # Initialization phase
+            # -28 RPC in warmup
+            # -342 Service unavailable, RPC server started but is shutting down due to error
+            if e.error['code'] != -28 and e.error['code'] != -342:
+                raise  # unknown JSON RPC exception
+        except ConnectionResetError:
+            # This might happen when the RPC server is in warmup, but shut down before the call to getblockcount
+            # succeeds. Try again to properly raise the FailedToStartError
+            pass
+        except OSError as e:
+            if e.errno == errno.ETIMEDOUT:
+                # Treat identical to ConnectionResetError
                 pass
-            except OSError as e:
-                if e.errno == errno.ETIMEDOUT:
-                    # Treat identical to ConnectionResetError
-                    pass
-                elif e.errno == errno.ECONNREFUSED:
-                    # Port not yet open?
-                    pass
-                else:
-                    # unknown OS error
-                    raise
-            except ValueError as e:
-                # cookie file not found and no rpcuser or rpcpassword;
-                # bitcoind is still starting
-                if "No RPC credentials" not in str(e):
-                    raise
-            time.sleep(1.0 / poll_per_s)
-        self._raise_assertion_error("Unable to connect to bitcoind")
+            elif e.errno == errno.ECONNREFUSED:
+                # Port not yet open?
+                pass
+            else:
+                # unknown OS error
+                raise
+        except ValueError as e:
+            # cookie file not found and no rpcuser or rpcpassword;
+            # bitcoind is still starting
+            if "No RPC credentials" not in str(e):
+                raise
+        return False
 
     def wait_for_cookie_credentials(self):
         """Ensures auth cookie credentials can be read, e.g. for testing CLI
@@ -475,38 +557,40 @@ class TestNode():
             raise AssertionError("Expected debug messages is empty")
         if unexpected_msgs is None:
             unexpected_msgs = []
-        time_end = time.time() + timeout * self.timeout_factor
-        debug_log = os.path.join(self.datadir, self.chain, 'debug.log')
-        with open(debug_log, encoding='utf-8') as dl:
-            dl.seek(0, 2)
-            prev_size = dl.tell()
+        watch = self.debug_log_follower.watch(expected_msgs, unexpected_msgs)
 
         yield
 
-        while True:
-            found = True
-            with open(debug_log, encoding='utf-8') as dl:
-                dl.seek(prev_size)
-                log = dl.read()
-            print_log = " - " + "\n - ".join(log.splitlines())
-            for unexpected_msg in unexpected_msgs:
-                if re.search(re.escape(unexpected_msg),
-                             log, flags=re.MULTILINE):
-                    self._raise_assertion_error(
-                        'Unexpected message "{}" partially matches log:\n\n{}\n\n'.format(
-                            unexpected_msg, print_log))
-            for expected_msg in expected_msgs:
-                if re.search(re.escape(expected_msg), log,
-                             flags=re.MULTILINE) is None:
-                    found = False
-            if found:
-                return
-            if time.time() >= time_end:
-                break
-            time.sleep(0.05)
-        self._raise_assertion_error(
-            'Expected messages "{}" does not partially match log:\n\n{}\n\n'.format(
-                str(expected_msgs), print_log))
+        found = watch.wait(timeout * self.timeout_factor)
+        print_log = " - " + "\n - ".join(watch.log.splitlines())
+        if watch.unexpected is not None:
+            self._raise_assertion_error(
+                'Unexpected message "{}" partially matches log:\n\n{}\n\n'.format(
+                    watch.unexpected, print_log))
+        if not found:
+            self._raise_assertion_error(
+                'Expected messages "{}" does not partially match log:\n\n{}\n\n'.format(
+                    str(expected_msgs), print_log))
+
+    def wait_for_debug_log(self, expected_msgs, timeout=60):
+        """Block until all the expected debug messages were logged after the
+        call, or until the timeout expires."""
+        if not expected_msgs:
+            raise AssertionError("Expected debug messages is empty")
+        watch = self.debug_log_follower.watch(expected_msgs)
+        if not watch.wait(timeout * self.timeout_factor):
+            self._raise_assertion_error(
+                'Expected messages "{}" were not logged within {} seconds'.format(
+                    sorted(watch.expected), timeout))
+
+    @property
+    def debug_log_follower(self):
+        """The LogFollower of the debug.log of the node, shared by the
+        checks on its content."""
+        if self._debug_log_follower is None:
+            self._debug_log_follower = LogFollower(
+                os.path.join(self.datadir, self.chain, 'debug.log'))
+        return self._debug_log_follower
 
     @contextlib.contextmanager
     def profile_with_perf(self, profile_name):
@@ -650,6 +734,7 @@ class TestNode():
         - all inputs are compressed-key p2pkh, and will be signed ecdsa or schnorr
         - all inputs currently unsigned (empty scriptSig)
         """
+        from .messages import COIN
         billable_size_estimate = tx.billable_size()
         # Add some padding for signatures / public keys
         # 107 = length of PUSH(longest_sig = 72 bytes), PUSH(pubkey = 33 bytes)
@@ -659,6 +744,7 @@ class TestNode():
         return int(self.relay_fee() / 1000 * billable_size_estimate * COIN)
 
     def calculate_fee_from_txid(self, txid):
+        from .messages import CTransaction, FromHex
         ctx = FromHex(CTransaction(), self.getrawtransaction(txid))
         return self.calculate_fee(ctx)
 
@@ -668,7 +754,7 @@ class TestNode():
         This method adds the p2p connection to the self.p2ps list and also
         returns the connection to the caller."""
         if 'dstport' not in kwargs:
-            kwargs['dstport'] = p2p_port(self.index)
+            kwargs['dstport'] = self.p2p_port
         if 'dstaddr' not in kwargs:
             kwargs['dstaddr'] = '127.0.0.1'
 
@@ -711,6 +797,36 @@ class TestNode():
         del self.p2ps[:]
 
 
+def wait_for_rpc_connections(nodes):
+    """Wait for the RPC servers of several nodes, started with start(), to
+    come up, and set up their RPC connection.
+
+    The nodes are checked together, first often as bitcoind usually starts
+    quickly, then backing off. All the nodes share the same deadline."""
+    pending = list(nodes)
+    time_end = time.time() + max(node.rpc_timeout for node in nodes)
+    delay = STARTUP_POLL_MIN_INTERVAL
+    while True:
+        pending = [node for node in pending if not node.poll_rpc_connection()]
+        if not pending:
+            return
+        remaining = time_end - time.time()
+        if remaining <= 0:
+            pending[0]._raise_assertion_error("Unable to connect to bitcoind")
+        time.sleep(min(delay, remaining))
+        delay = min(2 * delay, STARTUP_POLL_MAX_INTERVAL)
+
+
+def wait_until_stopped(nodes, timeout=BITCOIND_PROC_WAIT_TIMEOUT):
+    """Wait for several nodes to stop, with a shared deadline."""
+    if not nodes:
+        return
+    wait_until(
+        lambda: all([node.is_node_stopped() for node in nodes]),
+        timeout=timeout,
+        timeout_factor=max(node.timeout_factor for node in nodes))
+
+
 class TestNodeCLIAttr:
     def __init__(self, cli, command):
         self.cli = cli
@@ -722,6 +838,16 @@ class TestNodeCLIAttr:
     def get_request(self, *args, **kwargs):
         return lambda: self(*args, **kwargs)
 
+    def stream(self, *args, **kwargs):
+        # bitcoin-cli prints the whole result, there is nothing to gain from
+        # parsing it incrementally
+        result = self(*args, **kwargs)
+        if isinstance(result, list):
+            return iter(result)
+        if isinstance(result, dict):
+            return iter(result.items())
+        return iter([result])
+
 
 def arg_to_cli(arg):
     if isinstance(arg, bool):
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Sign large batches of transactions without the node wallet.
+
+A spend template describes how the coins of some keys are locked and how to
+spend them: P2PKHTemplate for a single key, P2SHMultisigTemplate for a m-of-n
+multisig behind P2SH, each with ECDSA or Schnorr signatures. A
+TransactionFactory signs every input of a list of transactions from the
+template of the coin it spends, and returns the serialized transactions:
+
+    template = P2PKHTemplate(key)
+    with TransactionFactory() as factory:
+        hexes = factory.sign_transactions(
+            [(tx, [(template, amount)]) for tx, amount in unsigned])
+
+The signature hashes of all the inputs of a transaction share a
+PrecomputedTransactionData, and when there is enough work the transactions
+are spread over a pool of processes. The result does not depend on the
+number of processes: the transactions come back in order and the signature
+nonces are drawn from a seed taken from the caller's random state, so a test
+run with a fixed --randomseed produces the same transactions.
+"""
+
+from io import BytesIO
+import os
+import random
+import unittest
+
+from .interpreter import check_transaction
+from .key import ECKey
+from .messages import (
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxOut,
+)
+from .script import (
+    CScript,
+    CScriptOp,
+    OP_0,
+    OP_1NEGATE,
+    OP_CHECKMULTISIG,
+    OP_CHECKSIG,
+    OP_DUP,
+    OP_EQUAL,
+    OP_EQUALVERIFY,
+    OP_HASH160,
+    PrecomputedTransactionData,
+    SIGHASH_ALL,
+    SIGHASH_FORKID,
+    STANDARD_SCRIPT_VERIFY_FLAGS,
+    SignatureHash,
+    SignatureHashForkId,
+    hash160,
+)
+
+# Below this number of signatures, starting the worker processes costs more
+# than signing serially.
+PARALLEL_SIGNING_THRESHOLD = 256
+
+
+def _minimal_push(data):
+    """Push data the way MINIMALDATA requires it"""
+    if len(data) == 1 and 1 <= data[0] <= 16:
+        return CScriptOp.encode_op_n(data[0])
+    if data == b'\x81':
+        return OP_1NEGATE
+    return data
+
+
+class SpendTemplate():
+    """Base class for the spend templates.
+
+    Subclasses define script_pubkey, script_code (the script committed to by
+    the signatures) and build_scriptsig()."""
+
+    def __init__(self, sigtype, hashtype):
+        assert sigtype in ('ecdsa', 'schnorr')
+        self.sigtype = sigtype
+        self.hashtype = hashtype
+
+    def sign(self, key, sighash):
+        if self.sigtype == 'schnorr':
+            sig = key.sign_schnorr(sighash)
+        else:
+            sig = key.sign_ecdsa(sighash)
+        return sig + bytes([self.hashtype & 0xff])
+
+    def create_scriptsig(self, tx, nIn, amount, txdata=None):
+        """Sign input nIn of tx, spending amount satoshis."""
+        if self.hashtype & SIGHASH_FORKID:
+            sighash = SignatureHashForkId(
+                self.script_code, tx, nIn, self.hashtype, amount, txdata)
+        else:
+            sighash, err = SignatureHash(
+                self.script_code, tx, nIn, self.hashtype, txdata)
+            assert err is None, err
+        return self.build_scriptsig(sighash)
+
+    def build_scriptsig(self, sighash):
+        raise NotImplementedError
+
+
+class P2PKHTemplate(SpendTemplate):
+    """Pay to the hash of the public key of key."""
+
+    def __init__(self, key, *, sigtype='schnorr',
+                 hashtype=SIGHASH_ALL | SIGHASH_FORKID):
+        super().__init__(sigtype, hashtype)
+        self.key = key
+        self.pubkey = key.get_pubkey().get_bytes()
+        self.script_pubkey = CScript([
+            OP_DUP, OP_HASH160, hash160(self.pubkey), OP_EQUALVERIFY,
+            OP_CHECKSIG])
+        self.script_code = self.script_pubkey
+
+    def build_scriptsig(self, sighash):
+        return CScript([self.sign(self.key, sighash), self.pubkey])
+
+
+class P2SHMultisigTemplate(SpendTemplate):
+    """Pay to a nrequired-of-len(keys) multisig redeem script.
+
+    The coins are spent with the first nrequired keys. Schnorr signatures use
+    the Schnorr multisig mode, where the dummy element is the bitfield of the
+    keys that signed."""
+
+    def __init__(self, keys, nrequired, *, sigtype='schnorr',
+                 hashtype=SIGHASH_ALL | SIGHASH_FORKID):
+        super().__init__(sigtype, hashtype)
+        assert 1 <= nrequired <= len(keys) <= 16
+        self.keys = keys
+        self.nrequired = nrequired
+        self.pubkeys = [key.get_pubkey().get_bytes() for key in keys]
+        self.redeem_script = CScript(
+            [nrequired] + self.pubkeys + [len(keys), OP_CHECKMULTISIG])
+        self.script_pubkey = CScript(
+            [OP_HASH160, hash160(self.redeem_script), OP_EQUAL])
+        self.script_code = self.redeem_script
+
+    def build_scriptsig(self, sighash):
+        if self.sigtype == 'schnorr':
+            checkbits = (1 << self.nrequired) - 1
+            dummy = _minimal_push(checkbits.to_bytes(
+                (len(self.keys) + 7) // 8, 'little'))
+        else:
+            dummy = OP_0
+        sigs = [self.sign(key, sighash)
+                for key in self.keys[:self.nrequired]]
+        return CScript([dummy] + sigs + [self.redeem_script])
+
+
+def _sign_job(job):
+    """Sign the inputs of a serialized transaction, in a worker process.
+
+    spent holds the (template, amount) of the coin spent by each input, or
+    None for the inputs which must be left untouched. The nonces are drawn
+    from seed, the random state of the caller is restored when the job runs
+    in its process."""
+    seed, rawtx, spent = job
+    state = random.getstate()
+    random.seed(seed)
+    try:
+        tx = CTransaction()
+        tx.deserialize(BytesIO(rawtx))
+        assert len(spent) == len(tx.vin)
+        txdata = PrecomputedTransactionData(tx)
+        for i, coin in enumerate(spent):
+            if coin is not None:
+                template, amount = coin
+                tx.vin[i].scriptSig = template.create_scriptsig(
+                    tx, i, amount, txdata)
+        return tx.serialize()
+    finally:
+        random.setstate(state)
+
+
+class TransactionFactory():
+    """Sign batches of transactions, using a pool of processes.
+
+    Worker processes are spawned rather than forked, as the test framework
+    runs threads (e.g. the network thread) that a fork could catch while
+    holding a lock. The pool is started on first use, close() or the context
+    manager stop it."""
+
+    def __init__(self, processes=None, *,
+                 parallel_threshold=PARALLEL_SIGNING_THRESHOLD):
+        self.processes = processes or os.cpu_count() or 1
+        self.parallel_threshold = parallel_threshold
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            import multiprocessing
+            self._pool = multiprocessing.get_context('spawn').Pool(
+                self.processes)
+        return self._pool
+
+    def sign_transactions(self, txs):
+        """Sign a list of (tx, spent) and return the signed transactions
+        serialized as hex, in the same order.
+
+        spent is the list of the (template, amount) of the coins spent by
+        the inputs of tx (see _sign_job). The CTransaction objects are not
+        modified."""
+        jobs = [(random.getrandbits(64), tx.serialize(), spent)
+                for tx, spent in txs]
+        nsigs = sum(len(spent) for _, spent in txs)
+        if self.processes > 1 and nsigs >= self.parallel_threshold:
+            chunksize = max(1, len(jobs) // (4 * self.processes))
+            signed = self._get_pool().imap(_sign_job, jobs, chunksize)
+        else:
+            signed = map(_sign_job, jobs)
+        return [rawtx.hex() for rawtx in signed]
+
+    def sign_transaction(self, tx, spent):
+        return self.sign_transactions([(tx, spent)])[0]
+
+
+class TestFrameworkTxFactory(unittest.TestCase):
+    def setUp(self):
+        self.keys = []
+        for i in range(3):
+            key = ECKey()
+            key.set(bytes([i + 1]) * 32, True)
+            self.keys.append(key)
+
+    def check_spend(self, templates, processes=1):
+        txs = []
+        for n, template in enumerate(templates):
+            tx = CTransaction()
+            tx.vin = [CTxIn(COutPoint(n + 1, i)) for i in range(2)]
+            tx.vout = [CTxOut(1000, CScript([OP_0]))]
+            txs.append((tx, [(template, 5000), (template, 6000)]))
+
+        random.seed(1)
+        with TransactionFactory(processes, parallel_threshold=0) as factory:
+            signed = factory.sign_transactions(txs)
+        for rawtx, (tx, spent) in zip(signed, txs):
+            signedtx = CTransaction()
+            signedtx.deserialize(BytesIO(bytes.fromhex(rawtx)))
+            # Only the scriptSigs were filled in
+            self.assertEqual(len(signedtx.vin), 2)
+            self.assertEqual(signedtx.vin[0].prevout.hash,
+                             tx.vin[0].prevout.hash)
+            outputs = [CTxOut(amount, template.script_pubkey)
+                       for template, amount in spent]
+            self.assertTrue(
+                check_transaction(signedtx, outputs,
+                                  STANDARD_SCRIPT_VERIFY_FLAGS)[0] is None)
+        # The random state of the test only moved by the seeds drawn
+        after = random.random()
+        random.seed(1)
+        for _ in txs:
+            random.getrandbits(64)
+        self.assertEqual(after, random.random())
+        return signed
+
+    def test_templates(self):
+        self.check_spend([
+            P2PKHTemplate(self.keys[0]),
+            P2PKHTemplate(self.keys[0], sigtype='ecdsa'),
+            P2SHMultisigTemplate(self.keys, 2),
+            P2SHMultisigTemplate(self.keys, 3, sigtype='ecdsa'),
+        ])
+
+    def test_deterministic(self):
+        templates = [P2PKHTemplate(self.keys[n % 3]) for n in range(8)]
+        # The signatures only depend on the random seed, not on the number
+        # of processes
+        self.assertEqual(self.check_spend(templates),
+                         self.check_spend(templates, processes=2))
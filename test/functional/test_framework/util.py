@@ -295,7 +295,8 @@ class PortSeed:
     n = None
 
 
-def get_rpc_proxy(url, node_number, *, timeout=None, coveragedir=None):
+def get_rpc_proxy(url, node_number, *, timeout=None, coveragedir=None,
+                  pool_size=None):
     """
     Args:
         url (str): URL of the RPC server to call
@@ -304,6 +305,8 @@ def get_rpc_proxy(url, node_number, *, timeout=None, coveragedir=None):
     Kwargs:
         timeout (int): HTTP timeout in seconds
         coveragedir (str): Directory
+        pool_size (int): maximum number of concurrent connections to the
+            server, if this is the first proxy to it
 
     Returns:
         AuthServiceProxy. convenience object for making RPC calls.
@@ -312,6 +315,8 @@ def get_rpc_proxy(url, node_number, *, timeout=None, coveragedir=None):
     proxy_kwargs = {}
     if timeout is not None:
         proxy_kwargs['timeout'] = int(timeout)
+    if pool_size is not None:
+        proxy_kwargs['pool_size'] = pool_size
 
     proxy = AuthServiceProxy(url, **proxy_kwargs)
     proxy.url = url  # store URL on proxy for info
@@ -319,18 +324,39 @@ def get_rpc_proxy(url, node_number, *, timeout=None, coveragedir=None):
     coverage_logfile = coverage.get_filename(
         coveragedir, node_number) if coveragedir else None
 
-    return coverage.AuthServiceProxyWrapper(proxy, coverage_logfile)
+    return coverage.AuthServiceProxyWrapper(
+        proxy, coverage_logfile, coverage.get_profile(node_number))
 
 
-def p2p_port(n):
+def get_async_rpc_proxy(url, node_number, *, timeout=None, coveragedir=None):
+    """Like get_rpc_proxy, but for an AsyncAuthServiceProxy."""
+    from .asyncrpc import AsyncAuthServiceProxy
+    proxy_kwargs = {}
+    if timeout is not None:
+        proxy_kwargs['timeout'] = int(timeout)
+
+    proxy = AsyncAuthServiceProxy(url, **proxy_kwargs)
+
+    coverage_logfile = coverage.get_filename(
+        coveragedir, node_number) if coveragedir else None
+
+    return coverage.AuthServiceProxyWrapper(
+        proxy, coverage_logfile, coverage.get_profile(node_number))
+
+
+def p2p_port(n, port_seed=None):
     assert n <= MAX_NODES
+    if port_seed is None:
+        port_seed = PortSeed.n
     return PORT_MIN + n + \
-        (MAX_NODES * PortSeed.n) % (PORT_RANGE - 1 - MAX_NODES)
+        (MAX_NODES * port_seed) % (PORT_RANGE - 1 - MAX_NODES)
 
 
-def rpc_port(n):
+def rpc_port(n, port_seed=None):
+    if port_seed is None:
+        port_seed = PortSeed.n
     return PORT_MIN + PORT_RANGE + n + \
-        (MAX_NODES * PortSeed.n) % (PORT_RANGE - 1 - MAX_NODES)
+        (MAX_NODES * port_seed) % (PORT_RANGE - 1 - MAX_NODES)
 
 
 def rpc_url(datadir, chain, host, port):
@@ -343,7 +369,7 @@ def rpc_url(datadir, chain, host, port):
 ################
 
 
-def initialize_datadir(dirname, n, chain):
+def initialize_datadir(dirname, n, chain, port_seed=None):
     datadir = get_datadir_path(dirname, n)
     if not os.path.isdir(datadir):
         os.makedirs(datadir)
@@ -357,8 +383,8 @@ def initialize_datadir(dirname, n, chain):
     with open(os.path.join(datadir, "bitcoin.conf"), 'w', encoding='utf8') as f:
         f.write("{}=1\n".format(chain_name_conf_arg))
         f.write("[{}]\n".format(chain_name_conf_section))
-        f.write("port=" + str(p2p_port(n)) + "\n")
-        f.write("rpcport=" + str(rpc_port(n)) + "\n")
+        f.write("port=" + str(p2p_port(n, port_seed)) + "\n")
+        f.write("rpcport=" + str(rpc_port(n, port_seed)) + "\n")
         f.write("fallbackfee=0.0002\n")
         f.write("server=1\n")
         f.write("keypool=1\n")
@@ -457,6 +483,27 @@ def connect_nodes(from_node, to_node):
                 0) == 24 for peer in from_node.getpeerinfo()))
 
 
+def mempools_diff(names, pools, limit=10):
+    """Describe how the mempools (sets of txids) differ from the first one,
+    listing at most limit txids per difference."""
+    def txids(diff):
+        return ', '.join(sorted(diff)[:limit]) + (
+            ', ...' if len(diff) > limit else '')
+
+    lines = ['{}: {} transactions'.format(names[0], len(pools[0]))]
+    for name, pool in zip(names[1:], pools[1:]):
+        line = '{}: {} transactions'.format(name, len(pool))
+        missing = pools[0] - pool
+        if missing:
+            line += ', {} missing: {}'.format(len(missing), txids(missing))
+        extra = pool - pools[0]
+        if extra:
+            line += ', {} not in {}: {}'.format(
+                len(extra), names[0], txids(extra))
+        lines.append(line)
+    return lines
+
+
 # Transaction/Block functions
 #############################
 
@@ -466,12 +513,28 @@ def find_output(node, txid, amount, *, blockhash=None):
     Return index to output of txid with value amount
     Raises exception if there is none.
     """
-    txdata = node.getrawtransaction(txid, 1, blockhash)
-    for i in range(len(txdata["vout"])):
-        if txdata["vout"][i]["value"] == amount:
-            return i
-    raise RuntimeError("find_output txid {} : {} not found".format(
-        txid, str(amount)))
+    return find_outputs(node, [(txid, amount)], blockhash=blockhash)[0]
+
+
+def find_outputs(node, outputs, *, blockhash=None):
+    """
+    Return the indexes of a list of (txid, amount) outputs, see find_output.
+    The transactions are fetched with a single batch request.
+    """
+    with node.batch() as b:
+        futures = [b.getrawtransaction(txid, 1, blockhash)
+                   for txid, _ in outputs]
+    indexes = []
+    for (txid, amount), future in zip(outputs, futures):
+        vout = future.result()["vout"]
+        for i in range(len(vout)):
+            if vout[i]["value"] == amount:
+                indexes.append(i)
+                break
+        else:
+            raise RuntimeError("find_output txid {} : {} not found".format(
+                txid, str(amount)))
+    return indexes
 
 
 def gather_inputs(from_node, amount_needed, confirmations_required=1):
@@ -0,0 +1,562 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Nodes started in advance on the cached chain and leased to the tests.
+
+Starting and stopping bitcoind is most of the runtime of the short tests.
+With `test_runner.py --warmpool=n`, the runner keeps n nodes running on a
+copy of the standard cache (see BitcoinTestFramework._initialize_chain) for
+each node index below WARM_POOL_MAX_NODES. A test setting supports_warm_pool
+in set_test_params() leases them the first time it starts its nodes, if each
+of them matches the command line and the bitcoin.conf the test would start
+its node with, the ports excepted (see node_key()). Otherwise the test starts
+its own nodes as usual. Until then, the datadirs of the test only hold their
+bitcoin.conf: the cached chain is only copied if the nodes are not leased.
+
+A leased node keeps its datadir, which is linked in place of the datadir of
+the test node, and its ports (see TestNode.adopt()). So only the tests which
+do not rely on p2p_port(n) and rpc_port(n), nor modify the datadirs before
+starting the nodes, can support the warm pool.
+
+When the test releases a node, the pool stops it, replaces its datadir with
+a fresh copy of the cache and restarts it, in the background. The datadir of
+the nodes of a failed test is kept for debugging: the pool moves it in place
+of the link before the test exits.
+
+The pool serves the tests on a unix socket, whose path is in the WARM_POOL_ENV
+environment variable. A test holds a single connection for all its nodes,
+closing it, e.g. when the test crashes, releases them. The pool reports the
+exit status of the leased processes on it, see LeasedProcess.
+"""
+
+import json
+import logging
+import os
+import select
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from .datadir import DatadirCloner
+from .test_node import BITCOIND_PROC_WAIT_TIMEOUT, TestNode
+from .util import get_datadir_path, initialize_datadir, p2p_port, rpc_port
+from .zygote import _recv_line, _send_json
+
+# Environment variable holding the path of the socket of the pool
+WARM_POOL_ENV = 'TEST_RUNNER_WARM_POOL'
+
+# The pool keeps nodes for the indices below this one
+WARM_POOL_MAX_NODES = 4
+
+# How often the pool checks whether the leased processes exited, in seconds
+REAP_INTERVAL = 0.05
+
+# How long a test waits for the pool to answer, in seconds
+LEASE_TIMEOUT = 10
+
+
+def node_key(node, extra_args=None):
+    """What a warm node must match to be leased in place of node started
+    with extra_args: the command line and the bitcoin.conf, except the
+    datadir and the ports."""
+    args = [arg for arg in node.get_start_args(extra_args)
+            if not arg.startswith('-datadir=')]
+    with open(node.bitcoinconf, encoding='utf8') as f:
+        conf = [line for line in f.read().splitlines()
+                if not line.startswith(('port=', 'rpcport='))]
+    return {'index': node.index, 'args': args, 'conf': conf}
+
+
+class WarmNode():
+    """A node of the pool, restarted on the same ports after each lease."""
+
+    def __init__(self, index, port_seed, root):
+        self.index = index
+        self.port_seed = port_seed
+        # The directory holding the datadir
+        self.root = root
+        self.datadir = get_datadir_path(root, index)
+        self.process = None
+        self.key = None
+        # Describes the node to the test leasing it
+        self.info = None
+        self.startup_time = 0
+
+
+class WarmPool():
+    """Keep size nodes running for each index below WARM_POOL_MAX_NODES, see
+    the module documentation.
+
+    The nodes are started by bitcoind on copies of the datadir
+    cache_node_dir, their ports derived from consecutive port seeds from
+    port_seed. default_args are added to the default arguments of the nodes,
+    like BitcoinTestFramework.add_nodes() does."""
+
+    def __init__(self, pool_dir, cache_node_dir, *, size, port_seed,
+                 bitcoind, emulator=None, default_args=()):
+        self.pool_dir = pool_dir
+        self.cache_node_dir = cache_node_dir
+        self.bitcoind = bitcoind
+        self.emulator = emulator
+        self.default_args = list(default_args)
+        # Out of pool_dir, the length of the path of a socket is limited
+        self._socket_dir = tempfile.mkdtemp(prefix='warm_pool_')
+        self.socket_path = os.path.join(self._socket_dir, 'socket')
+        # Number of leases, of nodes leased, and the node startup and
+        # shutdown time the tests did not have to wait for, in seconds
+        self.tests = 0
+        self.leased = 0
+        self.saved_time = 0
+        # The tmpdirs of the tests which leased nodes
+        self._lessees = set()
+
+        self._cond = threading.Condition()
+        self._ready = []
+        self._closing = False
+        self._threads = []
+
+        # The pool runs in the test runner, whose logs are not about the nodes
+        # nor their RPC calls
+        for name in ('TestFramework', 'BitcoinRPC'):
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+        os.makedirs(pool_dir)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.socket_path)
+        self._server.listen(64)
+        self._server.settimeout(REAP_INTERVAL)
+        self._spawn(self._accept)
+        nodes = [WarmNode(index, port_seed + n * WARM_POOL_MAX_NODES + index,
+                          os.path.join(pool_dir, 'slot{}'.format(n)))
+                 for n in range(size) for index in range(WARM_POOL_MAX_NODES)]
+        for node in nodes:
+            self._spawn(self._warm, node)
+
+    def _spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        with self._cond:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            self._threads.append(thread)
+        thread.start()
+
+    def _provision(self, node):
+        """Copy the cache to the datadir of node."""
+        DatadirCloner().clone(self.cache_node_dir, node.datadir)
+        initialize_datadir(node.root, node.index, 'regtest', node.port_seed)
+
+    def _start(self, node):
+        """Start bitcoind on the datadir of node, and wait for it to be
+        ready."""
+        test_node = TestNode(
+            node.index,
+            node.datadir,
+            chain='regtest',
+            host=None,
+            rpc_port=rpc_port(node.index, node.port_seed),
+            p2p_port=p2p_port(node.index, node.port_seed),
+            timewait=BITCOIND_PROC_WAIT_TIMEOUT,
+            timeout_factor=1,
+            bitcoind=self.bitcoind,
+            bitcoin_cli=None,
+            coverage_dir=None,
+            cwd=node.root,
+            extra_conf=["bind=127.0.0.1"],
+            extra_args=[],
+            emulator=self.emulator,
+        )
+        test_node.extend_default_args(self.default_args)
+        node.key = node_key(test_node)
+        test_node.start()
+        node.process = test_node.process
+        try:
+            test_node.wait_for_rpc_connection()
+        finally:
+            # The pool owns the process
+            test_node.cleanup_on_exit = False
+            test_node.stdout.close()
+            test_node.stderr.close()
+        node.info = {
+            'index': node.index,
+            'pid': node.process.pid,
+            'datadir': node.datadir,
+            'rpc_port': test_node.rpc_port,
+            'p2p_port': test_node.p2p_port,
+            'stdout': test_node.stdout.name,
+            'stderr': test_node.stderr.name,
+        }
+
+    def _stop(self, node):
+        """Stop the process of node, bitcoind shuts down on SIGTERM."""
+        process, node.process = node.process, None
+        if process is None:
+            return
+        if process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(BITCOIND_PROC_WAIT_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+    def _warm(self, node):
+        """Start node on a fresh copy of the cache and make it available."""
+        start = time.time()
+        try:
+            self._provision(node)
+            self._start(node)
+        except Exception as e:
+            # The node is given up, the tests start their own
+            print("Warm pool node {} failed to start: {!r}".format(
+                node.index, e), file=sys.stderr)
+            self._stop(node)
+            shutil.rmtree(node.datadir, ignore_errors=True)
+            return
+        node.startup_time = time.time() - start
+        with self._cond:
+            if not self._closing:
+                self._ready.append(node)
+                return
+        self._stop(node)
+
+    def _retire(self, node, keep=None):
+        """Stop a released node. Its datadir is moved to keep, if set, or
+        removed."""
+        start = time.time()
+        self._stop(node)
+        if keep is not None:
+            if os.path.islink(keep):
+                os.remove(keep)
+            shutil.move(node.datadir, keep)
+        else:
+            shutil.rmtree(node.datadir, ignore_errors=True)
+            with self._cond:
+                self.saved_time += time.time() - start
+
+    def _rewarm(self, node):
+        """Start a retired node again on a fresh datadir."""
+        with self._cond:
+            if self._closing:
+                return
+        self._warm(node)
+
+    def _recycle(self, node, keep=None):
+        """Stop a released node and start it again on a fresh datadir, see
+        _retire()."""
+        self._retire(node, keep)
+        self._rewarm(node)
+
+    def _take(self, keys, tmpdir=None):
+        """Lease a ready node matching each of keys, or none, to the test
+        running in tmpdir."""
+        with self._cond:
+            # Do not lease the nodes which exited meanwhile
+            exited = [n for n in self._ready if n.process.poll() is not None]
+            for node in exited:
+                self._ready.remove(node)
+            leased = []
+            for key in keys:
+                node = next((n for n in self._ready
+                             if n.key == key and n not in leased), None)
+                if node is None:
+                    leased = None
+                    break
+                leased.append(node)
+            if leased is not None:
+                for node in leased:
+                    self._ready.remove(node)
+                self.tests += 1
+                self.leased += len(leased)
+                self._lessees.add(tmpdir)
+                self.saved_time += sum(n.startup_time for n in leased)
+        for node in exited:
+            self._spawn(self._recycle, node)
+        return leased
+
+    def _accept(self):
+        while True:
+            with self._cond:
+                if self._closing:
+                    return
+            try:
+                conn, _ = self._server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            conn.settimeout(None)
+            self._spawn(self._serve, conn)
+
+    def _serve(self, conn):
+        """Lease nodes to a test, then report the exit of their processes
+        and recycle them as they are released."""
+        leased = {}
+        try:
+            line, buf = _recv_line(conn, b'')
+            if line is None:
+                return
+            request = json.loads(line.decode('utf-8'))
+            nodes = self._take(request['nodes'], request.get('tmpdir'))
+            if nodes is None:
+                _send_json(conn, {'nodes': None})
+                return
+            leased = {node.index: node for node in nodes}
+            _send_json(conn, {'nodes': [node.info for node in nodes]})
+            exited = set()
+            while leased and not self._closing:
+                readable, _, _ = select.select([conn], [], [], REAP_INTERVAL)
+                for index, node in leased.items():
+                    returncode = node.process.poll()
+                    if index not in exited and returncode is not None:
+                        exited.add(index)
+                        _send_json(conn, {'index': index,
+                                          'returncode': returncode})
+                if not readable:
+                    continue
+                line, buf = _recv_line(conn, buf)
+                if line is None:
+                    break
+                message = json.loads(line.decode('utf-8'))
+                node = leased.pop(message['release'])
+                if message['keep'] is None:
+                    self._spawn(self._recycle, node)
+                else:
+                    # The test waits for its datadir, not for the restart
+                    self._retire(node, message['keep'])
+                    _send_json(conn, {'released': node.index})
+                    self._spawn(self._rewarm, node)
+        except OSError:
+            # The test is gone
+            pass
+        finally:
+            conn.close()
+            for node in leased.values():
+                self._spawn(self._recycle, node)
+
+    def close(self):
+        """Stop all the nodes and remove the pool directory."""
+        with self._cond:
+            self._closing = True
+            ready, self._ready = self._ready, []
+            threads = list(self._threads)
+        self._server.close()
+        for node in ready:
+            self._stop(node)
+        while threads:
+            for thread in threads:
+                thread.join()
+            # Including the threads started meanwhile
+            with self._cond:
+                threads = [t for t in self._threads if t.is_alive()]
+        shutil.rmtree(self.pool_dir, ignore_errors=True)
+        shutil.rmtree(self._socket_dir, ignore_errors=True)
+
+    def leased_by(self, tmpdir):
+        """Return whether the test running in tmpdir leased nodes. They are
+        children of the pool, the resources they use are not measured with
+        the test."""
+        with self._cond:
+            return tmpdir in self._lessees
+
+    def report(self):
+        return "{} nodes leased by {} tests, {:.0f} s of node startup and " \
+            "shutdown saved".format(self.leased, self.tests, self.saved_time)
+
+
+class LeasedProcess():
+    """The process of a leased node, which is a child of the pool. It
+    provides the part of the subprocess.Popen interface used by TestNode."""
+
+    def __init__(self, lease, pid):
+        self._lease = lease
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        self._lease.update()
+        return self.returncode
+
+    def wait(self, timeout=None):
+        end = None if timeout is None else time.time() + timeout
+        while self.returncode is None:
+            remaining = None if end is None else end - time.time()
+            if remaining is not None and remaining <= 0:
+                raise subprocess.TimeoutExpired(
+                    'bitcoind (pid {})'.format(self.pid), timeout)
+            self._lease.update(remaining)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.returncode is None:
+            os.kill(self.pid, sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class WarmPoolLease():
+    """The nodes leased by a test, see lease_nodes().
+
+    nodes describes each leased node, in the order they were requested, and
+    processes maps their index to their LeasedProcess."""
+
+    def __init__(self, conn, nodes):
+        self._conn = conn
+        self._buf = b''
+        self._released = set()
+        self.nodes = nodes
+        self.processes = {node['index']: LeasedProcess(self, node['pid'])
+                          for node in nodes}
+
+    def update(self, timeout=0):
+        """Handle the messages of the pool, waiting for at most timeout
+        seconds (forever if None) for the first one."""
+        while select.select([self._conn], [], [], timeout)[0]:
+            data = self._conn.recv(4096)
+            if not data:
+                raise RuntimeError('The warm pool exited')
+            self._buf += data
+            while b'\n' in self._buf:
+                line, _, self._buf = self._buf.partition(b'\n')
+                message = json.loads(line.decode('utf-8'))
+                if 'released' in message:
+                    self._released.add(message['released'])
+                else:
+                    self.processes[message['index']].returncode = \
+                        message['returncode']
+            timeout = 0
+
+    def release(self, index, keep=None):
+        """Give the node back to the pool. If keep is set, wait for the pool
+        to stop the node and move its datadir there."""
+        _send_json(self._conn, {'release': index, 'keep': keep})
+        if keep is None:
+            return
+        # The pool kills the node if it does not stop in time
+        timeout = 2 * BITCOIND_PROC_WAIT_TIMEOUT
+        end = time.time() + timeout
+        while index not in self._released:
+            if time.time() >= end:
+                raise RuntimeError(
+                    'The warm pool did not release node {} within {} s'.format(
+                        index, timeout))
+            self.update(end - time.time())
+
+    def close(self):
+        """Release the remaining nodes."""
+        self._conn.close()
+
+
+def lease_nodes(socket_path, keys, tmpdir=None):
+    """Lease a node matching each of keys (see node_key()) from the pool
+    listening on socket_path, for the test running in tmpdir. Returns a
+    WarmPoolLease, or None if the pool has not all the nodes ready."""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(LEASE_TIMEOUT)
+    try:
+        conn.connect(socket_path)
+        _send_json(conn, {'nodes': keys, 'tmpdir': tmpdir})
+        line, buf = _recv_line(conn, b'')
+    except OSError:
+        conn.close()
+        return None
+    reply = json.loads(line.decode('utf-8')) if line is not None else {}
+    if not reply.get('nodes'):
+        conn.close()
+        return None
+    conn.settimeout(None)
+    lease = WarmPoolLease(conn, reply['nodes'])
+    lease._buf = buf
+    return lease
+
+
+class TestFrameworkWarmPool(unittest.TestCase):
+    class FakeWarmPool(WarmPool):
+        """A pool of sleeping python processes instead of nodes."""
+        # Set to block the provisioning of the nodes until it is set
+        unblock = None
+
+        def _provision(self, node):
+            if self.unblock is not None:
+                self.unblock.wait(10)
+            os.makedirs(node.datadir)
+
+        def _start(self, node):
+            node.key = {'index': node.index, 'args': [], 'conf': []}
+            node.process = subprocess.Popen(
+                [sys.executable, '-c', 'import time; time.sleep(60)'])
+            node.info = {'index': node.index, 'pid': node.process.pid,
+                         'datadir': node.datadir}
+
+    def setUp(self):
+        if not hasattr(socket, 'AF_UNIX'):
+            self.skipTest('no unix sockets')
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+        self.pool = self.FakeWarmPool(
+            os.path.join(self.tmpdir, 'pool'), None, size=1, port_seed=0,
+            bitcoind=None)
+        self.addCleanup(self.pool.close)
+        self.keys = [{'index': i, 'args': [], 'conf': []} for i in range(2)]
+
+    def lease(self, keys, tmpdir=None):
+        end = time.time() + 10
+        while True:
+            lease = lease_nodes(self.pool.socket_path, keys, tmpdir)
+            if lease is not None or time.time() > end:
+                return lease
+            # The pool is starting
+            time.sleep(0.05)
+
+    def test_lease(self):
+        lease = self.lease(self.keys, '/tmp/test_0')
+        self.assertIsNotNone(lease)
+        self.assertEqual([n['index'] for n in lease.nodes], [0, 1])
+        self.assertEqual((self.pool.tests, self.pool.leased), (1, 2))
+        self.assertTrue(self.pool.leased_by('/tmp/test_0'))
+        # No other node matches
+        self.assertIsNone(lease_nodes(self.pool.socket_path, self.keys[:1],
+                                      '/tmp/test_1'))
+        self.assertFalse(self.pool.leased_by('/tmp/test_1'))
+        self.assertIsNone(lease_nodes(self.pool.socket_path, [
+            {'index': 2, 'args': ['-other'], 'conf': []}]))
+
+        # The exit of the processes is reported
+        process = lease.processes[0]
+        self.assertIsNone(process.poll())
+        process.kill()
+        self.assertEqual(process.wait(10), -signal.SIGKILL)
+        with self.assertRaises(subprocess.TimeoutExpired):
+            lease.processes[1].wait(0.1)
+
+        # A released node is kept on demand, the other ones are restarted
+        keep = os.path.join(self.tmpdir, 'node1')
+        os.symlink(lease.nodes[1]['datadir'], keep)
+        lease.release(1, keep)
+        self.assertTrue(os.path.isdir(keep))
+        self.assertFalse(os.path.islink(keep))
+        lease.close()
+        self.assertIsNotNone(self.lease(self.keys))
+
+    def test_release_before_restart(self):
+        lease = self.lease(self.keys)
+        self.pool.unblock = threading.Event()
+        self.addCleanup(self.pool.unblock.set)
+        # The datadir is moved while the node restarts in the background
+        keep = os.path.join(self.tmpdir, 'node0')
+        start = time.time()
+        lease.release(0, keep)
+        self.assertLess(time.time() - start, 5)
+        self.assertTrue(os.path.isdir(keep))
+        self.assertFalse(self.pool.unblock.is_set())
+        lease.close()
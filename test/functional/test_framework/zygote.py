@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 The Bitcoin developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or http://www.opensource.org/licenses/mit-license.php.
+"""Fork the functional tests from a process with the test framework loaded.
+
+Started with `test_runner.py --zygote`, the zygote imports the test
+framework modules once, then listens on a unix socket. For every test, it
+forks a child which runs the test script as __main__ with the requested
+arguments, its stdout and stderr redirected to the file descriptors sent
+along the request. The child is reseeded, so the tests do not share the
+random state of the zygote.
+
+The zygote is single-threaded, so a fork never catches a lock held by
+another thread. It reaps its children itself and sends back their exit
+status and resource usage, which includes the nodes they waited for:
+
+    zygote = Zygote(tests_dir)
+    process = zygote.spawn(argv, stdout, stderr)
+    returncode, rusage = process.wait()
+"""
+
+import array
+import importlib
+import json
+import os
+import random
+import runpy
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from collections import namedtuple
+
+# Modules imported by the zygote before forking the tests
+PRELOAD_MODULES = [
+    'test_framework.address',
+    'test_framework.asyncrpc',
+    'test_framework.authproxy',
+    'test_framework.blocktools',
+    'test_framework.key',
+    'test_framework.messages',
+    'test_framework.mininode',
+    'test_framework.script',
+    'test_framework.test_framework',
+    'test_framework.txtools',
+    'test_framework.util',
+]
+
+# How often the zygote checks for exited children, in seconds
+REAP_INTERVAL = 0.05
+
+# Resource usage of a test, as in resource.struct_rusage
+ZygoteRusage = namedtuple('ZygoteRusage', ['ru_utime', 'ru_stime',
+                                           'ru_maxrss'])
+
+
+def _recv_line(conn, buf):
+    """Read a line from conn, buf holds what was read past the previous
+    one. Returns the line and the new buf, the line is None on EOF."""
+    while b'\n' not in buf:
+        data = conn.recv(4096)
+        if not data:
+            return None, buf
+        buf += data
+    line, _, buf = buf.partition(b'\n')
+    return line, buf
+
+
+def _send_json(conn, obj):
+    conn.sendall(json.dumps(obj).encode('utf-8') + b'\n')
+
+
+class ZygoteProcess():
+    """A test running in a child of the zygote, see Zygote.spawn()."""
+
+    def __init__(self, conn, pid, buf):
+        self._conn = conn
+        self._buf = buf
+        self.pid = pid
+        self.returncode = None
+
+    def wait(self):
+        """Wait for the test to exit, return its exit code (negative for a
+        signal, like Popen) and resource usage."""
+        line, self._buf = _recv_line(self._conn, self._buf)
+        self._conn.close()
+        if line is None:
+            raise RuntimeError('The zygote exited before the test')
+        reply = json.loads(line.decode('utf-8'))
+        self.returncode = reply['returncode']
+        return self.returncode, ZygoteRusage(*reply['rusage'])
+
+
+class Zygote():
+    """Start a zygote process and spawn tests from it."""
+
+    def __init__(self, tests_dir):
+        self._dir = tempfile.mkdtemp(prefix='zygote_')
+        self.socket_path = os.path.join(self._dir, 'socket')
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), tests_dir,
+             self.socket_path],
+            stdout=subprocess.PIPE, universal_newlines=True)
+        # Wait for the modules to be loaded
+        ready = self.process.stdout.readline()
+        if ready.strip() != 'ready':
+            self.close()
+            raise RuntimeError('The zygote failed to start')
+
+    def spawn(self, argv, stdout, stderr):
+        """Run the test script argv[0] with the arguments argv[1:], writing
+        to the files stdout and stderr. Returns a ZygoteProcess."""
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(self.socket_path)
+        request = json.dumps({'argv': argv, 'cwd': os.getcwd()}).encode(
+            'utf-8') + b'\n'
+        fds = array.array('i', [stdout.fileno(), stderr.fileno()])
+        conn.sendmsg([request], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+        line, buf = _recv_line(conn, b'')
+        if line is None:
+            conn.close()
+            raise RuntimeError('The zygote failed to start the test')
+        return ZygoteProcess(conn, json.loads(line.decode('utf-8'))['pid'],
+                             buf)
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        self.process.stdout.close()
+        try:
+            os.remove(self.socket_path)
+        except OSError:
+            pass
+        os.rmdir(self._dir)
+
+
+def _read_request(conn):
+    """Receive a test request and its stdout and stderr descriptors."""
+    fds = array.array('i')
+    buf = b''
+    while b'\n' not in buf:
+        data, ancdata, _, _ = conn.recvmsg(
+            4096, socket.CMSG_LEN(2 * fds.itemsize))
+        for level, kind, cmsg_data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(cmsg_data[:len(cmsg_data) -
+                                        (len(cmsg_data) % fds.itemsize)])
+        if not data:
+            return None, list(fds)
+        buf += data
+    request = json.loads(buf.partition(b'\n')[0].decode('utf-8'))
+    return request, list(fds)
+
+
+def serve(socket_path):
+    """Fork a child for every request received on socket_path. Only
+    returns in the children, with the request they must run."""
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(64)
+    sel = selectors.DefaultSelector()
+    sel.register(server, selectors.EVENT_READ)
+    # pid -> connection waiting for its exit status
+    children = {}
+    print('ready', flush=True)
+
+    while True:
+        for _ in sel.select(REAP_INTERVAL):
+            conn, _ = server.accept()
+            request, fds = _read_request(conn)
+            if request is None or len(fds) != 2:
+                for fd in fds:
+                    os.close(fd)
+                conn.close()
+                continue
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                sel.close()
+                server.close()
+                for other in children.values():
+                    other.close()
+                conn.close()
+                request['fds'] = fds
+                return request
+            for fd in fds:
+                os.close(fd)
+            children[pid] = conn
+            _send_json(conn, {'pid': pid})
+
+        while children:
+            pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            conn = children.pop(pid, None)
+            if conn is None:
+                continue
+            returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) \
+                else os.WEXITSTATUS(status)
+            try:
+                _send_json(conn, {
+                    'returncode': returncode,
+                    'rusage': [rusage.ru_utime, rusage.ru_stime,
+                               rusage.ru_maxrss],
+                })
+            except OSError:
+                # The runner is gone
+                pass
+            conn.close()
+
+
+def run_test(request):
+    """Run the requested test script in a forked child, as python would."""
+    stdout_fd, stderr_fd = request['fds']
+    os.dup2(stdout_fd, 1)
+    os.dup2(stderr_fd, 2)
+    os.close(stdout_fd)
+    os.close(stderr_fd)
+    os.chdir(request['cwd'])
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    # Do not share the random state of the zygote with the other tests
+    random.seed()
+    sys.argv = list(request['argv'])
+    runpy.run_path(sys.argv[0], run_name='__main__')
+
+
+def main():
+    tests_dir, socket_path = sys.argv[1:3]
+    # Interrupting the runner interrupts the tests, the zygote is terminated
+    # by the runner
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Import the test framework the way the test scripts do
+    sys.path[0] = tests_dir
+    for module in PRELOAD_MODULES:
+        try:
+            importlib.import_module(module)
+        except Exception:
+            # The tests will report the error
+            pass
+    run_test(serve(socket_path))
+
+
+class TestFrameworkZygote(unittest.TestCase):
+    def test_spawn(self):
+        if not hasattr(socket, 'AF_UNIX') or not hasattr(os, 'fork'):
+            self.skipTest('no fork or unix sockets')
+        tests_dir = os.path.dirname(os.path.dirname(os.path.abspath(
+            __file__)))
+        zygote = Zygote(tests_dir)
+        self.addCleanup(zygote.close)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            script = os.path.join(tmpdir, 'script.py')
+            with open(script, 'w', encoding='utf8') as f:
+                f.write(
+                    'import random, sys\n'
+                    'import test_framework.util\n'
+                    'print(sys.argv[1:], random.random())\n'
+                    'print("error", file=sys.stderr)\n'
+                    'if __name__ == "__main__":\n'
+                    '    sys.exit(int(sys.argv[1]))\n')
+
+            def run(code):
+                with tempfile.TemporaryFile() as out, \
+                        tempfile.TemporaryFile() as err:
+                    process = zygote.spawn([script, str(code)], out, err)
+                    returncode, rusage = process.wait()
+                    out.seek(0)
+                    err.seek(0)
+                    return returncode, out.read().decode(), \
+                        err.read().decode(), rusage
+
+            start = time.time()
+            returncode, out, err, rusage = run(3)
+            self.assertEqual(returncode, 3)
+            self.assertTrue(out.startswith("['3'] "), out)
+            self.assertEqual(err, 'error\n')
+            self.assertGreaterEqual(rusage.ru_utime, 0)
+            self.assertLess(time.time() - start, 10)
+            # The random state is not shared
+            self.assertNotEqual(run(0)[1].split()[1], out.split()[1])
+
+
+if __name__ == '__main__':
+    main()
@@ -14,9 +14,10 @@ For a description of arguments recognized by test scripts, see
 """
 
 import argparse
-from collections import deque
+from collections import deque, namedtuple
 import configparser
 import datetime
+import hashlib
 import os
 import time
 import shutil
@@ -76,9 +77,22 @@ TEST_EXIT_SKIPPED = 77
 
 TEST_FRAMEWORK_MODULES = [
     "address",
+    "asyncrpc",
+    "authproxy",
     "blocktools",
+    "chainfixture",
+    "coverage",
+    "datadir",
+    "importtime",
+    "interpreter",
+    "keycache",
+    "logfollower",
     "messages",
+    "rpccache",
     "script",
+    "txfactory",
+    "warmpool",
+    "zygote",
 ]
 
 NON_SCRIPTS = [
@@ -115,6 +129,42 @@ TEST_PARAMS = {
 DEFAULT_EXTENDED_CUTOFF = 40
 DEFAULT_JOBS = (multiprocessing.cpu_count() // 3) + 1
 
+# Estimated cost of the tests without a recorded run: the memory of a node
+# and of the test framework process in MiB, and the cores used
+DEFAULT_NODE_MEMORY = 64
+DEFAULT_FRAMEWORK_MEMORY = 64
+DEFAULT_TEST_CPU = 1.0
+# ... and the disk space used by a node, in MiB
+DEFAULT_NODE_DISK = 32
+# Disk footprint in MiB of the tests writing a lot, used until one is recorded
+LARGE_DISK_TESTS = {
+    "feature_dbcrash.py": 2000,
+    "feature_pruning.py": 4000,
+}
+
+# Largest disk footprint in MiB of a test run on tmpfs (--tmpfs), and the part
+# of the free space of the tmpfs the tests can fill
+TMPFS_MAX_TEST_DISK = 1024
+TMPFS_USABLE_SPACE = 0.8
+# Name of the file holding the pid of the runner owning a tmpfs directory
+TMPFS_PID_FILENAME = "test_runner.pid"
+
+# How often the memory of the tests and the size of their tmpdir are sampled
+RESOURCE_SAMPLING_INTERVAL = 0.5
+# A test regresses when it uses this much more of a resource than recorded
+DEFAULT_REGRESSION_THRESHOLD = 0.5
+# Smaller increases are noise: seconds of duration and CPU, MiB of memory
+# and disk
+REGRESSION_MIN_INCREASE = {
+    'time': 5,
+    'cpu': 5,
+    'max_rss': 50,
+    'max_disk': 50,
+}
+# Keys of timing.json no longer written, dropped when the timings are merged:
+# the CPU time is saved as cpu_user and cpu_sys
+OBSOLETE_TIMING_KEYS = ['cpu']
+
 
 class TestCase():
     """
@@ -122,9 +172,16 @@ class TestCase():
     """
 
     def __init__(self, test_num, test_case, tests_dir,
-                 tmpdir, failfast_event, flags=None):
+                 tmpdir, failfast_event, flags=None, zygote=None,
+                 tmpfs=None, disk=0, warm_pool=None):
         self.tests_dir = tests_dir
+        self.zygote = zygote
+        self.warm_pool = warm_pool
         self.tmpdir = tmpdir
+        # The TmpfsAllocator placing the tmpdir of the test, and its
+        # estimated disk footprint
+        self.tmpfs = tmpfs
+        self.disk = disk
         self.test_case = test_case
         self.test_num = test_num
         self.failfast_event = failfast_event
@@ -135,34 +192,186 @@ class TestCase():
             return TestResult(self.test_num, self.test_case,
                               "", "Skipped", 0, "", "")
 
+        if self.tmpfs is None:
+            return self._run(portseed_offset, self.tmpdir)
+        tmpdir = self.tmpfs.acquire(self.disk)
+        try:
+            result = self._run(portseed_offset, tmpdir)
+            if tmpdir != self.tmpdir and os.path.isdir(result.testdir):
+                # Left for debugging, move it out of memory
+                testdir = os.path.join(
+                    self.tmpdir, os.path.basename(result.testdir))
+                shutil.move(result.testdir, testdir)
+                result.testdir = testdir
+            return result
+        finally:
+            self.tmpfs.release(tmpdir, self.disk)
+
+    def _run(self, portseed_offset, tmpdir):
         portseed = self.test_num + portseed_offset
         portseed_arg = ["--portseed={}".format(portseed)]
         log_stdout = tempfile.SpooledTemporaryFile(max_size=2**16)
         log_stderr = tempfile.SpooledTemporaryFile(max_size=2**16)
         test_argv = self.test_case.split()
         testdir = os.path.join("{}", "{}_{}").format(
-            self.tmpdir, re.sub(".py$", "", test_argv[0]), portseed)
+            tmpdir, re.sub(".py$", "", test_argv[0]), portseed)
         tmpdir_arg = ["--tmpdir={}".format(testdir)]
         start_time = time.time()
-        process = subprocess.Popen([sys.executable, os.path.join(self.tests_dir, test_argv[0])] + test_argv[1:] + self.flags + portseed_arg + tmpdir_arg,
-                                   universal_newlines=True,
-                                   stdout=log_stdout,
-                                   stderr=log_stderr)
-
-        process.wait()
+        test_args = [os.path.join(self.tests_dir, test_argv[0])] + test_argv[1:] + self.flags + portseed_arg + tmpdir_arg
+        try:
+            if self.zygote is not None:
+                process = self.zygote.spawn(test_args, log_stdout, log_stderr)
+            else:
+                process = subprocess.Popen([sys.executable] + test_args,
+                                           universal_newlines=True,
+                                           stdout=log_stdout,
+                                           stderr=log_stderr)
+        except (OSError, RuntimeError) as e:
+            log_stdout.close(), log_stderr.close()
+            return TestResult(self.test_num, self.test_case, testdir,
+                              "Failed", time.time() - start_time, "",
+                              "Failed to start the test: {}".format(e))
+        sampler = ResourceSampler(process.pid, testdir)
+        sampler.start()
+
+        wait_error = None
+        try:
+            if self.zygote is not None:
+                _, rusage = process.wait()
+            else:
+                rusage = wait_with_rusage(process)
+        except (OSError, RuntimeError) as e:
+            # E.g. the zygote was killed during the test
+            rusage = None
+            wait_error = "Failed to wait for the test: {}".format(e)
+        sampler.stop()
         log_stdout.seek(0), log_stderr.seek(0)
         [stdout, stderr] = [log.read().decode('utf-8')
                             for log in (log_stdout, log_stderr)]
         log_stdout.close(), log_stderr.close()
-        if process.returncode == TEST_EXIT_PASSED and stderr == "":
+        if wait_error is not None:
+            status = "Failed"
+            stderr += wait_error
+        elif process.returncode == TEST_EXIT_PASSED and stderr == "":
             status = "Passed"
         elif process.returncode == TEST_EXIT_SKIPPED:
             status = "Skipped"
         else:
             status = "Failed"
 
-        return TestResult(self.test_num, self.test_case, testdir, status,
-                          time.time() - start_time, stdout, stderr)
+        result = TestResult(self.test_num, self.test_case, testdir, status,
+                            time.time() - start_time, stdout, stderr)
+        if rusage is not None:
+            result.cpu_user = rusage.ru_utime
+            result.cpu_sys = rusage.ru_stime
+            # ru_maxrss is in bytes on macOS, in KiB elsewhere
+            result.max_rss = rusage.ru_maxrss / \
+                (2**20 if sys.platform == 'darwin' else 2**10)
+        # The sampled memory of the whole process tree is more accurate than
+        # the largest process in rusage, but can miss short peaks
+        if sampler.max_rss is not None:
+            result.max_rss = max(sampler.max_rss, result.max_rss or 0)
+        result.max_disk = sampler.max_disk
+        result.leased = self.warm_pool is not None and \
+            self.warm_pool.leased_by(os.path.abspath(testdir))
+        return result
+
+
+class ResourceSampler():
+    """
+    Sample the memory used by a test, the sum of the RSS of its process and
+    of all the descendants (the nodes), and the disk space used by its
+    tmpdir, in a background thread. The memory is only sampled where /proc
+    is available. Peaks are in MiB.
+    """
+
+    def __init__(self, pid, directory, interval=RESOURCE_SAMPLING_INTERVAL):
+        self.pid = pid
+        self.directory = directory
+        self.interval = interval
+        self.max_rss = None
+        self.max_disk = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            self.sample()
+            if self._stop.wait(self.interval):
+                break
+
+    def sample(self):
+        rss = get_process_tree_rss(self.pid)
+        if rss is not None:
+            self.max_rss = max(self.max_rss or 0, rss)
+        self.max_disk = max(self.max_disk, get_directory_size(self.directory))
+
+
+def get_process_tree_rss(pid):
+    """Return the RSS of pid and all its descendants in MiB, None if /proc
+    is not available."""
+    if not os.path.isdir('/proc/self'):
+        return None
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry), encoding='utf8') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name can contain spaces, the fields follow it
+        ppid = int(stat[stat.rfind(')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    rss = 0
+    pids = [pid]
+    while pids:
+        p = pids.pop()
+        pids.extend(children.get(p, []))
+        try:
+            with open('/proc/{}/statm'.format(p), encoding='utf8') as f:
+                rss += int(f.read().split()[1]) * page_size
+        except (OSError, IndexError):
+            pass
+    return rss / 2**20
+
+
+def get_directory_size(directory):
+    """Return the size of the files under directory in MiB"""
+    size = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                # Removed meanwhile
+                pass
+    return size / 2**20
+
+
+def wait_with_rusage(process):
+    """Wait for process to exit and return its resource usage, which
+    includes the usage of its waited for children (the nodes), or None if
+    not available on this platform."""
+    if not hasattr(os, 'wait4'):
+        process.wait()
+        return None
+    _, status, rusage = os.wait4(process.pid, 0)
+    # The process is reaped, tell Popen how it exited
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return rusage
 
 
 def on_ci():
@@ -197,6 +406,8 @@ def main():
                              'and all test nodes.')
     parser.add_argument('--coverage', action='store_true',
                         help='generate a basic coverage report for the RPC interface')
+    parser.add_argument('--rpcprofile', action='store_true',
+                        help='report the slowest RPC commands and the tests spending most of their time in RPC calls')
     parser.add_argument(
         '--exclude', '-x', help='specify a comma-separated-list of scripts to exclude.')
     parser.add_argument('--extended', action='store_true',
@@ -211,8 +422,18 @@ def main():
                         help='the default behavior is to flush the cache directory on startup. --keepcache retains the cache from the previous testrun.')
     parser.add_argument('--quiet', '-q', action='store_true',
                         help='only print results summary and failure logs')
+    parser.add_argument('--regressionthreshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help='warn about the tests using more than (1 + this) times the time, CPU, memory or disk space recorded in timing.json')
+    parser.add_argument('--zygote', action='store_true',
+                        help='fork the tests from a process with the test framework already imported, instead of starting a new python interpreter for each test (unix only)')
+    parser.add_argument('--warmpool', type=int, default=0, metavar='n',
+                        help='keep n nodes running on the cached chain for each of the first node indices, the tests supporting it lease them instead of starting their own nodes (unix only)')
+    parser.add_argument('--shard', type=parse_shard, metavar='i/n',
+                        help='only run the i-th (from 1) of n parts of the selected tests, balanced by their recorded durations, and print the predicted duration of the parts')
     parser.add_argument('--tmpdirprefix', '-t',
                         default=os.path.join(build_dir, 'test', 'tmp'), help="Root directory for datadirs")
+    parser.add_argument('--tmpfs', nargs='?', const='/dev/shm', metavar='DIR',
+                        help='put the chain cache and the datadirs of the tests expected to fit in a RAM-backed filesystem, /dev/shm by default. The larger tests, and the datadirs of the failed tests, stay under --tmpdirprefix')
     parser.add_argument(
         '--failfast',
         action='store_true',
@@ -245,6 +466,19 @@ def main():
     if args.junitoutput and not os.path.isabs(args.junitoutput):
         args.junitoutput = os.path.join(tmpdir, args.junitoutput)
 
+    cache_dir = os.path.join(build_dir, "test", "cache")
+    tmpfs_dir = None
+    if args.tmpfs:
+        remove_stale_tmpfs_dirs(args.tmpfs)
+        tmpfs_dir = os.path.join(args.tmpfs, os.path.basename(tmpdir))
+        os.makedirs(tmpfs_dir)
+        with open(os.path.join(tmpfs_dir, TMPFS_PID_FILENAME), 'w', encoding="utf8") as f:
+            f.write(str(os.getpid()))
+        # One cache per build, kept with --keepcache like the default one
+        cache_dir = os.path.join(args.tmpfs, "bitcoin_test_cache_{}".format(
+            hashlib.sha256(build_dir.encode('utf-8')).hexdigest()[:8]))
+        logging.debug("Temporary tmpfs directory at {}".format(tmpfs_dir))
+
     enable_bitcoind = config["components"].getboolean("ENABLE_BITCOIND")
 
     if not enable_bitcoind:
@@ -315,6 +549,18 @@ def main():
     test_list = get_tests_to_run(
         test_list, TEST_PARAMS, cutoff, src_timings)
 
+    if args.shard:
+        shard, num_shards = args.shard
+        shards, durations = shard_tests(
+            test_list, src_timings.get_times(), num_shards)
+        for i, (tests, duration) in enumerate(zip(shards, durations), 1):
+            print("{}Shard {}/{}: {} tests, predicted duration {} s{}".format(
+                BOLD[1] if i == shard else "", i, num_shards, len(tests),
+                duration, BOLD[0] if i == shard else ""))
+        # Keep the longest first order
+        shard_set = set(shards[shard - 1])
+        test_list = [t for t in test_list if t in shard_set]
+
     if not test_list:
         print("No valid test scripts specified. Check that your test is in one "
               "of the test lists in test_runner.py, or run test_runner.py with no arguments to run all tests")
@@ -330,28 +576,56 @@ def main():
 
     check_script_prefixes(all_scripts)
 
+    warm_pool_args = None
+    if args.warmpool > 0:
+        from test_framework.test_framework import TIMESTAMP_IN_THE_PAST
+        warm_pool_args = {
+            'size': args.warmpool,
+            'bitcoind': os.getenv("BITCOIND", default=os.path.join(
+                build_dir, "src", "bitcoind" + config["environment"]["EXEEXT"])),
+            'emulator': config["environment"]["EMULATOR"] or None,
+            # The framework arguments changing the command line of the nodes
+            'default_args': ["-axionactivationtime={}".format(
+                TIMESTAMP_IN_THE_PAST)] if "--with-axionactivation" in passon_args else [],
+        }
+
     if not args.keepcache:
-        shutil.rmtree(os.path.join(build_dir, "test",
-                                   "cache"), ignore_errors=True)
-
-    run_tests(
-        test_list,
-        build_dir,
-        tests_dir,
-        args.junitoutput,
-        tmpdir,
-        num_jobs=args.jobs,
-        test_suite_name=args.testsuitename,
-        enable_coverage=args.coverage,
-        args=passon_args,
-        combined_logs_len=args.combinedlogslen,
-        build_timings=build_timings,
-        failfast=args.failfast
-    )
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    try:
+        run_tests(
+            test_list,
+            build_dir,
+            tests_dir,
+            args.junitoutput,
+            tmpdir,
+            num_jobs=args.jobs,
+            test_suite_name=args.testsuitename,
+            enable_coverage=args.coverage,
+            enable_rpc_profile=args.rpcprofile,
+            args=passon_args,
+            combined_logs_len=args.combinedlogslen,
+            build_timings=build_timings,
+            failfast=args.failfast,
+            regression_threshold=args.regressionthreshold,
+            use_zygote=args.zygote,
+            warm_pool_args=warm_pool_args,
+            timings=src_timings.existing_timings + (
+                build_timings.existing_timings if build_timings else []),
+            cache_dir=cache_dir,
+            tmpfs_dir=tmpfs_dir,
+        )
+    finally:
+        # Do not leave anything in memory, even when interrupted
+        if tmpfs_dir is not None:
+            shutil.rmtree(tmpfs_dir, ignore_errors=True)
+            if not args.keepcache:
+                shutil.rmtree(cache_dir, ignore_errors=True)
 
 
 def run_tests(test_list, build_dir, tests_dir, junitoutput, tmpdir, num_jobs, test_suite_name,
-              enable_coverage=False, args=None, combined_logs_len=0, build_timings=None, failfast=False):
+              enable_coverage=False, enable_rpc_profile=False, args=None, combined_logs_len=0, build_timings=None, failfast=False, timings=None, regression_threshold=DEFAULT_REGRESSION_THRESHOLD, use_zygote=False, warm_pool_args=None,
+              cache_dir=None, tmpfs_dir=None):
     args = args or []
 
     # Warn if bitcoind is already running (unix only)
@@ -364,7 +638,7 @@ def run_tests(test_list, build_dir, tests_dir, junitoutput, tmpdir, num_jobs, te
         pass
 
     # Warn if there is a cache directory
-    cache_dir = os.path.join(build_dir, "test", "cache")
+    cache_dir = cache_dir or os.path.join(build_dir, "test", "cache")
     if os.path.isdir(cache_dir):
         print("{}WARNING!{} There is a cache directory here: {}. If tests fail unexpectedly, try deleting the cache directory.".format(
             BOLD[1], BOLD[0], cache_dir))
@@ -376,6 +650,9 @@ def run_tests(test_list, build_dir, tests_dir, junitoutput, tmpdir, num_jobs, te
         test_framework_tests.addTest(
             unittest.TestLoader().loadTestsFromName(
                 "test_framework.{}".format(module)))
+    # And the tests of the runner itself
+    test_framework_tests.addTest(
+        unittest.TestLoader().loadTestsFromModule(sys.modules[__name__]))
     result = unittest.TextTestRunner(
         verbosity=1, failfast=True).run(test_framework_tests)
     if not result.wasSuccessful():
@@ -393,11 +670,19 @@ def run_tests(test_list, build_dir, tests_dir, junitoutput, tmpdir, num_jobs, te
     else:
         coverage = None
 
-    if len(test_list) > 1 and num_jobs > 1:
+    if enable_rpc_profile:
+        rpc_profile = RPCProfile()
+        flags.append(rpc_profile.flag)
+        logging.debug(
+            "Initializing RPC profile directory at {}".format(rpc_profile.dir))
+    else:
+        rpc_profile = None
+
+    if (len(test_list) > 1 and num_jobs > 1) or warm_pool_args:
         # Populate cache
         try:
             subprocess.check_output([sys.executable, os.path.join(
-                tests_dir, 'create_cache.py')] + flags + [os.path.join("--tmpdir={}", "cache") .format(tmpdir)])
+                tests_dir, 'create_cache.py')] + flags + [os.path.join("--tmpdir={}", "cache") .format(tmpfs_dir or tmpdir)])
         except subprocess.CalledProcessError as e:
             sys.stdout.buffer.write(e.output)
             raise
@@ -405,13 +690,25 @@ def run_tests(test_list, build_dir, tests_dir, junitoutput, tmpdir, num_jobs, te
     # Run Tests
     start_time = time.time()
     test_results = execute_test_processes(
-        num_jobs, test_list, tests_dir, tmpdir, flags, failfast)
+        num_jobs, test_list, tests_dir, tmpdir, flags, failfast,
+        get_test_costs(test_list, tests_dir, timings or [],
+                       tmpfs=tmpfs_dir is not None), use_zygote,
+        dict(warm_pool_args, cache_node_dir=os.path.join(cache_dir, "node0"))
+        if warm_pool_args else None, tmpfs_dir)
     runtime = time.time() - start_time
 
     max_len_name = len(max(test_list, key=len))
     print_results(test_results, tests_dir, max_len_name,
                   runtime, combined_logs_len)
 
+    regressions = find_regressions(
+        test_results, timings or [], regression_threshold)
+    if regressions:
+        print("{}WARNING!{} Tests using more than {:.0%} of their recorded resources:".format(
+            BOLD[1], BOLD[0], 1 + regression_threshold))
+        for name, changes in regressions:
+            print("  {}: {}".format(name, ", ".join(changes)))
+
     if junitoutput is not None:
         save_results_as_junit(
             test_results,
@@ -422,6 +719,10 @@ def run_tests(test_list, build_dir, tests_dir, junitoutput, tmpdir, num_jobs, te
     if (build_timings is not None):
         build_timings.save_timings(test_results)
 
+    if rpc_profile:
+        rpc_profile.report(test_results)
+        rpc_profile.cleanup()
+
     if coverage:
         coverage_passed = coverage.report_rpc_coverage()
 
@@ -441,9 +742,10 @@ def run_tests(test_list, build_dir, tests_dir, junitoutput, tmpdir, num_jobs, te
 
 
 def execute_test_processes(
-        num_jobs, test_list, tests_dir, tmpdir, flags, failfast=False):
+        num_jobs, test_list, tests_dir, tmpdir, flags, failfast=False,
+        costs=None, use_zygote=False, warm_pool_args=None, tmpfs_dir=None):
     update_queue = Queue()
-    job_queue = Queue()
+    done_queue = Queue()
     failfast_event = threading.Event()
     test_results = []
     poll_timeout = 10  # seconds
@@ -522,22 +824,21 @@ def execute_test_processes(
                     sys.stdout.flush()
                     printed_status = True
 
-    def handle_test_cases():
+    def handle_test_case(test):
         """
-        job_runner represents a single thread that is part of a worker pool.
-        It waits for a test, then executes that test.
-        It also reports start and result messages to handle_update_messages
+        handle_test_case runs in its own thread and executes a single test.
+        It reports start and result messages to handle_update_messages, then
+        tells the scheduler the test is done.
         """
-        while True:
-            test = job_queue.get()
-            if test is None:
-                break
-            # Signal that the test is starting to inform the poor waiting
-            # programmer
-            update_queue.put(test)
+        # Signal that the test is starting to inform the poor waiting
+        # programmer
+        update_queue.put(test)
+        try:
             result = test.run(portseed_offset)
             update_queue.put(result)
-            job_queue.task_done()
+        finally:
+            # The scheduler waits for it, whatever happened to the test
+            done_queue.put(test)
 
     ##
     # Setup our threads, and start sending tasks
@@ -548,34 +849,275 @@ def execute_test_processes(
     resultCollector.daemon = True
     resultCollector.start()
 
-    # Start some worker threads
-    for job in range(num_jobs):
-        t = threading.Thread(target=handle_test_cases)
-        t.daemon = True
-        t.start()
+    # The zygote ignores SIGINT and the pool nodes outlive the tests: they
+    # are stopped on any exit, including an interruption
+    warm_pool = None
+    zygote = None
+    try:
+        if warm_pool_args is not None:
+            from test_framework.warmpool import WARM_POOL_ENV, WarmPool
+            # On the port seeds following the ones of the tests
+            warm_pool = WarmPool(
+                os.path.join(tmpfs_dir or tmpdir, "warm_pool"),
+                port_seed=portseed_offset + len(test_list), **warm_pool_args)
+            # Inherited by the tests, and by the zygote
+            os.environ[WARM_POOL_ENV] = warm_pool.socket_path
+
+        if use_zygote:
+            from test_framework.zygote import Zygote
+            zygote = Zygote(tests_dir)
+
+        tmpfs = None
+        if tmpfs_dir is not None:
+            tmpfs = TmpfsAllocator(tmpfs_dir, tmpdir)
+
+        # Start the tests as the resources of the machine allow
+        costs = costs or {}
+        tests = []
+        for i, t in enumerate(test_list):
+            cost = costs.get(t, TestCost(0, DEFAULT_TEST_CPU, 0, 0))
+            tests.append((TestCase(i, t, tests_dir, tmpdir, failfast_event,
+                                   flags, zygote, tmpfs, cost.disk,
+                                   warm_pool), cost))
+        scheduler = TestScheduler(
+            tests, num_jobs, multiprocessing.cpu_count(),
+            get_available_memory())
+        while not scheduler.done():
+            for test in scheduler.next_tests(time.time()):
+                t = threading.Thread(target=handle_test_case, args=(test,))
+                t.daemon = True
+                t.start()
+            scheduler.finish(done_queue.get())
+
+        # Wait for all the results to be compiled
+        update_queue.join()
+
+        # Flush our queue so the thread exits
+        update_queue.put(None)
+    finally:
+        if zygote is not None:
+            zygote.close()
+
+        if warm_pool is not None:
+            del os.environ[WARM_POOL_ENV]
+            warm_pool.close()
+
+    if warm_pool is not None:
+        print("Warm pool: {}".format(warm_pool.report()))
+
+    if tmpfs is not None:
+        print("Tmpfs: {}".format(tmpfs.report()))
 
-    # Push all our test cases into the job queue.
-    for i, t in enumerate(test_list):
-        job_queue.put(TestCase(i, t, tests_dir, tmpdir, failfast_event, flags))
+    return test_results
 
-    # Wait for all the jobs to be completed
-    job_queue.join()
 
-    # Wait for all the results to be compiled
-    update_queue.join()
+# Estimated cost of a test: its duration in seconds, the number of cores it
+# keeps busy, its memory and the size of its tmpdir in MiB
+TestCost = namedtuple('TestCost', ['time', 'cpu', 'memory', 'disk'])
 
-    # Flush our queues so the threads exit
-    update_queue.put(None)
-    for job in range(num_jobs):
-        job_queue.put(None)
 
-    return test_results
+def get_test_costs(test_list, tests_dir, timings, tmpfs=False):
+    """
+    Estimate the cost of the tests from their recorded timings, falling back
+    to an estimate from their number of nodes.
+    The peak memory recorded is the one of the test and all its nodes. With
+    tmpfs, the tmpdir of the tests small enough for it is in memory too.
+    """
+    recorded = {t['name']: t for t in timings}
+    costs = {}
+    for test in test_list:
+        num_nodes = get_test_num_nodes(
+            os.path.join(tests_dir, test.split()[0]))
+        timing = recorded.get(test, {})
+        duration = timing.get('time', 0)
+        cpu = DEFAULT_TEST_CPU
+        resources = get_recorded_resources(timing)
+        if 'cpu' in resources and duration > 0:
+            cpu = resources['cpu'] / duration
+        if 'max_rss' in resources:
+            memory = resources['max_rss']
+        else:
+            memory = DEFAULT_FRAMEWORK_MEMORY + \
+                DEFAULT_NODE_MEMORY * num_nodes
+        if 'max_disk' in resources:
+            disk = resources['max_disk']
+        else:
+            disk = LARGE_DISK_TESTS.get(
+                test.split()[0], DEFAULT_NODE_DISK * num_nodes)
+        if tmpfs and disk <= TMPFS_MAX_TEST_DISK:
+            memory += disk
+        costs[test] = TestCost(duration, min(cpu, multiprocessing.cpu_count()),
+                               memory, disk)
+    return costs
+
+
+def get_test_num_nodes(script):
+    """Return the largest number of nodes a test script sets, 0 if unknown"""
+    try:
+        with open(script, encoding="utf8") as f:
+            return max([int(n) for n in re.findall(
+                r"self\.num_nodes\s*=\s*(\d+)", f.read())] or [0])
+    except OSError:
+        return 0
+
+
+def get_available_memory():
+    """Return the memory available to the tests in MiB, None if unknown"""
+    try:
+        with open('/proc/meminfo', encoding="utf8") as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+class TmpfsAllocator():
+    """
+    Choose where the tmpdir of each test goes: in tmpfs_dir while the
+    estimated disk footprints of the tests there fit in the free space of the
+    tmpfs, in disk_dir otherwise. Tests larger than TMPFS_MAX_TEST_DISK always
+    go to disk_dir.
+    """
+
+    def __init__(self, tmpfs_dir, disk_dir, capacity=None):
+        self.tmpfs_dir = tmpfs_dir
+        self.disk_dir = disk_dir
+        if capacity is None:
+            capacity = shutil.disk_usage(
+                tmpfs_dir).free / 2**20 * TMPFS_USABLE_SPACE
+        # In MiB
+        self.capacity = capacity
+        self.used = 0
+        self.counts = {tmpfs_dir: 0, disk_dir: 0}
+        self.lock = threading.Lock()
+
+    def acquire(self, disk):
+        """Return the directory for the tmpdir of a test using disk MiB"""
+        with self.lock:
+            if disk <= TMPFS_MAX_TEST_DISK and \
+                    self.used + disk <= self.capacity:
+                self.used += disk
+                directory = self.tmpfs_dir
+            else:
+                directory = self.disk_dir
+            self.counts[directory] += 1
+            return directory
+
+    def release(self, directory, disk):
+        if directory == self.tmpfs_dir:
+            with self.lock:
+                self.used -= disk
+
+    def report(self):
+        return "{} tests in {}, {} tests in {}".format(
+            self.counts[self.tmpfs_dir], self.tmpfs_dir,
+            self.counts[self.disk_dir], self.disk_dir)
+
+
+def remove_stale_tmpfs_dirs(tmpfs):
+    """Remove the tmpfs directories left by the runners that were killed"""
+    try:
+        entries = os.listdir(tmpfs)
+    except OSError:
+        return
+    for entry in entries:
+        path = os.path.join(tmpfs, entry)
+        try:
+            with open(os.path.join(path, TMPFS_PID_FILENAME), encoding="utf8") as f:
+                pid = int(f.read())
+        except (OSError, ValueError):
+            continue
+        try:
+            os.kill(pid, 0)
+            continue
+        except ProcessLookupError:
+            pass
+        except OSError:
+            # Running, as another user
+            continue
+        logging.debug("Removing stale tmpfs directory {}".format(path))
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class TestScheduler():
+    """
+    Decide when to start the tests, so that the tests running together fit
+    in the cores and memory of the machine.
+
+    The tests are started in the order given (longest first) as long as they
+    fit. When the next test does not fit, the resources are reserved for it:
+    a later test is only started if it fits now and is expected to be done
+    by the time the next test can start (backfilling). So expensive tests do
+    not overlap, and are not delayed forever by the smaller ones. A test too
+    large for the machine runs alone.
+    """
+
+    def __init__(self, tests, max_jobs, cpus, memory=None):
+        # List of (test, cost)
+        self.pending = list(tests)
+        self.max_jobs = max_jobs
+        self.cpus = cpus
+        self.memory = memory
+        # test -> (cost, start time)
+        self.running = {}
+
+    def done(self):
+        return not self.pending and not self.running
+
+    def _fits(self, cost, running):
+        return len(running) < self.max_jobs and \
+            sum(c.cpu for c, _ in running) + cost.cpu <= self.cpus and (
+                self.memory is None or
+                sum(c.memory for c, _ in running) + cost.memory <= self.memory)
+
+    def _start_time(self, cost, now):
+        """Estimate when the running tests leave enough room for cost"""
+        running = sorted(self.running.values(),
+                         key=lambda r: r[0].time + r[1])
+        end = now
+        while running and not self._fits(cost, running):
+            running_cost, start_time = running.pop(0)
+            end = max(end, start_time + running_cost.time)
+        return end
+
+    def next_tests(self, now):
+        """Return the tests to start now"""
+        started = []
+
+        def start(i):
+            test, cost = self.pending.pop(i)
+            self.running[test] = (cost, now)
+            started.append(test)
+
+        while self.pending:
+            _, cost = self.pending[0]
+            if not self.running or self._fits(cost, self.running.values()):
+                start(0)
+                continue
+            reserved_until = self._start_time(cost, now)
+            backfill = next(
+                (i for i, (_, c) in enumerate(self.pending[1:], 1)
+                 if self._fits(c, self.running.values()) and
+                 now + c.time <= reserved_until), None)
+            if backfill is None:
+                break
+            start(backfill)
+        return started
+
+    def finish(self, test):
+        del self.running[test]
 
 
 def print_results(test_results, tests_dir, max_len_name,
                   runtime, combined_logs_len):
-    results = "\n" + BOLD[1] + "{} | {} | {}\n\n".format(
-        "TEST".ljust(max_len_name), "STATUS   ", "DURATION") + BOLD[0]
+    results = "\n" + BOLD[1] + "{} | {} | {} | {} | {} | {}\n\n".format(
+        "TEST".ljust(max_len_name), "STATUS   ", "DURATION", "CPU".rjust(8),
+        "MAX RSS".rjust(8), "MAX DISK") + BOLD[0]
 
     test_results.sort(key=TestResult.sort_key)
     all_passed = True
@@ -634,6 +1176,15 @@ class TestResult():
         self.padding = 0
         self.stdout = stdout
         self.stderr = stderr
+        # CPU time in seconds, peak memory and tmpdir size in MiB, when
+        # measured
+        self.cpu_user = None
+        self.cpu_sys = None
+        self.max_rss = None
+        self.max_disk = None
+        # Whether the test ran on nodes leased from the warm pool, which are
+        # not accounted in its resources
+        self.leased = False
 
     def sort_key(self):
         if self.status == "Passed":
@@ -654,8 +1205,28 @@ class TestResult():
             color = GREY
             glyph = CIRCLE
 
-        return color[1] + "{} | {}{} | {} s\n".format(
-            self.name.ljust(self.padding), glyph, self.status.ljust(7), TimeResolution.seconds(self.time)) + color[0]
+        resources = self.resources()
+
+        def column(key, unit):
+            if key not in resources:
+                return "-".rjust(8)
+            return "{} {}".format(round(resources[key]), unit).rjust(8)
+
+        return color[1] + "{} | {}{} | {} s | {} | {} | {}\n".format(
+            self.name.ljust(self.padding), glyph, self.status.ljust(7), TimeResolution.seconds(self.time),
+            column('cpu', 's'), column('max_rss', 'MiB'), column('max_disk', 'MiB')) + color[0]
+
+    def resources(self):
+        """Return the resources used by the test, as get_recorded_resources
+        would after the result is saved."""
+        resources = {'time': self.time}
+        if self.cpu_user is not None:
+            resources['cpu'] = self.cpu_user + self.cpu_sys
+        if self.max_rss is not None:
+            resources['max_rss'] = self.max_rss
+        if self.max_disk is not None:
+            resources['max_disk'] = self.max_disk
+        return resources
 
     @property
     def was_successful(self):
@@ -708,10 +1279,11 @@ def get_tests_to_run(test_list, test_params, cutoff, src_timings):
     Timings from build directory override those from src directory
     """
 
+    test_times = src_timings.get_times()
+
     def get_test_time(test):
         # Return 0 if test is unknown to always run it
-        return next(
-            (x['time'] for x in src_timings.existing_timings if x['name'] == test), 0)
+        return test_times.get(test, 0)
 
     # Some tests must also be run with additional parameters. Add them to the
     # list.
@@ -730,6 +1302,74 @@ def get_tests_to_run(test_list, test_params, cutoff, src_timings):
     return result
 
 
+def parse_shard(value):
+    """Parse the --shard argument i/n into (i, n)"""
+    m = re.fullmatch(r"(\d+)/(\d+)", value)
+    if m is None or not 1 <= int(m.group(1)) <= int(m.group(2)):
+        raise argparse.ArgumentTypeError(
+            "expected i/n with 1 <= i <= n, got {}".format(value))
+    return int(m.group(1)), int(m.group(2))
+
+
+def shard_tests(test_list, test_times, num_shards):
+    """
+    Split the tests into num_shards lists of about the same total duration,
+    with the greedy longest processing time algorithm: each test, longest
+    first, goes to the shard with the smallest total so far (the first one
+    on ties), so the partition only depends on the tests and their timings.
+    Returns the shards and their predicted durations.
+    Unknown tests count for a second, so they are spread over the shards.
+    """
+    def get_test_time(test):
+        return max(1, test_times.get(test, 0))
+
+    shards = [[] for _ in range(num_shards)]
+    durations = [0] * num_shards
+    for test in sorted(test_list, key=lambda t: (-get_test_time(t), t)):
+        i = min(range(num_shards), key=lambda i: (durations[i], i))
+        shards[i].append(test)
+        durations[i] += get_test_time(test)
+    return shards, durations
+
+
+def get_recorded_resources(timing):
+    """Return the resources used by a test from its saved timing entry"""
+    resources = {key: timing[key]
+                 for key in ('time', 'max_rss', 'max_disk') if key in timing}
+    if 'cpu_user' in timing:
+        resources['cpu'] = timing['cpu_user'] + timing['cpu_sys']
+    return resources
+
+
+def find_regressions(test_results, timings, threshold):
+    """
+    Compare the resources used by the passed tests, except the ones leasing
+    nodes from the warm pool, with their recorded timings. Return the list
+    of (test name, [description]) of the tests using more than
+    (1 + threshold) times a recorded resource, ignoring the increases below
+    REGRESSION_MIN_INCREASE.
+    """
+    recorded = {t['name']: t for t in timings}
+    units = {'time': 's', 'cpu': 's', 'max_rss': 'MiB', 'max_disk': 'MiB'}
+    regressions = []
+    for result in sorted(test_results, key=lambda r: r.name):
+        if result.status != 'Passed' or result.leased or \
+                result.name not in recorded:
+            continue
+        before = get_recorded_resources(recorded[result.name])
+        changes = []
+        for key, value in sorted(result.resources().items()):
+            if key not in before or \
+                    value - before[key] < REGRESSION_MIN_INCREASE[key]:
+                continue
+            if value > before[key] * (1 + threshold):
+                changes.append("{} {} -> {} {}".format(
+                    key, round(before[key]), round(value), units[key]))
+        if changes:
+            regressions.append((result.name, changes))
+    return regressions
+
+
 class RPCCoverage():
     """
     Coverage reporting utilities for test_runner.
@@ -801,6 +1441,116 @@ class RPCCoverage():
         return all_cmds - covered_cmds
 
 
+class RPCProfile():
+    """
+    RPC profiling report for test_runner.
+
+    Each test script subprocess writes, for each node, the number of calls,
+    the latencies and the request and response sizes of the RPC commands it
+    sent into a directory (see test/functional/test_framework/coverage.py).
+    They are aggregated over the suite to find the slowest commands, and the
+    tests whose duration is mostly spent waiting for RPC calls.
+    """
+    # Number of RPC commands in the report
+    TOP_METHODS = 15
+    # Report the tests spending more than this fraction of their duration in
+    # RPC calls. Concurrent calls can add up to more than the duration.
+    RPC_DOMINANT_RATIO = 0.5
+
+    def __init__(self):
+        self.dir = tempfile.mkdtemp(prefix="rpcprofile")
+        self.flag = '--rpcprofiledir={}'.format(self.dir)
+
+    def cleanup(self):
+        return shutil.rmtree(self.dir)
+
+    @staticmethod
+    def percentile(histogram, fraction):
+        """Nearest-rank percentile of the values counted in histogram, a
+        {bucket upper bound: count} dict. Returns the bound of its bucket."""
+        count = sum(histogram.values())
+        if not count:
+            return 0
+        rank = max(1, int(fraction * count + 0.999999))
+        for bound in sorted(histogram):
+            rank -= histogram[bound]
+            if rank <= 0:
+                return bound
+
+    def load(self):
+        """Return the aggregated stats by RPC command, and the RPC time by
+        test script."""
+        # This is shared from `test/functional/test-framework/coverage.py`
+        profile_file_prefix = 'rpcprofile.'
+
+        methods = {}
+        rpc_time = {}
+        for filename in os.listdir(self.dir):
+            # Skip the partial files of the killed tests
+            if not filename.startswith(profile_file_prefix) or \
+                    not filename.endswith('.json'):
+                continue
+            with open(os.path.join(self.dir, filename), 'r', encoding="utf8") as f:
+                profile = json.load(f)
+            for method, stats in profile['methods'].items():
+                total = methods.setdefault(method, {
+                    'count': 0, 'time': 0.0, 'latencies': {},
+                    'max_latency': 0, 'request_bytes': 0,
+                    'response_bytes': 0})
+                for key in ('count', 'time', 'request_bytes',
+                            'response_bytes'):
+                    total[key] += stats[key]
+                # The buckets are the same in all the profiles
+                for bound, count in stats['latencies'].items():
+                    total['latencies'][int(bound)] = \
+                        total['latencies'].get(int(bound), 0) + count
+                total['max_latency'] = max(total['max_latency'],
+                                           stats['max_latency'])
+                rpc_time[profile['script']] = rpc_time.get(
+                    profile['script'], 0.0) + stats['time']
+        return methods, rpc_time
+
+    def report(self, test_results):
+        methods, rpc_time = self.load()
+        if not methods:
+            print("No RPC profile was recorded.")
+            return
+
+        print(BOLD[1] + "Slowest RPC commands (by accumulated time):" + BOLD[0])
+        print("{:<28} {:>8} {:>10} {:>9} {:>9} {:>9} {:>11} {:>11}".format(
+            "COMMAND", "CALLS", "TOTAL (s)", "P50 (ms)", "P95 (ms)",
+            "MAX (ms)", "REQ (kB)", "RESP (kB)"))
+        slowest = sorted(methods.items(), key=lambda m: m[1]['time'],
+                         reverse=True)[:self.TOP_METHODS]
+        for method, stats in slowest:
+            latencies = stats['latencies']
+            print("{:<28} {:>8} {:>10.3f} {:>9.2f} {:>9.2f} {:>9.2f} {:>11.1f} {:>11.1f}".format(
+                method, stats['count'], stats['time'],
+                self.percentile(latencies, 0.5) / 1000,
+                self.percentile(latencies, 0.95) / 1000,
+                stats['max_latency'] / 1000,
+                stats['request_bytes'] / 1000,
+                stats['response_bytes'] / 1000))
+
+        wall_time = {}
+        for test_result in test_results:
+            if test_result.status == "Passed":
+                script = test_result.name.split()[0]
+                wall_time[script] = wall_time.get(
+                    script, 0.0) + test_result.time
+        dominated = sorted(
+            ((rpc_time[script] / wall, script, wall)
+             for script, wall in wall_time.items()
+             if wall > 0 and rpc_time.get(script, 0) / wall >
+             self.RPC_DOMINANT_RATIO), reverse=True)
+        if dominated:
+            print(BOLD[1] + "\nTests spending most of their time in RPC calls:" + BOLD[0])
+            for ratio, script, wall in dominated:
+                print("  - {}: {:.1f} s of RPC calls over {:.1f} s ({:.0%})".format(
+                    script, rpc_time[script], wall, ratio))
+        print()
+
+
 def save_results_as_junit(test_results, file_name, time, test_suite_name):
     """
     Save tests results to file in JUnit format
@@ -847,6 +1597,10 @@ class Timings():
         self.timing_file = timing_file
         self.existing_timings = self.load_timings()
 
+    def get_times(self):
+        """Return the recorded duration of the tests, by name"""
+        return {t['name']: t['time'] for t in self.existing_timings}
+
     def load_timings(self):
         if os.path.isfile(self.timing_file):
             with open(self.timing_file, encoding="utf8") as file:
@@ -867,6 +1621,9 @@ class Timings():
                 merged[item[key]].update(item)
             else:
                 merged[item[key]] = item
+        for item in merged.values():
+            for obsolete in OBSOLETE_TIMING_KEYS:
+                item.pop(obsolete, None)
 
         # Sort the result to preserve test ordering in file
         merged = list(merged.values())
@@ -875,11 +1632,24 @@ class Timings():
 
     def save_timings(self, test_results):
         # we only save test that have passed - timings for failed test might be
-        # wrong (timeouts or early fails)
+        # wrong (timeouts or early fails). The resources of the nodes leased
+        # from the warm pool are not measured, these runs are not saved.
         passed_results = [
-            test for test in test_results if test.status == 'Passed']
+            test for test in test_results
+            if test.status == 'Passed' and not test.leased]
         new_timings = list(map(lambda test: {'name': test.name, 'time': TimeResolution.seconds(test.time)},
                                passed_results))
+        # Record the resources used, for the scheduler to estimate the cost
+        # of the tests
+        for timing, test in zip(new_timings, passed_results):
+            if test.cpu_user is not None:
+                timing['cpu_user'] = TimeResolution.milliseconds(
+                    test.cpu_user)
+                timing['cpu_sys'] = TimeResolution.milliseconds(test.cpu_sys)
+            if test.max_rss is not None:
+                timing['max_rss'] = round(test.max_rss)
+            if test.max_disk is not None:
+                timing['max_disk'] = round(test.max_disk)
         merged_timings = self.get_merged_timings(new_timings)
 
         with open(self.timing_file, 'w', encoding="utf8") as file:
@@ -896,5 +1666,231 @@ class TimeResolution:
         return round(time_fractional_second, 3)
 
 
+class TestRunnerScheduler(unittest.TestCase):
+    def test_fits(self):
+        cost = TestCost(10, 2, 100, 0)
+        scheduler = TestScheduler(
+            [('a', cost), ('b', cost), ('c', cost)], 8, 4, 250)
+        # c does not fit in the memory
+        self.assertEqual(scheduler.next_tests(0), ['a', 'b'])
+        self.assertEqual(scheduler.next_tests(1), [])
+        scheduler.finish('a')
+        self.assertEqual(scheduler.next_tests(10), ['c'])
+        scheduler.finish('b')
+        scheduler.finish('c')
+        self.assertTrue(scheduler.done())
+
+    def test_max_jobs(self):
+        cost = TestCost(10, 1, 0, 0)
+        scheduler = TestScheduler(
+            [('a', cost), ('b', cost), ('c', cost)], 2, 4)
+        self.assertEqual(scheduler.next_tests(0), ['a', 'b'])
+
+    def test_backfill(self):
+        scheduler = TestScheduler([
+            ('a', TestCost(10, 3, 0, 0)),
+            ('big', TestCost(100, 4, 0, 0)),
+            ('long', TestCost(20, 1, 0, 0)),
+            ('short', TestCost(5, 1, 0, 0)),
+        ], 8, 4)
+        # big waits for a, only short is done before a is
+        self.assertEqual(scheduler.next_tests(0), ['a', 'short'])
+        scheduler.finish('short')
+        self.assertEqual(scheduler.next_tests(5), [])
+        scheduler.finish('a')
+        self.assertEqual(scheduler.next_tests(10), ['big'])
+        scheduler.finish('big')
+        self.assertEqual(scheduler.next_tests(110), ['long'])
+
+    def test_too_large(self):
+        scheduler = TestScheduler([
+            ('huge', TestCost(10, 16, 10**6, 0)),
+            ('small', TestCost(10, 1, 0, 0)),
+        ], 8, 4, 1000)
+        # Runs alone
+        self.assertEqual(scheduler.next_tests(0), ['huge'])
+        scheduler.finish('huge')
+        self.assertEqual(scheduler.next_tests(10), ['small'])
+
+    def test_costs(self):
+        with tempfile.TemporaryDirectory() as tests_dir:
+            with open(os.path.join(tests_dir, 'a.py'), 'w', encoding="utf8") as f:
+                f.write('self.num_nodes = 1\nself.num_nodes = 2\n')
+            timings = [{'name': 'b.py --arg', 'time': 10, 'cpu_user': 15,
+                        'cpu_sys': 5, 'max_rss': 300, 'max_disk': 50}]
+            tests = ['a.py', 'b.py --arg', 'feature_pruning.py']
+            costs = get_test_costs(tests, tests_dir, timings)
+            tmpfs_costs = get_test_costs(tests, tests_dir, timings, tmpfs=True)
+        # Estimated from the number of nodes
+        self.assertEqual(costs['a.py'], TestCost(
+            0, DEFAULT_TEST_CPU,
+            DEFAULT_FRAMEWORK_MEMORY + 2 * DEFAULT_NODE_MEMORY,
+            2 * DEFAULT_NODE_DISK))
+        # Recorded
+        self.assertEqual(costs['b.py --arg'], TestCost(
+            10, min(2.0, multiprocessing.cpu_count()), 300, 50))
+        self.assertEqual(costs['feature_pruning.py'].disk,
+                         LARGE_DISK_TESTS['feature_pruning.py'])
+        # The tmpdir is in memory with tmpfs, unless the test is too large
+        self.assertEqual(tmpfs_costs['a.py'].memory,
+                         costs['a.py'].memory + 2 * DEFAULT_NODE_DISK)
+        self.assertEqual(tmpfs_costs['b.py --arg'].memory, 350)
+        self.assertEqual(tmpfs_costs['feature_pruning.py'],
+                         costs['feature_pruning.py'])
+
+
+class TestRunnerShard(unittest.TestCase):
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard('2/3'), (2, 3))
+        for value in ('0/3', '4/3', '1', '1/0', 'a/b'):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                parse_shard(value)
+
+    def test_shard_tests(self):
+        times = {'a.py': 60, 'b.py': 50, 'c.py': 30, 'd.py': 20,
+                 'e.py': 10}
+        tests = sorted(times) + ['new1.py', 'new2.py']
+        shards, durations = shard_tests(tests, times, 2)
+        # e.py goes to the first shard on a tie, the unknown tests count
+        # for a second
+        self.assertEqual(shards, [['a.py', 'd.py', 'e.py'],
+                                  ['b.py', 'c.py', 'new1.py', 'new2.py']])
+        self.assertEqual(durations, [90, 82])
+        # Every test is in exactly one shard, whatever the input order
+        self.assertEqual(sorted(sum(shards, [])), tests)
+        self.assertEqual(shard_tests(tests[::-1], times, 2), (shards, durations))
+        # More shards than tests
+        shards, durations = shard_tests(['a.py'], times, 3)
+        self.assertEqual(shards, [['a.py'], [], []])
+        self.assertEqual(durations, [60, 0, 0])
+
+
+class TestRunnerTimings(unittest.TestCase):
+    def result(self, name, time, cpu=None, max_rss=None, status='Passed'):
+        result = TestResult(0, name, '', status, time, '', '')
+        if cpu is not None:
+            result.cpu_user = cpu
+            result.cpu_sys = 0
+        result.max_rss = max_rss
+        return result
+
+    def test_find_regressions(self):
+        timings = [
+            {'name': 'a.py', 'time': 100, 'cpu_user': 80, 'cpu_sys': 20,
+             'max_rss': 200},
+            {'name': 'b.py', 'time': 2},
+        ]
+        results = [
+            # Time and memory regressed, not the CPU
+            self.result('a.py', 200, cpu=120, max_rss=500),
+            # Above the threshold, but below the minimal increase
+            self.result('b.py', 6),
+            # Failed or not recorded
+            self.result('a.py', 1000, status='Failed'),
+            self.result('c.py', 1000),
+        ]
+        results.append(self.result('b.py', 1000))
+        results[-1].leased = True
+        self.assertEqual(find_regressions(results, timings, 0.5), [
+            ('a.py', ['max_rss 200 -> 500 MiB', 'time 100 -> 200 s'])])
+        self.assertEqual(find_regressions(results, timings, 1), [
+            ('a.py', ['max_rss 200 -> 500 MiB'])])
+
+    def test_merge(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            timings = Timings(os.path.join(tmpdir, 'timing.json'))
+            timings.existing_timings = [
+                {'name': 'a.py', 'time': 10, 'cpu': 12},
+                {'name': 'b.py', 'time': 5, 'max_rss': 100},
+            ]
+            merged = timings.get_merged_timings([
+                {'name': 'a.py', 'time': 11, 'cpu_user': 9, 'cpu_sys': 2},
+            ])
+        # The obsolete cpu key is dropped, the other tests are kept
+        self.assertEqual(merged, [
+            {'name': 'a.py', 'time': 11, 'cpu_user': 9, 'cpu_sys': 2},
+            {'name': 'b.py', 'time': 5, 'max_rss': 100},
+        ])
+
+    def test_save_leased(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            timings = Timings(os.path.join(tmpdir, 'timing.json'))
+            timings.existing_timings = [{'name': 'b.py', 'time': 5}]
+            results = [self.result('a.py', 10, cpu=8, max_rss=100),
+                       self.result('b.py', 1)]
+            # Without the nodes leased from the warm pool
+            results[1].leased = True
+            timings.save_timings(results)
+            with open(timings.timing_file, encoding='utf8') as f:
+                saved = json.load(f)
+        self.assertEqual(saved, [
+            {'name': 'a.py', 'time': 10, 'cpu_user': 8, 'cpu_sys': 0,
+             'max_rss': 100},
+            {'name': 'b.py', 'time': 5},
+        ])
+
+
+class TestRunnerTestCase(unittest.TestCase):
+    class FailingZygote():
+        def spawn(self, args, stdout, stderr):
+            raise RuntimeError('The zygote failed to start the test')
+
+    class DyingZygote():
+        class Process():
+            pid = os.getpid()
+            returncode = None
+
+            def wait(self):
+                raise RuntimeError('The zygote exited before the test')
+
+        def spawn(self, args, stdout, stderr):
+            stderr.write(b'started\n')
+            return self.Process()
+
+    def run_test(self, zygote):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            test = TestCase(0, 'a.py --flag', tmpdir, tmpdir,
+                            threading.Event(), [], zygote=zygote)
+            return test.run(0)
+
+    def test_spawn_failure(self):
+        result = self.run_test(self.FailingZygote())
+        self.assertEqual(result.status, 'Failed')
+        self.assertEqual(
+            result.stderr,
+            'Failed to start the test: The zygote failed to start the test')
+
+    def test_wait_failure(self):
+        result = self.run_test(self.DyingZygote())
+        self.assertEqual(result.status, 'Failed')
+        self.assertEqual(
+            result.stderr,
+            'started\nFailed to wait for the test: The zygote exited before '
+            'the test')
+
+
+class TestRunnerRPCProfile(unittest.TestCase):
+    def test_load(self):
+        profile = RPCProfile()
+        self.addCleanup(profile.cleanup)
+        for node, latencies in enumerate(({'10': 3, '100': 1},
+                                          {'100': 1, '1000': 5})):
+            with open(os.path.join(profile.dir, 'rpcprofile.{}.json'.format(
+                    node)), 'w', encoding='utf8') as f:
+                json.dump({'script': 'a.py', 'node': node, 'methods': {
+                    'echo': {'count': sum(latencies.values()), 'time': 1.0,
+                             'latencies': latencies, 'max_latency': 900 + node,
+                             'request_bytes': 10, 'response_bytes': 20}}}, f)
+        methods, rpc_time = profile.load()
+        self.assertEqual(rpc_time, {'a.py': 2.0})
+        echo = methods['echo']
+        self.assertEqual(echo['latencies'], {10: 3, 100: 2, 1000: 5})
+        self.assertEqual((echo['count'], echo['max_latency']), (10, 901))
+        self.assertEqual(RPCProfile.percentile(echo['latencies'], 0.3), 10)
+        self.assertEqual(RPCProfile.percentile(echo['latencies'], 0.5), 100)
+        self.assertEqual(RPCProfile.percentile(echo['latencies'], 0.95), 1000)
+        self.assertEqual(RPCProfile.percentile({}, 0.5), 0)
+
+
 if __name__ == '__main__':
     main()